@@ -1,11 +1,13 @@
-import time
-from flask import Flask, jsonify, request, render_template
+import json
+import atexit
+from flask import Flask, Response, jsonify, request, render_template, url_for
 from flask_cors import CORS, cross_origin
 from flask_mail import Mail, Message
 from .config import Config
-from .logic import logic, location_logic
-from .music_recognition import get_human_readable_db, upload_to_db_protected, delete_id_from_db_protected_for_web
-from .story_story_logic import StoryStorySession
+from .jobs import JobRunner, JobError
+from .logic import logic, location_logic, iter_logic, iter_location_logic, location_posts_logic
+from .music_recognition import iter_human_readable_db, upload_to_db_protected, delete_id_from_db_protected_for_web
+from .story_story_logic import StoryStorySessionPool
 
 app = Flask(__name__)
 
@@ -14,6 +16,100 @@ app.config.from_object(Config)
 mail = Mail(app)
 cors = CORS(app)
 
+STORY_STORY_SESSIONS = StoryStorySessionPool()  # Browsers start on first use, not when the app is imported
+atexit.register(STORY_STORY_SESSIONS.close)
+
+
+def run_songs_job(params: dict, progress) -> list:
+    return logic(params['username'], progress=progress)
+
+
+def run_location_songs_job(params: dict, progress) -> list:
+    return location_logic(location=params['location'],
+                          day=params['day'], month=params['month'], year=params['year'], progress=progress)
+
+
+def run_location_posts_songs_job(params: dict, _progress) -> dict:
+    return location_posts_logic(params['location_id'])
+
+
+def run_locations_job(params: dict, _progress) -> list:
+    with STORY_STORY_SESSIONS.session() as storystory_session:
+        return storystory_session.get_instagram_followed_locations_and_dates(dashboard_name=params['dashboard'])
+
+
+JOBS = JobRunner(handlers={'songs': run_songs_job,
+                           'location_songs': run_location_songs_job,
+                           'location_posts_songs': run_location_posts_songs_job,
+                           'locations': run_locations_job})
+JOBS.resume_unfinished()
+
+
+def is_async_request() -> bool:
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+
+def submit_job(job_type: str, params: dict) -> tuple:
+    """Queue a job and respond with where to follow it."""
+    job_id = JOBS.submit(job_type, params)
+    return jsonify(job_id=job_id, status_url=url_for('get_job', job_id=job_id)), 202
+
+
+def stream_json_array(items) -> Response:
+    """
+    Respond with a JSON array that is written item by item as the items are produced.
+    The status is sent with the first item, so an error after it ends the array with a final {'error': message} item
+    instead of cutting the array short.
+    """
+    items = iter(items)
+    first_item = next(items, None)  # Fail before the response starts if the items can't be produced at all
+
+    def generate():
+        if first_item is None:
+            yield '[]'
+            return
+        yield '[' + json.dumps(first_item)
+        try:
+            for item in items:
+                yield ',' + json.dumps(item)
+        except Exception as e:
+            yield ',' + json.dumps({'error': str(e)})
+        yield ']'
+
+    return Response(generate(), mimetype='application/json')
+
+
+STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
+
+def stream_records(records, stream_format: str) -> Response:
+    """
+    Respond with the records as they are produced, one JSON object per line (ndjson)
+    or one server-sent event per record, named after the record's type (sse).
+    An error after the response started is sent as a final {'type': 'error', 'error': message} record.
+    """
+    records = iter(records)
+    # The first record is the 'start' record, produced right after the listing. Fail before the response starts if
+    # even the listing fails.
+    first_record = next(records)
+
+    def format_record(record: dict) -> str:
+        if stream_format == 'sse':
+            return f"event: {record['type']}\ndata: {json.dumps(record)}\n\n"
+        return json.dumps(record) + '\n'
+
+    def generate():
+        yield format_record(first_record)
+        try:
+            for record in records:
+                yield format_record(record)
+        except Exception as e:
+            yield format_record({'type': 'error', 'error': str(e)})
+
+    return Response(generate(), mimetype=STREAM_FORMATS[stream_format],
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/api/data', methods=['GET'])
 def get_data():
     # Your main function logic goes here
@@ -27,8 +123,15 @@ def get_songs():
     username = request.args.get("username")
     if not username:
         return jsonify(error="Missing 'username' parameter."), 400
+    stream_format = request.args.get('stream')
+    if stream_format and stream_format not in STREAM_FORMATS:
+        return jsonify(error=f"Invalid 'stream' parameter, use one of: {', '.join(STREAM_FORMATS)}."), 400
 
     try:
+        if is_async_request():
+            return submit_job('songs', {'username': username})
+        if stream_format:
+            return stream_records(iter_logic(username), stream_format)
         data = logic(username)
         return jsonify(data)
     except Exception as e:
@@ -37,8 +140,7 @@ def get_songs():
 
 @app.route('/api/database_songs', methods=['GET'])
 def get_database_songs():
-    db = get_human_readable_db()
-    return jsonify(db)
+    return stream_json_array(iter_human_readable_db())
 
 
 @app.route('/api/upload_song', methods=['POST'])
@@ -81,7 +183,17 @@ def get_location_songs():
     start_day, start_month, start_year = data.get('date').split('-')
     if not all([start_day, start_month, start_year]):
         return jsonify(error="Missing a date parameter ('start_day'/'start_month'/'start_year')."), 400
+    stream_format = request.args.get('stream')
+    if stream_format and stream_format not in STREAM_FORMATS:
+        return jsonify(error=f"Invalid 'stream' parameter, use one of: {', '.join(STREAM_FORMATS)}."), 400
     try:
+        if is_async_request():
+            return submit_job('location_songs', {'location': location, 'day': int(start_day),
+                                                 'month': int(start_month), 'year': int(start_year)})
+        if stream_format:
+            return stream_records(iter_location_logic(location=location, day=int(start_day),
+                                                      month=int(start_month), year=int(start_year)),
+                                  stream_format)
         recognized_songs_links = location_logic(location=location,
                                                 day=int(start_day), month=int(start_month), year=int(start_year))
         return jsonify(recognized_songs_links)
@@ -89,19 +201,41 @@ def get_location_songs():
         return jsonify(error=str(e)), 500
 
 
+@app.route('/api/location_posts_songs', methods=['GET'])
+def get_location_posts_songs():
+    location_id = request.args.get('location_id')
+    if not location_id or not location_id.isdigit():
+        return jsonify(error="Missing or invalid 'location_id' parameter."), 400
+    try:
+        if is_async_request():
+            return submit_job('location_posts_songs', {'location_id': int(location_id)})
+        return jsonify(location_posts_logic(int(location_id)))
+    except Exception as e:
+        return jsonify(error=str(e)), 500
+
+
 @app.route('/api/locations', methods=['POST'])
 def get_locations():
     data = request.get_json()
     dashboard = data.get('dashboard')
     try:
-        storystory_session = StoryStorySession()
-        time.sleep(0.5)
-        locations = storystory_session.get_instagram_followed_locations_and_dates(dashboard_name=dashboard)
+        if is_async_request():
+            return submit_job('locations', {'dashboard': dashboard})
+        with STORY_STORY_SESSIONS.session() as storystory_session:
+            locations = storystory_session.get_instagram_followed_locations_and_dates(dashboard_name=dashboard)
     except Exception as e:
         return jsonify(error=str(e)), 500
     return jsonify(locations)
 
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        return jsonify(JOBS.get(job_id))
+    except JobError as e:
+        return jsonify(error=str(e)), 404
+
+
 @app.route('/api/send_location_email', methods=['POST'])
 def send_email():
     data = request.get_json()
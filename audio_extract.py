@@ -0,0 +1,77 @@
+import io
+import os
+import wave
+import datetime
+import subprocess
+
+import numpy as np
+from imageio_ffmpeg import get_ffmpeg_exe
+from loguru import logger
+from .fingerprint import SAMPLE_RATE, CLIP_SECONDS
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'music_recognition', f"music_recognition_{date_now}.log"), rotation="1 day")
+
+SAMPLE_WIDTH = 2  # bytes, signed 16 bit little-endian PCM
+EXTRACTION_TIMEOUT = 60  # seconds
+
+
+class AudioExtractionError(OSError):
+    """Raised when ffmpeg fails to extract audio from a media file."""
+    def __init__(self, source, error):
+        self.message = f"Can't extract audio from {source}: {error}"
+        logger.error(self.message)
+
+    def __str__(self):
+        return self.message
+
+
+def extract_clip(source: str or bytes, seconds: float or None = CLIP_SECONDS) -> bytes:
+    """
+    Decode the start of a media file's audio to mono 16 bit PCM at SAMPLE_RATE, in memory.
+    Only the first seconds are demuxed and decoded, the video stream is never decoded.
+
+    :param source: Path to a media file, or the (possibly partial) media file content
+    :param seconds: Length of the clip from the start, None for the whole audio
+    :return: Raw PCM samples (empty if the media has no audio)
+    :exception AudioExtractionError: ffmpeg couldn't read the media
+    """
+    from_memory = isinstance(source, (bytes, bytearray))
+    command = [get_ffmpeg_exe(), '-v', 'error']
+    command += ['-i', 'pipe:0'] if from_memory else ['-nostdin', '-i', source]
+    if seconds:
+        command += ['-t', str(seconds)]
+    command += ['-vn', '-sn', '-dn', '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', 'pipe:1']
+
+    source_name = f"{len(source)} bytes of media" if from_memory else source
+    try:
+        process = subprocess.run(command, input=source if from_memory else None,
+                                 capture_output=True, timeout=EXTRACTION_TIMEOUT)
+    except (OSError, subprocess.SubprocessError) as e:
+        raise AudioExtractionError(source_name, e)
+
+    if process.returncode and not process.stdout:
+        stderr = process.stderr.decode(errors='replace').strip()
+        if 'does not contain any stream' in stderr or 'matches no streams' in stderr:
+            return b''
+        raise AudioExtractionError(source_name, stderr)
+
+    logger.debug(f"Extracted {len(process.stdout) / SAMPLE_WIDTH / SAMPLE_RATE:.1f}s of audio from {source_name}")
+    return process.stdout
+
+
+def pcm_to_samples(pcm: bytes) -> np.ndarray:
+    """PCM clip as float samples in [-1, 1)"""
+    return np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768
+
+
+def pcm_to_wav(pcm: bytes) -> bytes:
+    """Wrap a PCM clip in a WAV container."""
+    wav_buffer = io.BytesIO()
+    with wave.open(wav_buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(SAMPLE_WIDTH)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(pcm)
+    return wav_buffer.getvalue()
@@ -0,0 +1,175 @@
+import os
+import time
+import datetime
+import threading
+from typing import Callable, Iterable, Iterator
+
+from loguru import logger
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+CATALOG_TTL = float(os.environ.get('BUCKET_CATALOG_TTL', 300))  # seconds
+
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'music_recognition', f"music_recognition_{date_now}.log"), rotation="1 day")
+
+
+def track_record(bucket_file: dict) -> dict:
+    """Flatten an ACRCloud bucket file into {'id': id, 'title': title, 'artist': artist, 'album': album}"""
+    user_defined = bucket_file.get('user_defined') or {}
+    return {
+        'id': int(bucket_file['id']),
+        'title': bucket_file['title'],
+        'artist': user_defined.get('artist'),
+        'album': user_defined.get('album')
+    }
+
+
+class BucketCatalog:
+    """
+    In-process catalog of the tracks in the ACRCloud bucket.
+
+    The catalog is indexed by ID, title and (title, artist). Our own uploads and deletes update the indexes in place,
+    the whole listing is only fetched again when it is older than the TTL (or was invalidated).
+    Uploads and deletes made while a listing is paged are replayed onto the new indexes before they replace the old.
+    """
+
+    def __init__(self, loader: Callable[[], Iterable[dict]], ttl: float = CATALOG_TTL,
+                 on_refresh: Callable[[set], None] = None):
+        """
+        :param loader: Returns (or yields, page by page) the bucket files as the ACRCloud API lists them
+        :param ttl: Seconds until the catalog is considered stale and fully refreshed
+        :param on_refresh: Called with the IDs of the bucket's files after every full refresh
+        """
+        self._loader = loader
+        self._on_refresh = on_refresh
+        self.ttl = ttl
+        self._loaded_at = None
+        self._by_id = {}
+        self._by_title = {}
+        self._by_title_artist = {}
+        self._refresh_journals = []  # The changes made during each running refresh - [[(add/remove, track/ID)]]
+        self._lock = threading.RLock()
+
+    @property
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def invalidate(self) -> None:
+        """Force a full refresh on the next lookup."""
+        with self._lock:
+            self._loaded_at = None
+
+    def refresh(self) -> None:
+        """Rebuild the indexes from a full bucket listing."""
+        for _ in self._iter_refresh():
+            pass
+
+    def _iter_refresh(self) -> Iterator[dict]:
+        """Rebuild the indexes while yielding every track as soon as its listing page arrives."""
+        logger.info("Refreshing bucket catalog...")
+        by_id, by_title, by_title_artist = {}, {}, {}
+        journal = []
+        with self._lock:
+            self._refresh_journals.append(journal)
+        try:
+            for bucket_file in self._loader():
+                track = track_record(bucket_file)
+                self._index(track, by_id, by_title, by_title_artist)
+                yield track
+
+            with self._lock:
+                for change, value in journal:  # The listing may have missed them
+                    if change == 'add':
+                        self._index(value, by_id, by_title, by_title_artist)
+                    else:
+                        self._unindex(value, by_id, by_title, by_title_artist)
+                self._by_id, self._by_title, self._by_title_artist = by_id, by_title, by_title_artist
+                self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._refresh_journals.remove(journal)
+        logger.info(f"Bucket catalog holds {len(by_id)} tracks")
+        if self._on_refresh:
+            self._on_refresh(set(by_id))
+
+    def _ensure_fresh(self) -> None:
+        if self.is_stale:
+            self.refresh()
+
+    def _index(self, track: dict, by_id: dict = None, by_title: dict = None, by_title_artist: dict = None) -> None:
+        by_id = self._by_id if by_id is None else by_id
+        by_title = self._by_title if by_title is None else by_title
+        by_title_artist = self._by_title_artist if by_title_artist is None else by_title_artist
+        by_id[track['id']] = track
+        by_title[track['title']] = track
+        by_title_artist[(track['title'], track['artist'])] = track
+
+    def _unindex(self, file_id: int, by_id: dict = None, by_title: dict = None, by_title_artist: dict = None) -> None:
+        by_id = self._by_id if by_id is None else by_id
+        by_title = self._by_title if by_title is None else by_title
+        by_title_artist = self._by_title_artist if by_title_artist is None else by_title_artist
+        track = by_id.pop(file_id, None)
+        if not track:
+            return
+        if by_title.get(track['title']) is track:
+            del by_title[track['title']]
+            # Another file may share the title, keep the title index pointing at it
+            for other_track in by_id.values():
+                if other_track['title'] == track['title']:
+                    by_title[track['title']] = other_track
+                    break
+        by_title_artist.pop((track['title'], track['artist']), None)
+
+    def add(self, bucket_file: dict) -> None:
+        """Index a file we uploaded to the bucket."""
+        track = track_record(bucket_file)
+        with self._lock:
+            for journal in self._refresh_journals:
+                journal.append(('add', track))
+            if self._loaded_at is not None:
+                self._index(track)
+
+    def remove(self, file_id: int) -> None:
+        """Drop a file we deleted from the bucket."""
+        with self._lock:
+            for journal in self._refresh_journals:
+                journal.append(('remove', int(file_id)))
+            self._unindex(int(file_id))
+
+    def get(self, file_id: int) -> dict or None:
+        with self._lock:
+            self._ensure_fresh()
+            return self._by_id.get(int(file_id))
+
+    def get_by_title(self, title: str) -> dict or None:
+        with self._lock:
+            self._ensure_fresh()
+            return self._by_title.get(title)
+
+    def contains(self, title: str, artist: str) -> bool:
+        with self._lock:
+            self._ensure_fresh()
+            return (title, artist) in self._by_title_artist
+
+    def ids(self) -> set:
+        with self._lock:
+            self._ensure_fresh()
+            return set(self._by_id)
+
+    def tracks(self) -> list:
+        """All tracks as [{'id': id, 'title': title, 'artist': artist, 'album': album}, ...]"""
+        with self._lock:
+            self._ensure_fresh()
+            return list(self._by_id.values())
+
+    def iter_tracks(self) -> Iterator[dict]:
+        """
+        Yield all tracks. A fresh catalog is served from memory, a stale one streams the tracks
+        page by page while it refreshes instead of waiting for the whole listing.
+        """
+        with self._lock:
+            tracks = None if self.is_stale else list(self._by_id.values())
+        if tracks is None:
+            yield from self._iter_refresh()
+        else:
+            yield from tracks
@@ -0,0 +1,149 @@
+import io
+import os
+import struct
+import datetime
+from typing import NamedTuple
+from xml.etree import ElementTree
+
+from loguru import logger
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', "instagram_bot", f"instagram_bot_{date_now}.log"), rotation="1 day")
+
+
+class DashManifestError(ValueError):
+    """Raised when a DASH manifest or segment index can not be parsed."""
+    def __init__(self, error):
+        self.message = f"Can't parse DASH manifest: {error}"
+        logger.debug(self.message)
+
+    def __str__(self):
+        return self.message
+
+
+class AudioRepresentation(NamedTuple):
+    url: str
+    bandwidth: int  # bits per second
+    codecs: str or None = None
+    init_range: tuple or None = None  # (first byte, last byte) of the initialization segment
+    index_range: tuple or None = None  # (first byte, last byte) of the segment index (sidx box)
+
+
+class Segment(NamedTuple):
+    start: int  # first byte
+    end: int  # last byte
+    duration: float  # seconds
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _byte_range(value: str or None) -> tuple or None:
+    if not value:
+        return None
+    start, end = value.split('-')
+    return int(start), int(end)
+
+
+def _is_audio(element, adaptation_set) -> bool:
+    mime_type = element.get('mimeType') or adaptation_set.get('mimeType') or ''
+    content_type = adaptation_set.get('contentType') or ''
+    return mime_type.startswith('audio/') or content_type == 'audio'
+
+
+def parse_audio_representation(manifest: str or bytes) -> AudioRepresentation or None:
+    """
+    Find the lowest bandwidth audio representation of a DASH manifest.
+    The manifest is parsed as a stream of elements, finished elements are cleared instead of building the whole tree,
+    and only the audio representations are kept.
+
+    :param manifest: The MPD XML
+    :return: The audio representation, None if the manifest has no audio
+    :exception DashManifestError: The manifest isn't valid XML
+    """
+    if isinstance(manifest, str):
+        manifest = manifest.encode()
+    audio_representations = []
+    adaptation_set = None
+    representation = None
+    try:
+        for event, element in ElementTree.iterparse(io.BytesIO(manifest), events=('start', 'end')):
+            name = _local_name(element.tag)
+            if event == 'start':
+                if name == 'AdaptationSet':
+                    adaptation_set = element
+                elif name == 'Representation' and adaptation_set is not None and _is_audio(element, adaptation_set):
+                    representation = {'bandwidth': int(element.get('bandwidth', 0)), 'codecs': element.get('codecs')}
+                continue
+
+            if representation is not None:
+                if name == 'BaseURL':
+                    representation['url'] = (element.text or '').strip()
+                elif name == 'Initialization':
+                    representation['init_range'] = _byte_range(element.get('range'))
+                elif name == 'SegmentBase':
+                    representation['index_range'] = _byte_range(element.get('indexRange'))
+                elif name == 'Representation':
+                    if representation.get('url'):
+                        audio_representations.append(AudioRepresentation(**representation))
+                    representation = None
+            if name == 'AdaptationSet':
+                adaptation_set = None
+            if name in ('Representation', 'AdaptationSet'):
+                element.clear()
+    except (ElementTree.ParseError, ValueError) as e:
+        raise DashManifestError(e)
+
+    if not audio_representations:
+        return None
+    return min(audio_representations, key=lambda audio_representation: audio_representation.bandwidth)
+
+
+def parse_sidx(sidx: bytes, sidx_end: int) -> list:
+    """
+    List the media segments a segment index (sidx box) points to.
+
+    :param sidx: The sidx box, as found at the representation's index range
+    :param sidx_end: Offset in the media file of the first byte after the sidx box (the index range's end + 1)
+    :return: [Segment, ...] in playback order
+    :exception DashManifestError: The data isn't a sidx box
+    """
+    try:
+        size, box_type, version = struct.unpack_from('>I4sB', sidx)
+        if box_type != b'sidx':
+            raise ValueError(f"Expected a sidx box, found {box_type}")
+        position = 12 + 4  # Box header, version and flags, then the reference ID
+        timescale = struct.unpack_from('>I', sidx, position)[0]
+        position += 4
+        if version == 0:
+            first_offset = struct.unpack_from('>I', sidx, position + 4)[0]
+            position += 8
+        else:
+            first_offset = struct.unpack_from('>Q', sidx, position + 8)[0]
+            position += 16
+        reference_count = struct.unpack_from('>H', sidx, position + 2)[0]
+        position += 4
+
+        segments = []
+        offset = sidx_end + first_offset
+        for _ in range(reference_count):
+            reference, duration, _ = struct.unpack_from('>III', sidx, position)
+            position += 12
+            referenced_size = reference & 0x7FFFFFFF
+            segments.append(Segment(start=offset, end=offset + referenced_size - 1, duration=duration / timescale))
+            offset += referenced_size
+    except (struct.error, ValueError, ZeroDivisionError) as e:
+        raise DashManifestError(e)
+    return segments
+
+
+def bytes_for_duration(segments: list, seconds: float) -> int:
+    """The last byte to download so the media segments cover at least the first seconds (all of them if shorter)."""
+    covered = 0
+    for segment in segments:
+        covered += segment.duration
+        if covered >= seconds:
+            return segment.end
+    return segments[-1].end
@@ -0,0 +1,214 @@
+import os
+import time
+import datetime
+import threading
+
+from loguru import logger
+from .sqlite_store import SQLiteStore
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(MAIN_DIR, 'cache')
+DRIVE_INDEX_PATH = os.environ.get('DRIVE_INDEX_PATH', os.path.join(CACHE_DIR, 'drive_index.sqlite3'))
+DRIVE_INDEX_SYNC_INTERVAL = float(os.environ.get('DRIVE_INDEX_SYNC_INTERVAL', 60))  # seconds between changes syncs
+CHANGES_PAGE_SIZE = 1000  # The maximum page size Drive allows
+CHANGE_FIELDS = ("nextPageToken, newStartPageToken, "
+                 "changes(fileId, removed, file(id, name, mimeType, md5Checksum, parents, trashed))")
+FILE_FIELDS = 'files(id, name, mimeType, md5Checksum)'
+
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'drive_logic', f"drive_logic_{date_now}.log"), rotation="1 day")
+
+
+def get_story_date(file_name: str) -> datetime.date or None:
+    """Get the date of a story from its file name ('2023-08-24T21:13:05...'), None if the name has no date."""
+    try:
+        return datetime.date.fromisoformat(file_name.split('T')[0])
+    except ValueError:
+        return None
+
+
+class DriveChangesFeed:
+    """The Drive API changes feed: a start page token, then the pages of changes made since a token."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def get_start_page_token(self) -> str:
+        return self.service.changes().getStartPageToken().execute()['startPageToken']
+
+    def list_changes(self, page_token: str) -> dict:
+        """{'changes': [...], 'nextPageToken': ...} or, on the last page, {'changes': [...], 'newStartPageToken': ...}"""
+        return self.service.changes().list(pageToken=page_token, spaces='drive', pageSize=CHANGES_PAGE_SIZE,
+                                           fields=CHANGE_FIELDS).execute()
+
+
+class InMemoryChangesFeed:
+    """A local stand-in for the Drive changes feed, for tests: changes are recorded with change and remove."""
+
+    def __init__(self, page_size: int = CHANGES_PAGE_SIZE):
+        self.page_size = page_size
+        self.changes = []
+        self.list_calls = 0
+
+    def change(self, file: dict) -> None:
+        """Record a file that was added, renamed, moved or trashed - {id, name, mimeType, parents, ...}"""
+        self.changes.append({'fileId': file['id'], 'removed': False, 'file': file})
+
+    def remove(self, file_id: str) -> None:
+        self.changes.append({'fileId': file_id, 'removed': True})
+
+    def get_start_page_token(self) -> str:
+        return str(len(self.changes))
+
+    def list_changes(self, page_token: str) -> dict:
+        self.list_calls += 1
+        start = int(page_token)
+        end = min(start + self.page_size, len(self.changes))
+        page = {'changes': self.changes[start:end]}
+        if end < len(self.changes):
+            page['nextPageToken'] = str(end)
+        else:
+            page['newStartPageToken'] = str(end)
+        return page
+
+
+class DriveIndex(SQLiteStore):
+    """
+    Local index of the location folders' files and their story dates.
+
+    A folder is listed in full once, when it is first used. From then on the index follows the Drive changes feed,
+    so date lookups and per-day file listings never list the folder again.
+    """
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    id TEXT PRIMARY KEY,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    folder_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mime_type TEXT,
+    md5 TEXT,
+    story_date TEXT
+);
+CREATE INDEX IF NOT EXISTS files_folder_date ON files (folder_id, story_date);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+    def __init__(self, path: str = DRIVE_INDEX_PATH, sync_interval: float = DRIVE_INDEX_SYNC_INTERVAL):
+        super().__init__(path)
+        self.sync_interval = sync_interval
+        self._sync_lock = threading.Lock()
+
+    @staticmethod
+    def _get_meta(connection, key: str) -> str or None:
+        row = connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _set_meta(connection, key: str, value) -> None:
+        connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    @staticmethod
+    def _file_row(folder_id: str, file: dict) -> tuple:
+        story_date = get_story_date(file['name'])
+        return (file['id'], folder_id, file['name'], file.get('mimeType'), file.get('md5Checksum'),
+                story_date.isoformat() if story_date else None)
+
+    def sync(self, feed) -> int:
+        """
+        Apply the changes made since the last sync. The first sync only records where the feed starts.
+        :return: Number of changes applied
+        """
+        with self._sync_lock:
+            with self._connect() as connection:
+                page_token = self._get_meta(connection, 'page_token')
+            if page_token is None:
+                with self._connect() as connection:
+                    self._set_meta(connection, 'page_token', feed.get_start_page_token())
+                    self._set_meta(connection, 'synced_at', time.time())
+                logger.info("Drive index follows the changes feed from now on")
+                return 0
+
+            changes_count = 0
+            while True:
+                page = feed.list_changes(page_token)
+                page_token = page.get('nextPageToken') or page['newStartPageToken']
+                with self._connect() as connection:  # The changes and the token after them are saved together
+                    changes_count += self._apply_changes(connection, page.get('changes', []))
+                    self._set_meta(connection, 'page_token', page_token)
+                    if 'newStartPageToken' in page:
+                        self._set_meta(connection, 'synced_at', time.time())
+                if 'newStartPageToken' in page:
+                    break
+        if changes_count:
+            logger.info(f"Applied {changes_count} Drive changes to the index")
+        return changes_count
+
+    def sync_if_due(self, feed) -> None:
+        """Sync when the last sync is older than the sync interval."""
+        with self._connect() as connection:
+            synced_at = self._get_meta(connection, 'synced_at')
+        if synced_at is None or time.time() - float(synced_at) >= self.sync_interval:
+            self.sync(feed)
+
+    def _apply_changes(self, connection, changes: list) -> int:
+        indexed_folders = {row[0] for row in connection.execute("SELECT id FROM folders")}
+        for change in changes:
+            file = change.get('file') or {}
+            if change.get('removed') or file.get('trashed'):
+                connection.execute("DELETE FROM files WHERE id = ?", (change['fileId'],))
+                if change['fileId'] in indexed_folders:  # A location folder is gone, forget its files
+                    connection.execute("DELETE FROM folders WHERE id = ?", (change['fileId'],))
+                    connection.execute("DELETE FROM files WHERE folder_id = ?", (change['fileId'],))
+                continue
+            folder_ids = [parent for parent in file.get('parents', []) if parent in indexed_folders]
+            if folder_ids:
+                connection.execute("INSERT OR REPLACE INTO files (id, folder_id, name, mime_type, md5, story_date) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)", self._file_row(folder_ids[0], file))
+            else:  # Not (or no longer) in a folder we index
+                connection.execute("DELETE FROM files WHERE id = ?", (change['fileId'],))
+        return len(changes)
+
+    def is_indexed(self, folder_id: str) -> bool:
+        with self._connect() as connection:
+            return connection.execute("SELECT 1 FROM folders WHERE id = ?", (folder_id,)).fetchone() is not None
+
+    def index_folder(self, folder_id: str, files: list) -> None:
+        """
+        Store a full listing of a folder. Sync before listing it, so the changes made meanwhile are applied later.
+        :param files: The folder's files - [{id, name, mimeType, md5Checksum}, ...]
+        """
+        with self._connect() as connection:
+            connection.execute("DELETE FROM files WHERE folder_id = ?", (folder_id,))
+            connection.executemany("INSERT OR REPLACE INTO files (id, folder_id, name, mime_type, md5, story_date) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)", [self._file_row(folder_id, file) for file in files])
+            connection.execute("INSERT OR REPLACE INTO folders (id, indexed_at) VALUES (?, ?)",
+                               (folder_id, time.time()))
+        logger.info(f"Indexed {len(files)} files of Drive folder {folder_id}")
+
+    def get_dates(self, folder_id: str) -> list:
+        """The dates the folder has stories at, sorted - ['2023-08-24', ...]"""
+        with self._connect() as connection:
+            rows = connection.execute("SELECT DISTINCT story_date FROM files WHERE folder_id = ? "
+                                      "AND story_date IS NOT NULL ORDER BY story_date", (folder_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_files_by_date(self, folder_id: str, start_date: datetime.date, end_date: datetime.date) -> dict:
+        """
+        The folder's story videos of every day in a range of dates.
+        :return: files of each day, ordered by name (story time) - {date: [{id: ..., name: ..., md5: ...}, ...], ...}
+        """
+        files_by_date = {start_date + datetime.timedelta(days=day): []
+                         for day in range((end_date - start_date).days + 1)}
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id, name, md5, story_date FROM files WHERE folder_id = ? "
+                                      "AND story_date BETWEEN ? AND ? AND mime_type LIKE 'video/%' ORDER BY name",
+                                      (folder_id, start_date.isoformat(), end_date.isoformat())).fetchall()
+        for file_id, name, md5, story_date in rows:
+            files_by_date[datetime.date.fromisoformat(story_date)].append({'id': file_id, 'name': name, 'md5': md5})
+        return files_by_date
@@ -1,16 +1,24 @@
 from loguru import logger
 import os.path
 import datetime
-import io
-import shutil
-
+import hashlib
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
-from google.auth.exceptions import RefreshError
-from googleapiclient.http import MediaIoBaseDownload
+from google.auth.exceptions import RefreshError, TransportError
+from .drive_index import DriveIndex, DriveChangesFeed, FILE_FIELDS, get_story_date
+from .workspace import workspace, remove_files
 
 DOWNLOADED_STORIES_DIR = os.path.join(os.path.abspath(os.curdir), 'DownloadedStories')
 os.makedirs(DOWNLOADED_STORIES_DIR, exist_ok=True)
@@ -22,7 +30,23 @@ SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly',
 API_NAME = 'drive'
 API_VERSION = 'v3'
 
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DRIVE_DOWNLOAD_CHUNK_SIZE', 8 * 1024 * 1024))  # bytes
+DOWNLOAD_RETRIES = int(os.environ.get('DRIVE_DOWNLOAD_RETRIES', 3))  # Resumed attempts after a failed download
+DRIVE_MAX_CONCURRENCY = int(os.environ.get('DRIVE_MAX_CONCURRENCY', 8))  # Parallel Drive transfers
+RATE_LIMIT_RETRIES = int(os.environ.get('DRIVE_RATE_LIMIT_RETRIES', 5))
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+LIST_PAGE_SIZE = 1000  # The maximum page size Drive allows
+
 MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+TOKEN_PATH = os.path.join(MAIN_DIR, 'token.json')
+CREDENTIALS_PATH = os.path.join(MAIN_DIR, 'credentials.json')
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)  # Refresh the token this long before it expires
+CACHE_DIR = os.path.join(MAIN_DIR, 'cache')
+LOCATION_FOLDERS_PATH = os.environ.get('LOCATION_FOLDERS_PATH', os.path.join(CACHE_DIR, 'location_folders.json'))
+LOCATION_FOLDERS_TTL = float(os.environ.get('LOCATION_FOLDERS_TTL', 7 * 24 * 60 * 60))  # seconds
+LOCATION_DATES_PATH = os.environ.get('LOCATION_DATES_PATH', os.path.join(CACHE_DIR, 'location_dates.json'))
+LOCATION_DATES_TTL = float(os.environ.get('LOCATION_DATES_TTL', 15 * 60))  # seconds until refreshed in the background
+LOCATION_DATES_REFRESH_WORKERS = 2
 date_now = datetime.date.today()
 logger.add(os.path.join(MAIN_DIR, 'logs', 'drive_logic', f"drive_logic_{date_now}.log"), rotation="1 day")
 
@@ -61,42 +85,284 @@ class DriveLocationNotFound(DriveError):
         return self.message
 
 
+def file_md5(file_path: str) -> str:
+    """md5 hex digest of a local file, as Drive's md5Checksum."""
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def is_rate_limit_error(error: HttpError) -> bool:
+    """Whether Drive refused the request because of its rate limits (429, or 403 with a rate limit reason)."""
+    if isinstance(error, DriveError):  # Raised by us, not by Drive, so it has no response
+        return False
+    if error.resp.status == 429:
+        return True
+    if error.resp.status != 403:
+        return False
+    try:
+        reasons = [details.get('reason') for details in json.loads(error.content)['error']['errors']]
+    except (ValueError, KeyError, TypeError):
+        return False
+    return any(reason in RATE_LIMIT_REASONS for reason in reasons)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits how many Drive calls run at once.
+    The limit is halved whenever Drive rate-limits a call and grows back by one after a limit's worth of successes.
+    """
+
+    def __init__(self, max_limit: int = DRIVE_MAX_CONCURRENCY):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self._active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def on_success(self) -> None:
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def on_rate_limited(self) -> None:
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+            logger.warning(f"Drive rate limit reached, lowering concurrency to {self.limit}")
+
+
+# Shared by every Drive instance in the process, since the Drive quota is shared as well
+DRIVE_LIMITER = AdaptiveConcurrencyLimiter()
+
+
+class JSONFileCache:
+    """Entries kept in memory and persisted to a JSON file, shared between the threads of the process."""
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = None  # {key: {..., 'cached_at': timestamp}}
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path) as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self._entries, cache_file)
+        os.replace(temp_path, self.path)
+
+    def _is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry['cached_at'] <= self.ttl
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            if self._load().pop(key, None):
+                self._save()
+
+
+class LocationFolderCache(JSONFileCache):
+    """Location name -> Drive folder ID mapping, persisted to a JSON file with a TTL per entry."""
+
+    def __init__(self, path: str = LOCATION_FOLDERS_PATH, ttl: float = LOCATION_FOLDERS_TTL):
+        super().__init__(path, ttl)
+
+    def get(self, location: str) -> str or None:
+        """The cached folder ID of the location, None if it isn't cached or expired."""
+        with self._lock:
+            folder = self._load().get(location)
+        if not folder or not self._is_fresh(folder):
+            return None
+        return folder['id']
+
+    def set(self, location: str, folder_id: str) -> None:
+        with self._lock:
+            self._load()[location] = {'id': folder_id, 'cached_at': time.time()}
+            self._save()
+
+
+class LocationDatesCache(JSONFileCache):
+    """
+    Location name -> dates the location has stories at, persisted to a JSON file.
+    Dates older than the TTL are still served, the caller refreshes them in the background.
+    """
+
+    def __init__(self, path: str = LOCATION_DATES_PATH, ttl: float = LOCATION_DATES_TTL):
+        super().__init__(path, ttl)
+        self._refreshing = set()
+
+    def get(self, location: str) -> tuple or None:
+        """(the cached dates of the location, whether they are fresh), None if they aren't cached"""
+        with self._lock:
+            entry = self._load().get(location)
+        if not entry:
+            return None
+        return entry['dates'], self._is_fresh(entry)
+
+    def set(self, location: str, dates: list) -> None:
+        with self._lock:
+            self._load()[location] = {'dates': dates, 'cached_at': time.time()}
+            self._save()
+
+    def start_refresh(self, location: str) -> bool:
+        """Claim the refresh of a location, False if it is already being refreshed."""
+        with self._lock:
+            if location in self._refreshing:
+                return False
+            self._refreshing.add(location)
+            return True
+
+    def end_refresh(self, location: str) -> None:
+        with self._lock:
+            self._refreshing.discard(location)
+
+
+LOCATION_FOLDERS = LocationFolderCache()
+LOCATION_DATES = LocationDatesCache()
+DRIVE_INDEX = DriveIndex()
+_location_dates_refresher = ThreadPoolExecutor(max_workers=LOCATION_DATES_REFRESH_WORKERS,
+                                               thread_name_prefix='location-dates')
+
+
 def clear_downloaded_stories_dir() -> None:
-    """Removes all files in the downloaded stories dir."""
-    for file in os.listdir(DOWNLOADED_STORIES_DIR):
-        os.remove(os.path.join(DOWNLOADED_STORIES_DIR, file))
+    """Removes all files in the downloaded stories dir. Workspaces (directories) belong to running downloads."""
+    remove_files(DOWNLOADED_STORIES_DIR)
+
+
+def download_workspace():
+    """A directory of its own for one run's downloads, see workspace."""
+    return workspace(DOWNLOADED_STORIES_DIR)
+
+
+_credentials = None
+_credentials_lock = threading.RLock()
+_discovery_document = None
+_thread_local = threading.local()
+
+
+def _load_credentials() -> Credentials:
+    """Load the credentials from token.json, refreshing them or logging in to Google when needed."""
+    creds = None
+    # The file token.json stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first time.
+    if os.path.exists(TOKEN_PATH):
+        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+    # If there are no (valid) credentials available, let the user log in.
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+            except RefreshError as _:
+                logger.info('Token expired. Removing and logging in to Google to create a new token...')
+                os.remove(TOKEN_PATH)
+                creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
+            creds = flow.run_local_server(port=0)
+        # Save the credentials for the next run
+        with open(TOKEN_PATH, 'w') as token:
+            token.write(creds.to_json())
+    return creds
+
+
+def _schedule_token_refresh() -> None:
+    """Refresh the access token in the background shortly before it expires."""
+    if not _credentials.expiry:
+        return
+    delay = (_credentials.expiry - datetime.datetime.utcnow() - TOKEN_REFRESH_MARGIN).total_seconds()
+    timer = threading.Timer(max(delay, 30), _refresh_token)
+    timer.daemon = True
+    timer.start()
+
+
+def _refresh_token() -> None:
+    with _credentials_lock:
+        try:
+            _credentials.refresh(Request())
+            with open(TOKEN_PATH, 'w') as token:
+                token.write(_credentials.to_json())
+            logger.debug(f"Refreshed Google token, it expires at {_credentials.expiry}")
+        except (RefreshError, TransportError) as e:
+            logger.error(f"Couldn't refresh Google token in the background: {e}")
+    _schedule_token_refresh()
+
+
+def get_credentials() -> Credentials:
+    """Google credentials shared by the whole process (loaded once and kept fresh in the background)."""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials = _load_credentials()
+            _schedule_token_refresh()
+        return _credentials
+
+
+def get_service():
+    """
+    Drive service of the calling thread.
+    The discovery document is parsed once per process, every thread gets its own client
+    on its own HTTP transport since httplib2 connections can't be shared between threads.
+    """
+    global _discovery_document
+    service = getattr(_thread_local, 'service', None)
+    if service is None:
+        if _discovery_document is None:
+            _discovery_document = get_static_doc(API_NAME, API_VERSION)
+        http = AuthorizedHttp(get_credentials(), http=httplib2.Http())
+        service = build_from_document(_discovery_document, http=http)
+        _thread_local.service = service
+    return service
 
 
 class Drive:
     def __init__(self):
-        self.creds = None
-        # The file token.json stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first time.
-        token_path = os.path.join(MAIN_DIR, 'token.json')
-        credentials_path = os.path.join(MAIN_DIR, 'credentials.json')
-        if os.path.exists(token_path):
-            self.creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-        # If there are no (valid) credentials available, let the user log in.
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                try:
-                    self.creds.refresh(Request())
-                except RefreshError as _:
-                    logger.info('Token expired. Removing and logging in to Google to create a new token...')
-                    os.remove(os.path.join(MAIN_DIR, 'token.json'))
-                    self.creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    credentials_path, SCOPES)
-                self.creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open(token_path, 'w') as token:
-                token.write(self.creds.to_json())
-
-    def get_location_directory(self, location: str) -> str:
+        self.creds = get_credentials()
+
+    @property
+    def service(self):
+        return get_service()
+
+    def get_location_directory(self, location: str, refresh: bool = False) -> str:
+        """
+        Get the ID of the Drive folder of a location. Folder IDs are cached, see LocationFolderCache.
+        :param location: Location name
+        :param refresh: Search Drive for the folder even if its ID is cached
+        :exception: DriveLocationNotFound: No folder of the location
+        :exception: DriveMultipleFolders: The location name matches more than one folder
+        """
+        if not refresh:
+            folder_id = LOCATION_FOLDERS.get(location)
+            if folder_id:
+                return folder_id
+
         query = f"fullText contains \"'{location}_'\" and mimeType = 'application/vnd.google-apps.folder'"
 
-        service = build(API_NAME, API_VERSION, credentials=self.creds)
+        service = self.service
         results = service.files().list(q=query).execute()
         folders = results.get('files', [])
 
@@ -110,47 +376,89 @@ class Drive:
                 logger.debug(f'Found folder with the name: {folder["name"]} and the ID: {folder["id"]}')
             if len(location_directory) > 1:
                 raise DriveMultipleFolders(folders, location)
+            LOCATION_FOLDERS.set(location, location_directory[0])
             return location_directory[0]
 
-    def get_files_at_date_in_folder(self,
-                                    folder_id: str,
-                                    year: int = date_now.year,
-                                    month: int = date_now.month,
-                                    day: int = date_now.day):
+    def _in_location_folder(self, location: str, action):
         """
-        Get all drive files in consecutive range of dates.
-        :return: list of files as dictionaries - [{id: ..., name: ...}, {id: ..., name: ...}, ... ]
-        :exception: HttpError: Couldn't get files from Drive
+        Run an action on the location's folder ID.
+        If Drive can't find the (cached) folder, the folder is searched again and the action retried.
         """
-
-        date = datetime.date(year=year, month=month, day=day)
-        query = f"'{folder_id}' in parents and mimeType contains 'video/' and fullText contains '{date}'"
         try:
-            service = build(API_NAME, API_VERSION, credentials=self.creds)
+            return action(self.get_location_directory(location))
+        except DriveError:  # No (single) folder of the location, searching again won't help
+            raise
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            logger.info(f"Folder of location {location} was not found, searching for it again")
+            LOCATION_FOLDERS.invalidate(location)
+            return action(self.get_location_directory(location, refresh=True))
 
-            page_token = None
-            files = []
+    def _list_files(self, query: str, fields: str = 'files(id, name)') -> list:
+        """
+        Get every file matching the query, following all result pages.
+        :exception: HttpError: Couldn't get files from Drive
+        """
+        service = self.service
+        page_token = None
+        files = []
+        try:
             while True:
-                # Call the Drive v3 API
-                results = service.files().list(q=query, fields="nextPageToken, files(id, name)",
-                                               pageToken=page_token).execute()
-                items = results.get('files', [])
-
-                if not items:
-                    logger.info('No files found.')
-                    return []
-                files.extend([{"id": item["id"], "name": item["name"]} for item in items])
+                results = service.files().list(q=query, spaces='drive', pageSize=LIST_PAGE_SIZE,
+                                               fields=f"nextPageToken, {fields}", pageToken=page_token).execute()
+                files.extend(results.get('files', []))
                 page_token = results.get('nextPageToken', None)
                 if page_token is None:
                     break
 
         except HttpError as error:
             logger.error(f"An error occurred: {error}")
-            raise HttpError(resp=error.resp, content=error.content, uri=error.uri)
+            raise
 
-        logger.info(f'Files in Drive for day {date}: {files}')
         return files
 
+    @property
+    def changes_feed(self) -> DriveChangesFeed:
+        return DriveChangesFeed(self.service)
+
+    def _indexed_folder(self, folder_id: str) -> str:
+        """
+        Bring DRIVE_INDEX up to date for a folder: apply the Drive changes since the last sync (at most every
+        DRIVE_INDEX_SYNC_INTERVAL), and list the folder once if it was never indexed.
+        :return: The folder ID
+        :exception: HttpError: Couldn't get the changes or the files from Drive
+        """
+        DRIVE_INDEX.sync_if_due(self.changes_feed)  # Knows where the feed stands before the folder is listed
+        if not DRIVE_INDEX.is_indexed(folder_id):
+            logger.info(f"Indexing Drive folder {folder_id}")
+            DRIVE_INDEX.index_folder(folder_id, self._list_files(f"'{folder_id}' in parents", fields=FILE_FIELDS))
+        return folder_id
+
+    def get_files_by_date(self, folder_id: str, start_date: datetime.date, end_date: datetime.date) -> dict:
+        """
+        Get the story videos of every day in a range of dates from DRIVE_INDEX.
+        :return: files of each day, ordered by name (story time) - {date: [{id: ..., name: ..., md5: ...}, ...], ...}
+        :exception: HttpError: Couldn't get files from Drive
+        """
+        files_by_date = DRIVE_INDEX.get_files_by_date(self._indexed_folder(folder_id), start_date, end_date)
+        for date, files in files_by_date.items():
+            logger.info(f'Files in Drive for day {date}: {files}')
+        return files_by_date
+
+    def get_files_at_date_in_folder(self,
+                                    folder_id: str,
+                                    year: int = date_now.year,
+                                    month: int = date_now.month,
+                                    day: int = date_now.day):
+        """
+        Get all drive files of a single day.
+        :return: list of files as dictionaries - [{id: ..., name: ...}, {id: ..., name: ...}, ... ]
+        :exception: HttpError: Couldn't get files from Drive
+        """
+        date = datetime.date(year=year, month=month, day=day)
+        return self.get_files_by_date(folder_id, date, date)[date]
+
     def get_files(self, location: str,
                   start_year: int, start_month: int, start_day: int,
                   end_year: int, end_month: int, end_day: int) -> list:
@@ -159,75 +467,177 @@ class Drive:
         :return: list of files as dictionaries - [{id: ..., name: ...}, {id: ..., name: ...}, ... ]
         :exception: HttpError: Couldn't get files from Drive
         """
-        start_date = datetime.datetime(year=start_year, month=start_month, day=start_day)
-        end_date = datetime.datetime(year=end_year, month=end_month, day=end_day)
-        current_date = start_date
-        files = []
+        start_date = datetime.date(year=start_year, month=start_month, day=start_day)
+        end_date = datetime.date(year=end_year, month=end_month, day=end_day)
 
-        folder_id = self.get_location_directory(location)
+        files_by_date = self._in_location_folder(
+            location, lambda folder_id: self.get_files_by_date(folder_id, start_date, end_date))
 
-        while current_date <= end_date:
-            files.extend(self.get_files_at_date_in_folder(folder_id=folder_id,
-                                                          year=current_date.year,
-                                                          month=current_date.month,
-                                                          day=current_date.day))
-            current_date += datetime.timedelta(days=1)
-
-        return files
+        return [file for date in sorted(files_by_date) for file in files_by_date[date]]
 
     @staticmethod
     def get_file_link(file_id: str) -> str:
         return f"https://drive.google.com/uc?id={file_id}"
 
-    def _download(self, file_id: int, file_name: str) -> str:
+    def _download_remaining(self, file_id: int, partial_file_path: str, chunk_size: int, log_progress: bool) -> None:
+        """Append the bytes of a Drive file that are missing from the partial file, a Range request per chunk."""
+        service = self.service
+        with open(partial_file_path, "ab") as f:
+            offset = f.tell()
+            while True:
+                request = service.files().get_media(fileId=file_id)
+                request.headers['Range'] = f"bytes={offset}-{offset + chunk_size - 1}"
+                chunk = request.execute(num_retries=2)
+                if len(chunk) > chunk_size:
+                    raise ValueError(f"Drive ignored the requested byte range of file {file_id}")
+                f.write(chunk)
+                offset += len(chunk)
+                if log_progress:
+                    logger.debug(f"Download status: {offset} bytes")
+                if len(chunk) < chunk_size:
+                    return
+
+    def _download(self, file_id: int, file_name: str, md5: str = None, directory: str = None,
+                  chunk_size: int = DOWNLOAD_CHUNK_SIZE, log_progress: bool = False) -> str:
         """
         Download the specified file to the Downloaded Stories folder and name it.
+        The local name starts with the file ID, Drive files with the same name don't share a local (or partial) file.
+        The file is requested chunk by chunk with Range headers and written to disk as it arrives.
+        A failed download is resumed from the bytes already on disk.
         :param file_id: Google Drive file ID.
         :param file_name: The name that the downloaded file will have.
+        :param md5: The file's md5Checksum in Drive, to check a downloaded file is whole.
+        :param directory: Where to save the file, the Downloaded Stories folder by default (see download_workspace).
+        :param chunk_size: Bytes requested from Drive at a time.
+        :param log_progress: Log the downloaded bytes after every chunk.
         :return: Absolute path to the downloaded file
         :exception: DriveDownloadError: Couldn't download or save the Drive file
         """
-        service = build(API_NAME, API_VERSION, credentials=self.creds)
-        request = service.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-
-        downloader = MediaIoBaseDownload(fh, request, chunksize=204800)
-        done = False
-
-        try:
-            while not done:
-                status, done = downloader.next_chunk()
-                logger.debug(f"Download status: {int(status.progress() * 100)}")
-
-            fh.seek(0)
-
-            cleaned_file_name = file_name.replace(':', '-')
-            file_path = os.path.join(DOWNLOADED_STORIES_DIR, cleaned_file_name)
-            with open(file_path, "wb") as f:
-                shutil.copyfileobj(fh, f)
-
-            logger.success(f"Downloaded {file_name} and saved it in {file_path}")
-            return file_path
+        cleaned_file_name = f"{file_id}_{file_name.replace(':', '-')}"
+        file_path = os.path.join(directory or DOWNLOADED_STORIES_DIR, cleaned_file_name)
+        if os.path.exists(file_path):
+            if md5 is None or file_md5(file_path) == md5:
+                logger.debug(f"{file_name} was already downloaded to {file_path}")
+                return file_path
+            logger.warning(f"{file_path} doesn't match the Drive file {file_id}, downloading it again")
+            os.remove(file_path)
+        partial_file_path = f"{file_path}.part"
+
+        failed_attempts = 0
+        while True:
+            error = None
+            try:
+                self._download_remaining(file_id, partial_file_path, chunk_size, log_progress)
+            except HttpError as e:
+                if is_rate_limit_error(e):
+                    raise  # Backing off is up to the caller, retrying right away only makes it worse
+                if e.resp.status != 416:  # Requested range starts at the end, the partial file is already whole
+                    error = e
+            except Exception as e:
+                error = e
+            if error is None and md5 is not None and file_md5(partial_file_path) != md5:
+                os.remove(partial_file_path)  # Can't tell which bytes are wrong, start over
+                error = f"{file_name} doesn't match its Drive checksum"
+            if error is None:
+                break
 
-        except Exception as e:
-            raise DriveDownloadError(e)
+            failed_attempts += 1
+            if failed_attempts > DOWNLOAD_RETRIES:
+                raise DriveDownloadError(error)
+            resume_from = os.path.getsize(partial_file_path) if os.path.exists(partial_file_path) else 0
+            logger.warning(f"Downloading {file_name} failed ({error}). Resuming from byte {resume_from}...")
+
+        os.replace(partial_file_path, file_path)
+        logger.success(f"Downloaded {file_name} and saved it in {file_path}")
+        return file_path
+
+    def _download_with_backoff(self, file: dict, directory: str = None,
+                               limiter: AdaptiveConcurrencyLimiter = DRIVE_LIMITER) -> str:
+        """Download a Drive file within the concurrency limit, backing off while Drive rate-limits us."""
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                with limiter:
+                    file_path = self._download(file['id'], file['name'], md5=file.get('md5'), directory=directory)
+                limiter.on_success()
+                return file_path
+            except DriveDownloadError:
+                raise
+            except HttpError as e:
+                if not is_rate_limit_error(e) or attempt == RATE_LIMIT_RETRIES:
+                    raise DriveDownloadError(e)
+                limiter.on_rate_limited()
+                time.sleep(2 ** attempt + random.random())
 
     def download_files(self, location: str, start_year: int, start_month: int, start_day: int,
                        end_year: int, end_month: int, end_day: int) -> list:
-        """Download video files from Drive in the time specified."""
+        """
+        Download video files from Drive in the time specified.
+        The files are downloaded in parallel, see DRIVE_MAX_CONCURRENCY.
+        :return: list of downloaded files in the order Drive listed them - [{id: ..., path: ...}, ...]
+        :exception: DriveDownloadError: Couldn't download or save one of the Drive files
+        """
         drive_files = self.get_files(location=location,
                                      start_year=start_year, start_month=start_month, start_day=start_day,
                                      end_year=end_year, end_month=end_month, end_day=end_day)
-        downloaded_files = []
-        for file in drive_files:
-            downloaded_files.append({'id': file['id'], 'path': self._download(file['id'], file['name'])})
+        return self.download_drive_files(drive_files)
 
-        return downloaded_files
+    def submit_downloads(self, drive_files: list, directory: str = None) -> list:
+        """
+        Start downloading listed Drive files (see get_files) in parallel, without waiting for them.
+        The files share one pool of DRIVE_MAX_CONCURRENCY downloads within DRIVE_LIMITER, the batch's throughput is
+        logged when its last file is done. Cancel the futures to drop the downloads that didn't start yet.
+        :param directory: Where to save the files, the Downloaded Stories folder by default
+        :return: Futures of the downloaded files' paths, in the order entered. A file that couldn't be downloaded has
+                 its DriveDownloadError as exception.
+        """
+        if not drive_files:
+            return []
+
+        start_time = time.monotonic()
+        remaining = {'files': len(drive_files), 'downloaded': 0, 'bytes': 0}
+        lock = threading.Lock()
+
+        def on_done(future: Future) -> None:
+            with lock:
+                remaining['files'] -= 1
+                if not future.cancelled() and not future.exception():
+                    remaining['downloaded'] += 1
+                    remaining['bytes'] += os.path.getsize(future.result())
+                if remaining['files']:
+                    return
+            elapsed_time = max(time.monotonic() - start_time, 1e-6)
+            downloaded_mb = remaining['bytes'] / 2 ** 20
+            logger.info(f"Downloaded {remaining['downloaded']} files ({downloaded_mb:.1f} MB) in {elapsed_time:.1f}s "
+                        f"- {downloaded_mb / elapsed_time:.2f} MB/s")
+
+        executor = ThreadPoolExecutor(max_workers=min(DRIVE_MAX_CONCURRENCY, len(drive_files)),
+                                      thread_name_prefix='drive-download')
+        futures = [executor.submit(self._download_with_backoff, file, directory) for file in drive_files]
+        executor.shutdown(wait=False)  # The workers exit once the batch is done
+        for future in futures:
+            future.add_done_callback(on_done)
+        return futures
+
+    def download_drive_files(self, drive_files: list, directory: str = None) -> list:
+        """
+        Download listed Drive files (see get_files) in parallel.
+        :param directory: Where to save the files, the Downloaded Stories folder by default
+        :return: list of downloaded files in the order entered - [{id: ..., path: ...}, ...]
+        :exception: DriveDownloadError: Couldn't download or save one of the Drive files
+        """
+        futures = self.submit_downloads(drive_files, directory)
+        try:
+            file_paths = [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        return [{'id': file['id'], 'path': file_path} for file, file_path in zip(drive_files, file_paths)]
 
     def get_download_link(self, file_id: str):
         """Get the url link to download the file from drive"""
         logger.debug('Getting download link...')
-        service = build(API_NAME, API_VERSION, credentials=self.creds)
+        service = self.service
         file_metadata = service.files().get(fileId=file_id, fields='webContentLink').execute()
         download_link = file_metadata.get('webContentLink')
         logger.success(f"Successfully got download link")
@@ -235,33 +645,61 @@ class Drive:
 
     def _get_files_in_folder(self, folder_id: str):
         """Get all files in folder"""
-        service = build(API_NAME, API_VERSION, credentials=self.creds)
-
-        results = []
-        page_token = None
-
-        while True:
-            response = service.files().list(q=f"'{folder_id}' in parents",
-                                            spaces='drive',
-                                            fields='nextPageToken, files(id, name)',
-                                            pageToken=page_token).execute()
-
-            files = response.get('files', [])
-            results.extend(files)
-
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-
-        return results
+        return self._list_files(f"'{folder_id}' in parents")
 
     def get_location_dates(self, location: str) -> list:
         """Get location present stories dates"""
-        folder_id = self.get_location_directory(location=location)
-        drive_files = self._get_files_in_folder(folder_id)
-        location_dates = set()
-        for file in drive_files:
-            file_date = file['name'].split('T')[0]
-            location_dates.add(file_date)
-
-        return sorted(list(location_dates))
+        location_dates = self._in_location_folder(
+            location, lambda folder_id: DRIVE_INDEX.get_dates(self._indexed_folder(folder_id)))
+        LOCATION_DATES.set(location, location_dates)
+        return location_dates
+
+    def _get_location_dates_with_backoff(self, location: str,
+                                         limiter: AdaptiveConcurrencyLimiter = DRIVE_LIMITER) -> list:
+        """Get a location's dates within the Drive concurrency limit, backing off while Drive rate-limits us."""
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                with limiter:
+                    location_dates = self.get_location_dates(location)
+                limiter.on_success()
+                return location_dates
+            except HttpError as e:
+                if not is_rate_limit_error(e) or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                limiter.on_rate_limited()
+                time.sleep(2 ** attempt + random.random())
+
+    def _refresh_location_dates(self, location: str) -> None:
+        try:
+            self._get_location_dates_with_backoff(location)
+            logger.debug(f"Refreshed the dates of location {location}")
+        except Exception as e:
+            logger.warning(f"Couldn't refresh the dates of location {location}. Error: {e}")
+        finally:
+            LOCATION_DATES.end_refresh(location)
+
+    def get_locations_dates(self, locations: list, max_workers: int = DRIVE_MAX_CONCURRENCY) -> dict:
+        """
+        Get the dates of many locations: {location: dates}.
+        Cached dates are answered at once (and refreshed in the background if they are older than
+        LOCATION_DATES_TTL), the locations without cached dates are looked up concurrently, within DRIVE_LIMITER.
+        :exception: HttpError: Couldn't get the files of a location from Drive
+        """
+        locations_dates = {}
+        missing_locations = []
+        for location in locations:
+            cached = LOCATION_DATES.get(location)
+            if cached is None:
+                missing_locations.append(location)
+                continue
+            locations_dates[location], is_fresh = cached
+            if not is_fresh and LOCATION_DATES.start_refresh(location):
+                _location_dates_refresher.submit(self._refresh_location_dates, location)
+
+        if missing_locations:
+            logger.info(f"Getting the dates of {len(missing_locations)} of {len(locations)} locations from Drive")
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing_locations)))) as executor:
+                locations_dates.update(zip(missing_locations,
+                                           executor.map(self._get_location_dates_with_backoff, missing_locations)))
+
+        return {location: locations_dates[location] for location in locations}
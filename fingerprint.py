@@ -0,0 +1,228 @@
+import os
+import json
+import datetime
+import threading
+from typing import NamedTuple
+
+import numpy as np
+from loguru import logger
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(MAIN_DIR, 'cache')
+FINGERPRINT_INDEX_PATH = os.environ.get('FINGERPRINT_INDEX_PATH', os.path.join(CACHE_DIR, 'fingerprint_index.npz'))
+
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'fingerprint', f"fingerprint_{date_now}.log"), rotation="1 day")
+
+SAMPLE_RATE = 8000  # Hz, mono. Matches the sample rate ACRCloud fingerprints with.
+CLIP_SECONDS = 10  # Only the start of a story is fingerprinted, like ACRCloud does.
+FFT_SIZE = 1024
+HOP_SIZE = 256
+PEAK_NEIGHBORHOOD_FREQ = 10  # bins on each side of a peak
+PEAK_NEIGHBORHOOD_TIME = 10  # frames on each side of a peak
+PEAK_MIN_DB = 10  # A peak must stand this much above the clip's median level
+FAN_OUT = 10  # Number of target peaks paired with every anchor peak
+MAX_TIME_DELTA = 63  # frames (fits in 6 bits)
+
+MIN_QUERY_HASHES = 50  # Clips with less signal than this are never rejected locally
+MATCH_SCORE = 20  # Aligned hashes needed to call a local match
+NO_MATCH_SCORE = 6  # Below this many aligned hashes the clip is not in the bucket
+
+MATCH = 'match'
+NO_MATCH = 'no_match'
+UNCERTAIN = 'uncertain'
+
+
+class FingerprintError(ValueError):
+    """Raised when the local fingerprint index can not be used."""
+    def __init__(self, error):
+        self.message = f"Fingerprint index error: {error}"
+        logger.error(self.message)
+
+    def __str__(self):
+        return self.message
+
+
+class FingerprintMatch(NamedTuple):
+    verdict: str
+    title: str or None = None
+    score: int = 0
+
+
+def _max_filter(values: np.ndarray, size: int, axis: int) -> np.ndarray:
+    """Sliding maximum of width 2 * size + 1 along an axis (edges padded with -inf)."""
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (size, size)
+    padded = np.pad(values, pad, constant_values=-np.inf)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * size + 1, axis=axis)
+    return windows.max(axis=-1)
+
+
+def spectrogram(samples: np.ndarray) -> np.ndarray:
+    """Log-magnitude spectrogram shaped (frames, frequency bins)."""
+    samples = np.asarray(samples, dtype=np.float32)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if len(samples) < FFT_SIZE:
+        return np.empty((0, FFT_SIZE // 2 + 1), dtype=np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FFT_SIZE)[::HOP_SIZE]
+    magnitude = np.abs(np.fft.rfft(frames * np.hanning(FFT_SIZE), axis=1))
+    return 20 * np.log10(magnitude + 1e-6)
+
+
+def find_peaks(spec: np.ndarray) -> np.ndarray:
+    """Return the (frame, bin) coordinates of the spectrogram's local maxima, sorted by frame."""
+    if not spec.size:
+        return np.empty((0, 2), dtype=np.int64)
+    local_max = _max_filter(_max_filter(spec, PEAK_NEIGHBORHOOD_TIME, axis=0), PEAK_NEIGHBORHOOD_FREQ, axis=1)
+    is_peak = (spec == local_max) & (spec > np.median(spec) + PEAK_MIN_DB)
+    return np.argwhere(is_peak)  # argwhere is row-major, so peaks are already ordered by frame
+
+
+def hash_samples(samples: np.ndarray) -> tuple:
+    """
+    Hash pairs of spectral peaks into (f1, f2, dt) landmarks.
+
+    :param samples: Mono audio samples at SAMPLE_RATE
+    :return: (hashes, anchor frames) as two equally long numpy arrays
+    """
+    peaks = find_peaks(spectrogram(samples))
+    hashes, times = [], []
+    for distance in range(1, FAN_OUT + 1):
+        anchors, targets = peaks[:-distance], peaks[distance:]
+        time_delta = targets[:, 0] - anchors[:, 0]
+        valid = (time_delta > 0) & (time_delta <= MAX_TIME_DELTA)
+        anchors, targets, time_delta = anchors[valid], targets[valid], time_delta[valid]
+        hashes.append((anchors[:, 1] << 16) | (targets[:, 1] << 6) | time_delta)
+        times.append(anchors[:, 0])
+    if not hashes:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int32)
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(times).astype(np.int32)
+
+
+class FingerprintIndex:
+    """
+    Local spectral-peak index of the tracks in the ACRCloud bucket.
+
+    The index only answers NO_MATCH when it is complete (holds every track of the bucket), so a clip is never
+    rejected because its track was missing from the local copy.
+    """
+
+    def __init__(self, path: str = FINGERPRINT_INDEX_PATH):
+        self.path = path
+        self.complete = False
+        self._tracks = []  # [{'id': ACRCloud file ID, 'title': title}, ...]
+        self._hashes = np.empty(0, dtype=np.uint32)
+        self._track_indexes = np.empty(0, dtype=np.int32)
+        self._offsets = np.empty(0, dtype=np.int32)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    @property
+    def track_ids(self) -> set:
+        return {track['id'] for track in self._tracks}
+
+    def is_ready(self) -> bool:
+        """Whether the index is able to reject clips locally."""
+        return self.complete and len(self) > 0
+
+    def mark_incomplete(self) -> None:
+        with self._lock:
+            self.complete = False
+            self.save()
+
+    def add_track(self, track_id: int, title: str, samples: np.ndarray) -> None:
+        """Fingerprint a bucket track and add it to the index (replaces a track with the same ID)."""
+        hashes, offsets = hash_samples(samples)
+        with self._lock:
+            self._remove(track_id)
+            self._tracks.append({'id': track_id, 'title': title})
+            track_indexes = np.full(len(hashes), len(self._tracks) - 1, dtype=np.int32)
+            self._set_arrays(np.concatenate([self._hashes, hashes]),
+                             np.concatenate([self._track_indexes, track_indexes]),
+                             np.concatenate([self._offsets, offsets]))
+        logger.debug(f"Added '{title}' ({track_id}) to the fingerprint index with {len(hashes)} hashes")
+
+    def remove_track(self, track_id: int) -> None:
+        with self._lock:
+            self._remove(track_id)
+
+    def _remove(self, track_id: int) -> None:
+        positions = [position for position, track in enumerate(self._tracks) if track['id'] == track_id]
+        if not positions:
+            return
+        position = positions[0]
+        keep = self._track_indexes != position
+        track_indexes = self._track_indexes[keep]
+        track_indexes[track_indexes > position] -= 1
+        del self._tracks[position]
+        self._set_arrays(self._hashes[keep], track_indexes, self._offsets[keep])
+
+    def _set_arrays(self, hashes: np.ndarray, track_indexes: np.ndarray, offsets: np.ndarray) -> None:
+        order = np.argsort(hashes, kind='stable')
+        self._hashes, self._track_indexes, self._offsets = hashes[order], track_indexes[order], offsets[order]
+
+    def match(self, samples: np.ndarray) -> FingerprintMatch:
+        """
+        Look a clip up in the index.
+
+        :param samples: Mono audio samples of the clip at SAMPLE_RATE
+        :return: MATCH with the matched title, NO_MATCH, or UNCERTAIN when the clip should go to ACRCloud anyway
+        """
+        query_hashes, query_times = hash_samples(samples)
+        with self._lock:
+            if not len(self) or len(query_hashes) < MIN_QUERY_HASHES:
+                return FingerprintMatch(UNCERTAIN)
+
+            starts = np.searchsorted(self._hashes, query_hashes, side='left')
+            counts = np.searchsorted(self._hashes, query_hashes, side='right') - starts
+            total = int(counts.sum())
+            if total:
+                # Expand every [start, start + count) range of the sorted index into flat positions
+                run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+                positions = np.repeat(starts, counts) + np.arange(total) - run_starts
+                tracks = self._track_indexes[positions].astype(np.int64)
+                deltas = self._offsets[positions].astype(np.int64) - np.repeat(query_times, counts)
+                # A real match has many hashes sharing the same (track, time offset) pair
+                keys, key_counts = np.unique(tracks << 32 | (deltas & 0xFFFFFFFF), return_counts=True)
+                best = int(np.argmax(key_counts))
+                score = int(key_counts[best])
+                title = self._tracks[int(keys[best] >> 32)]['title']
+            else:
+                score, title = 0, None
+            complete = self.complete
+
+        if score >= MATCH_SCORE:
+            return FingerprintMatch(MATCH, title, score)
+        if score < NO_MATCH_SCORE and complete:
+            return FingerprintMatch(NO_MATCH, None, score)
+        return FingerprintMatch(UNCERTAIN, title, score)
+
+    def save(self) -> None:
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'wb') as index_file:
+                np.savez(index_file, hashes=self._hashes, track_indexes=self._track_indexes, offsets=self._offsets,
+                         tracks=np.array(json.dumps({'tracks': self._tracks, 'complete': self.complete})))
+        logger.info(f"Saved fingerprint index of {len(self)} tracks to {self.path}")
+
+    def load(self) -> 'FingerprintIndex':
+        """Load the index from disk. A missing index file leaves the index empty."""
+        if not os.path.exists(self.path):
+            logger.info(f"No fingerprint index at {self.path}, every clip will be sent to ACRCloud")
+            return self
+        try:
+            with np.load(self.path) as stored:
+                metadata = json.loads(str(stored['tracks']))
+                with self._lock:
+                    self._tracks = metadata['tracks']
+                    self.complete = metadata['complete']
+                    self._hashes = stored['hashes']
+                    self._track_indexes = stored['track_indexes']
+                    self._offsets = stored['offsets']
+        except (OSError, ValueError, KeyError) as e:
+            raise FingerprintError(f"Can't load {self.path}: {e}")
+        logger.info(f"Loaded fingerprint index of {len(self)} tracks (complete: {self.complete})")
+        return self
@@ -0,0 +1,79 @@
+import os
+import datetime
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from loguru import logger
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))  # seconds
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))  # seconds, between received bytes
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.5))  # Sleeps 0.5s, 1s, 2s... between retries
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))  # Kept-alive connections per host
+# Hosts we call in parallel get pools as large as their callers' concurrency
+HOST_POOL_SIZES = {
+    'api-v2.acrcloud.com': int(os.environ.get('ACRCLOUD_MAX_CONCURRENCY', 4)) * 2,
+    'instagram-scraper-2022.p.rapidapi.com': 4,
+}
+
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'http_client', f"http_client_{date_now}.log"), rotation="1 day")
+
+
+class TimeoutSession(requests.Session):
+    """Session whose requests time out by default, instead of waiting forever on a stuck server."""
+
+    def __init__(self, timeout: tuple = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def _retry() -> Retry:
+    """
+    Retry connection errors and throttled or failed responses with exponential backoff, honoring Retry-After.
+    POST is not retried on a response, an upload the server received must not be uploaded twice.
+    After the last retry the last response is returned, so callers keep handling errors by status.
+    """
+    return Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES,
+                 allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, respect_retry_after_header=True,
+                 raise_on_status=False)
+
+
+def create_session(host_pool_sizes: dict = None, default_pool_size: int = DEFAULT_POOL_SIZE) -> TimeoutSession:
+    """
+    Create a session with keep-alive connection pools, a pool per host.
+    :param host_pool_sizes: {host: connections kept alive to it}, other hosts get default_pool_size
+    """
+    host_pool_sizes = HOST_POOL_SIZES if host_pool_sizes is None else host_pool_sizes
+    session = TimeoutSession()
+    default_adapter = HTTPAdapter(pool_connections=default_pool_size, pool_maxsize=default_pool_size,
+                                  max_retries=_retry())
+    session.mount('https://', default_adapter)
+    session.mount('http://', default_adapter)
+    for host, pool_size in host_pool_sizes.items():
+        session.mount(f'https://{host}/', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                                      max_retries=_retry()))
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> TimeoutSession:
+    """The process wide session, every HTTP call should go through it to reuse its connections."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+                logger.debug("Created shared HTTP session")
+    return _session
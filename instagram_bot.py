@@ -1,10 +1,16 @@
 from loguru import logger  # TODO: Add logging to instagram_bot.py and tests
 import os
-import requests
-import time
 import datetime
-import xmltodict
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from moviepy.editor import VideoFileClip
+from .media_probe import probe_media, MediaProbeError
+from .http_client import get_session
+from .dash_manifest import parse_audio_representation, parse_sidx, bytes_for_duration, DashManifestError
+from .dash_manifest import AudioRepresentation
+from .fingerprint import CLIP_SECONDS
+from .rate_limiter import RateLimiter
+from .workspace import workspace, remove_files
 from dotenv.main import load_dotenv
 load_dotenv()
 
@@ -14,6 +20,15 @@ STORIES_DIR_PATH = os.environ.get('STORIES_DIR_PATH', FILE_DIR_PATH)
 if not os.path.exists(STORIES_DIR_PATH):
     os.makedirs(STORIES_DIR_PATH)
 
+STORY_DOWNLOAD_WORKERS = int(os.environ.get('STORY_DOWNLOAD_WORKERS', 8))  # Parallel downloads from the CDN
+STORY_DOWNLOAD_CHUNK_SIZE = 256 * 1024  # bytes
+# Start of a post's audio stream to download, enough for the recognized clip at DASH audio bitrates
+AUDIO_RANGE_BYTES = int(os.environ.get('INSTAGRAM_AUDIO_RANGE_BYTES', 512 * 1024))
+
+# RAPID API allows 1 request per second, shared by every IGBOT in every process on the host
+RAPIDAPI_LIMITER = RateLimiter('rapidapi-instagram', rate=float(os.environ.get('RAPIDAPI_REQUESTS_PER_SECOND', 1)),
+                               capacity=float(os.environ.get('RAPIDAPI_BURST', 1)))
+
 date_now = datetime.date.today()
 logger.add(os.path.join(MAIN_DIR, 'logs', "instagram_bot", f"instagram_bot_{date_now}.log"), rotation="1 day")
 
@@ -34,9 +49,6 @@ class IGDownloadError(IGError):
 
 
 class IGBOT:
-    def __init__(self):
-        self.last_request_time = time.time()
-
     def get_user_id(self, username: str) -> str:
         """
         Discover user ID from given username
@@ -48,14 +60,9 @@ class IGBOT:
             "X-RapidAPI-Host": os.environ.get("X_RAPID_API_HOST")
         }
 
-        time_now = time.time()
-        time_difference = time_now - self.last_request_time
-        if time_difference < 1:
-            time.sleep(1 - time_difference)  # RAPID API allows 1 request per second
-
-        response = requests.get(url, headers=headers, params=querystring)
+        RAPIDAPI_LIMITER.acquire()
 
-        self.last_request_time = time.time()
+        response = get_session().get(url, headers=headers, params=querystring)
 
         if not response.ok:
             raise IGGetError(response.text)
@@ -72,35 +79,55 @@ class IGBOT:
             "X-RapidAPI-Host": os.environ.get("X_RAPID_API_HOST")
         }
 
-        time_now = time.time()
-        time_difference = time_now - self.last_request_time
-        if time_difference < 1:
-            time.sleep(1 - time_difference)
+        RAPIDAPI_LIMITER.acquire()
 
-        response = requests.get(url, headers=headers, params=querystring)
-
-        self.last_request_time = time.time()
+        response = get_session().get(url, headers=headers, params=querystring)
 
         if not response.ok:
             raise IGGetError(response.text)
         return response.json()['user']
 
     @staticmethod
-    def convert_story_videos_to_audio():
-        for story_video in [os.path.join(STORIES_DIR_PATH, path) for path in os.listdir(STORIES_DIR_PATH)]:
+    def story_workspace():
+        """A directory of its own for one pipeline run's stories, see workspace."""
+        return workspace(STORIES_DIR_PATH)
+
+    @staticmethod
+    def convert_story_videos_to_audio(directory: str = None, story_ids=None):
+        """
+        Convert story videos to MP3 files next to them.
+        :param directory: The directory of the videos, the stories directory by default
+        :param story_ids: Convert only these stories, all the videos in the directory by default
+        """
+        directory = directory or STORIES_DIR_PATH
+        if story_ids is None:
+            story_videos = [os.path.join(directory, path) for path in os.listdir(directory)]
+        else:
+            story_videos = [os.path.join(directory, f"{story_id}.mp4") for story_id in story_ids]
+        for story_video in story_videos:
             file_path, file_extension = os.path.splitext(story_video)
-            if file_extension == ".mp4":
+            if file_extension == ".mp4" and os.path.isfile(story_video):
+                try:
+                    if not probe_media(story_video).has_audio:
+                        logger.debug(f"Story {story_video} has no audio, not converting it")
+                        continue
+                except MediaProbeError as _:
+                    pass  # Let moviepy try to read it
                 video = VideoFileClip(story_video)
+                if video.audio is None:
+                    video.close()
+                    continue
                 video.audio.write_audiofile(f"{file_path}.mp3")
+                video.close()
 
-    def download_user_stories(self, user_id: str) -> dict:
-        stories = self.download_user_stories_as_videos(user_id)
-        IGBOT.convert_story_videos_to_audio()
+    def download_user_stories(self, user_id: str, directory: str = None) -> dict:
+        stories = self.download_user_stories_as_videos(user_id, directory)
+        IGBOT.convert_story_videos_to_audio(directory, story_ids=stories)
         return stories
 
-    def download_user_stories_as_videos(self, user_id: str) -> dict:
+    def get_user_stories(self, user_id: str) -> dict:
         """
-        Download user stories (named with its ID) and return each story ID with its story JSON
+        Get the current stories of a user that have audio: {story ID: story JSON}
         """
         url = "https://instagram-scraper-2022.p.rapidapi.com/ig/stories/"
         querystring = {"id_user": user_id}
@@ -109,14 +136,9 @@ class IGBOT:
             "X-RapidAPI-Host": os.environ.get("X_RAPID_API_HOST")
         }
 
-        time_now = time.time()
-        time_difference = time_now - self.last_request_time
-        if time_difference < 1:
-            time.sleep(1 - time_difference)
-
-        response = requests.get(url, headers=headers, params=querystring)
+        RAPIDAPI_LIMITER.acquire()
 
-        self.last_request_time = time.time()
+        response = get_session().get(url, headers=headers, params=querystring)
 
         if response.ok:
             if "Something went wrong" in response.text:
@@ -125,20 +147,131 @@ class IGBOT:
             if response.json().get('reels'):
                 for story in response.json()['reels'][user_id]['items']:
                     if story.get('has_audio'):
-                        story_url = story['video_versions'][0]['url']
                         stories[story['id']] = story
-                        file_path = os.path.join(STORIES_DIR_PATH, f"{story['id']}.mp4")
-                        with open(file_path, "wb") as f:
-                            response = requests.get(story_url)
-                            f.write(response.content)
             else:
                 logger.info("User has no stories")  # TODO: Change the logger message. It is not necessarily true that the user has no stories
             return stories
         else:
             raise IGDownloadError(response.text)
 
-    def get_audio_urls_from_post_location_id(self, location_id: int) -> dict:
-        """Get usernames and their audio URL of recent Instagram Posts in entered location"""
+    @staticmethod
+    def download_story(story_id: str, story: dict, directory: str = None) -> str:
+        """
+        Stream a story video to the directory (named with its ID), the stories directory by default.
+        Return the video's path.
+        The video is written to a .part file first, so a failed download never leaves a truncated video behind.
+        :exception IGDownloadError: The video couldn't be downloaded
+        """
+        story_url = story['video_versions'][0]['url']
+        file_path = os.path.join(directory or STORIES_DIR_PATH, f"{story_id}.mp4")
+        part_path = f"{file_path}.part"
+        try:
+            with get_session().get(story_url, stream=True) as response:
+                if not response.ok:
+                    raise IGDownloadError(f"Story {story_id} download failed with status {response.status_code}")
+                with open(part_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=STORY_DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            os.replace(part_path, file_path)
+        except IGDownloadError:
+            raise
+        except (requests.RequestException, OSError) as e:
+            raise IGDownloadError(f"Story {story_id} download failed: {e}")
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return file_path
+
+    @staticmethod
+    def download_stories(stories: dict, directory: str = None, max_workers: int = STORY_DOWNLOAD_WORKERS) -> dict:
+        """
+        Download stories videos (named with their ID) to the directory, several at a time.
+        A story that fails to download is logged and left out, the other stories are not affected.
+        :param stories: {story ID: story JSON} as returned by get_user_stories
+        :param directory: Where to download the videos, the stories directory by default
+        :return: {story ID: video path} of the downloaded stories
+        """
+        if not stories:
+            return {}
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stories)))) as executor:
+            futures = {story_id: executor.submit(IGBOT.download_story, story_id, story, directory)
+                       for story_id, story in stories.items()}
+        downloaded = {}
+        for story_id, future in futures.items():
+            try:
+                downloaded[story_id] = future.result()
+            except IGDownloadError as e:
+                logger.error(f"Couldn't download story {story_id}. Error message: {e}")
+        logger.info(f"Downloaded {len(downloaded)} of {len(stories)} stories")
+        return downloaded
+
+    def download_user_stories_as_videos(self, user_id: str, directory: str = None) -> dict:
+        """
+        Download user stories (named with its ID) and return each downloaded story ID with its story JSON.
+        Stories that failed to download are left out (see download_stories).
+        """
+        stories = self.get_user_stories(user_id)
+        downloaded = IGBOT.download_stories(stories, directory)
+        return {story_id: story for story_id, story in stories.items() if story_id in downloaded}
+
+    @staticmethod
+    def _download_range(url: str, start: int, end: int) -> bytes:
+        """
+        Download bytes start to end (inclusive) of a file.
+        :exception IGDownloadError: The bytes couldn't be downloaded
+        """
+        size = end - start + 1
+        data = bytearray()
+        try:
+            with get_session().get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True) as response:
+                if not response.ok:
+                    raise IGDownloadError(f"Audio download failed with status {response.status_code}")
+                # A server that ignores the range sends the whole file, skip to the start and stop at the end
+                skip = start if response.status_code != 206 else 0
+                for chunk in response.iter_content(chunk_size=STORY_DOWNLOAD_CHUNK_SIZE):
+                    data += chunk
+                    if len(data) >= skip + size:
+                        break
+        except requests.RequestException as e:
+            raise IGDownloadError(f"Audio download failed: {e}")
+        return bytes(data[skip:skip + size])
+
+    @staticmethod
+    def download_audio_start(audio_url: str, size: int = AUDIO_RANGE_BYTES) -> bytes:
+        """
+        Download only the first bytes of a post's audio-only DASH representation (its headers and first segments).
+        :exception IGDownloadError: The audio couldn't be downloaded
+        """
+        return IGBOT._download_range(audio_url, 0, size - 1)
+
+    @staticmethod
+    def download_audio_representation_start(representation: AudioRepresentation,
+                                            seconds: float = CLIP_SECONDS) -> bytes:
+        """
+        Download the headers and the fewest segments of an audio representation that cover its first seconds.
+        The headers (up to the segment index) come first, the index tells where the segments end.
+        Without an index the first AUDIO_RANGE_BYTES are downloaded.
+        :exception IGDownloadError: The audio couldn't be downloaded
+        """
+        if not representation.index_range:
+            return IGBOT.download_audio_start(representation.url)
+        index_start, index_end = representation.index_range
+        headers = IGBOT._download_range(representation.url, 0, index_end)
+        try:
+            segments = parse_sidx(headers[index_start:], sidx_end=index_end + 1)
+        except DashManifestError as e:
+            logger.debug(f"Can't read the segment index of {representation.url}, downloading its start. Error: {e}")
+            return IGBOT.download_audio_start(representation.url)
+        if not segments:
+            return headers
+        return headers + IGBOT._download_range(representation.url, segments[0].start,
+                                               bytes_for_duration(segments, seconds))
+
+    def get_audio_representations_from_post_location_id(self, location_id: int) -> dict:
+        """
+        Get usernames and the lowest bandwidth audio representation of their recent Instagram Posts in entered location
+        :return: {username: [AudioRepresentation, ...]}
+        """
         url = "https://instagram-scraper-2022.p.rapidapi.com/ig/locations/"
         querystring = {"location_id": location_id}
         headers = {
@@ -146,14 +279,9 @@ class IGBOT:
             "X-RapidAPI-Host": os.environ.get("X_RAPID_API_HOST")
         }
 
-        time_now = time.time()
-        time_difference = time_now - self.last_request_time
-        if time_difference < 1:
-            time.sleep(1 - time_difference)
-
-        response = requests.get(url, headers=headers, params=querystring)
+        RAPIDAPI_LIMITER.acquire()
 
-        self.last_request_time = time.time()
+        response = get_session().get(url, headers=headers, params=querystring)
 
         if response.ok:
             sections = response.json()['native_location_data']['recent']['sections']
@@ -161,26 +289,30 @@ class IGBOT:
             for section in sections:
                 medias = section['layout_content']['medias']
                 for media in [media for media in medias if media['media'].get('video_dash_manifest')]:
-                    xml_data = xmltodict.parse(media['media']['video_dash_manifest'])
-                    audio_represent_url = xml_data['MPD']['Period']['AdaptationSet'][1]['Representation']['BaseURL']
-                    if type(audio_represent_url) is str:
-                        audio_url = audio_represent_url
-                    else:
-                        audio_url = audio_represent_url['#text']
-                    if not location_audios.get(media['media']['user']['username']):
-                        location_audios[media['media']['user']['username']] = []
-                    location_audios[media['media']['user']['username']].append(audio_url)
+                    try:
+                        audio_representation = parse_audio_representation(media['media']['video_dash_manifest'])
+                    except DashManifestError as _:
+                        continue
+                    if not audio_representation:
+                        continue
+                    location_audios.setdefault(media['media']['user']['username'], []).append(audio_representation)
 
             return location_audios
         else:
             raise IGGetError(response.text)
 
+    def get_audio_urls_from_post_location_id(self, location_id: int) -> dict:
+        """Get usernames and their audio URL of recent Instagram Posts in entered location"""
+        return {username: [audio_representation.url for audio_representation in audio_representations]
+                for username, audio_representations
+                in self.get_audio_representations_from_post_location_id(location_id).items()}
+
     # TODO: Add clean_stories_directory method to bot init and change tests accordingly (replaces setup).
     # TODO: Make sure tests that need files in the stories directory get them using pytest.fixture!
     @staticmethod
     def clean_stories_directory():
         """
-        Delete all files in stories directory
+        Delete all files in stories directory.
+        The workspaces of running pipelines (see story_workspace) are left alone, they delete themselves.
         """
-        for file in os.listdir(STORIES_DIR_PATH):
-            os.remove(os.path.join(STORIES_DIR_PATH, file))
+        remove_files(STORIES_DIR_PATH)
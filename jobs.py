@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import uuid
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from loguru import logger
+from .sqlite_store import SQLiteStore
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(MAIN_DIR, 'cache')
+JOBS_PATH = os.environ.get('JOBS_PATH', os.path.join(CACHE_DIR, 'jobs.sqlite3'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_LEASE = float(os.environ.get('JOB_LEASE', 60))  # seconds a running job stays claimed without a heartbeat
+
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'jobs', f"jobs_{date_now}.log"), rotation="1 day")
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class JobError(ValueError):
+    """Raised when a job can not be submitted or found."""
+    def __init__(self, error):
+        self.message = f"Job error: {error}"
+        logger.error(self.message)
+
+    def __str__(self):
+        return self.message
+
+
+class JobStore(SQLiteStore):
+    """Jobs with their parameters, progress and result, kept on disk so they survive a restart."""
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    files_total INTEGER,
+    files_processed INTEGER NOT NULL DEFAULT 0,
+    files_matched INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    lease_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+    def __init__(self, path: str = JOBS_PATH, lease: float = JOB_LEASE):
+        super().__init__(path)
+        self.lease = lease
+
+    def create(self, job_type: str, params: dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("INSERT INTO jobs (id, type, params, status, created_at, updated_at) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", (job_id, job_type, json.dumps(params), QUEUED, now, now))
+        return job_id
+
+    def _update(self, job_id: str, **columns) -> None:
+        assignments = ', '.join(f"{column} = ?" for column in columns)
+        with self._connect() as connection:
+            connection.execute(f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ?",
+                               (*columns.values(), time.time(), job_id))
+
+    def claim(self, job_id: str) -> bool:
+        """
+        Take a queued job to run it. Only one worker (thread or process) can claim a job.
+        :return: Whether the job was claimed, False if it isn't queued (anymore)
+        """
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = ?, lease_expires_at = ?, updated_at = ? "
+                                        "WHERE id = ? AND status = ?", (RUNNING, now + self.lease, now, job_id, QUEUED))
+        return cursor.rowcount == 1
+
+    def renew_lease(self, job_id: str) -> None:
+        """The worker running the job is alive, keep it claimed."""
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = ?",
+                               (time.time() + self.lease, job_id, RUNNING))
+
+    def requeue_abandoned(self) -> list:
+        """
+        Queue again the running jobs whose worker stopped renewing their lease (it died).
+        :return: Their IDs
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute("SELECT id FROM jobs WHERE status = ? AND "
+                                      "(lease_expires_at IS NULL OR lease_expires_at < ?)",
+                                      (RUNNING, now)).fetchall()
+            job_ids = [row[0] for row in rows]
+            connection.executemany("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?",
+                                   [(QUEUED, now, job_id) for job_id in job_ids])
+        return job_ids
+
+    def set_progress(self, job_id: str, files_processed: int, files_matched: int, files_total: int = None) -> None:
+        """Update the job's counts, the total only when it is given (a known total is never reset to unknown)."""
+        columns = {'files_processed': files_processed, 'files_matched': files_matched}
+        if files_total is not None:
+            columns['files_total'] = files_total
+        self._update(job_id, **columns)
+
+    def set_succeeded(self, job_id: str, result) -> None:
+        self._update(job_id, status=SUCCEEDED, result=json.dumps(result))
+
+    def set_failed(self, job_id: str, error: str) -> None:
+        self._update(job_id, status=FAILED, error=error)
+
+    def get(self, job_id: str) -> dict or None:
+        with self._connect() as connection:
+            connection.row_factory = lambda cursor, row: dict(zip([column[0] for column in cursor.description], row))
+            job = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not job:
+            return None
+        return {
+            'id': job['id'],
+            'type': job['type'],
+            'params': json.loads(job['params']),
+            'status': job['status'],
+            'progress': {'files_total': job['files_total'],
+                         'files_processed': job['files_processed'],
+                         'files_matched': job['files_matched']},
+            'result': json.loads(job['result']) if job['result'] else None,
+            'error': job['error'],
+            'created_at': job['created_at'],
+            'updated_at': job['updated_at']
+        }
+
+    def get_queued(self) -> list:
+        """IDs of the queued jobs, oldest first."""
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,)).fetchall()
+        return [row[0] for row in rows]
+
+
+class JobRunner:
+    """
+    Runs long jobs on a worker pool, outside of the HTTP request that submitted them.
+
+    A handler gets the job's parameters and a progress callback -
+    progress(files_processed, files_matched, files_total) - and returns the job's (JSON serializable) result.
+    """
+
+    def __init__(self, handlers: dict, store: JobStore = None, max_workers: int = JOB_WORKERS):
+        """
+        :param handlers: {job type: handler(params: dict, progress: Callable) -> result}
+        """
+        self.handlers = handlers
+        self.store = store or JobStore()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+
+    def submit(self, job_type: str, params: dict) -> str:
+        """
+        Queue a job.
+        :return: The job ID, to follow it with get
+        :exception JobError: No handler for the job type
+        """
+        if job_type not in self.handlers:
+            raise JobError(f"Unknown job type '{job_type}'")
+        job_id = self.store.create(job_type, params)
+        logger.info(f"Queued {job_type} job {job_id} with {params}")
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def get(self, job_id: str) -> dict:
+        """
+        :exception JobError: No job with the ID
+        """
+        job = self.store.get(job_id)
+        if not job:
+            raise JobError(f"No job with ID {job_id}")
+        return job
+
+    def resume_unfinished(self) -> int:
+        """
+        Queue the jobs that didn't finish before the last shutdown, returns their number.
+        Running jobs are only queued again once their lease expired, another worker may still be running them.
+        Every process can call this, a job is run by the one worker that claims it.
+        """
+        abandoned_ids = self.store.requeue_abandoned()
+        if abandoned_ids:
+            logger.info(f"Queued again {len(abandoned_ids)} jobs whose worker died")
+        job_ids = self.store.get_queued()
+        for job_id in job_ids:
+            self._executor.submit(self._run, job_id)
+        if job_ids:
+            logger.info(f"Resumed {len(job_ids)} unfinished jobs")
+        return len(job_ids)
+
+    def _heartbeat(self, job_id: str, stopped: threading.Event) -> None:
+        while not stopped.wait(self.store.lease / 3):
+            self.store.renew_lease(job_id)
+
+    def _run(self, job_id: str) -> None:
+        job = self.store.get(job_id)
+        handler = self.handlers.get(job['type'])
+        if not handler:
+            self.store.set_failed(job_id, f"Unknown job type '{job['type']}'")
+            return
+        if not self.store.claim(job_id):
+            logger.debug(f"Job {job_id} was already claimed by another worker")
+            return
+        logger.info(f"Running {job['type']} job {job_id}")
+
+        def progress(files_processed: int, files_matched: int, files_total: int = None) -> None:
+            self.store.set_progress(job_id, files_processed, files_matched, files_total)
+
+        stopped = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job_id, stopped), name=f'job-{job_id}-heartbeat',
+                         daemon=True).start()
+        try:
+            result = handler(job['params'], progress)
+        except Exception as e:
+            logger.error(f"{job['type']} job {job_id} failed. Error message: {e}")
+            self.store.set_failed(job_id, str(e))
+            return
+        finally:
+            stopped.set()
+        self.store.set_succeeded(job_id, result)
+        logger.success(f"Finished {job['type']} job {job_id}")
@@ -0,0 +1,65 @@
+import os
+import json
+import time
+import datetime
+
+from loguru import logger
+from .sqlite_store import SQLiteStore
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(MAIN_DIR, 'cache')
+LOCATION_LEDGER_PATH = os.environ.get('LOCATION_LEDGER_PATH', os.path.join(CACHE_DIR, 'location_ledger.sqlite3'))
+
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'music_recognition', f"music_recognition_{date_now}.log"), rotation="1 day")
+
+
+class LocationLedger(SQLiteStore):
+    """
+    Drive files that location_logic already processed, with their outcome.
+
+    Entries hold the recognized story (or None when nothing was recognized) and the bucket version it was processed
+    against, so files are processed again once the bucket changes.
+    """
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_files (
+    file_id TEXT PRIMARY KEY,
+    location TEXT NOT NULL,
+    story_date TEXT,
+    recognized_story TEXT,
+    bucket_version INTEGER NOT NULL,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processed_files_location ON processed_files (location, story_date);
+"""
+
+    def __init__(self, path: str = LOCATION_LEDGER_PATH):
+        super().__init__(path)
+
+    def get_processed(self, file_ids: list, bucket_version: int) -> dict:
+        """
+        Get the files already processed against the bucket version.
+        :return: {file ID: recognized story or None}
+        """
+        processed = {}
+        with self._connect() as connection:
+            # Query in batches to stay under SQLite's limit of bound parameters
+            for batch_start in range(0, len(file_ids), 500):
+                batch = file_ids[batch_start:batch_start + 500]
+                rows = connection.execute(
+                    f"SELECT file_id, recognized_story FROM processed_files "
+                    f"WHERE bucket_version = ? AND file_id IN ({', '.join('?' * len(batch))})",
+                    (bucket_version, *batch)).fetchall()
+                processed.update({file_id: json.loads(story) if story else None for file_id, story in rows})
+        return processed
+
+    def record(self, location: str, file: dict, recognized_story: dict or None, bucket_version: int) -> None:
+        """Record the outcome of processing a Drive file ({id: ..., name: ...})."""
+        story_date = file['name'].split('T')[0] if file.get('name') else None
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO processed_files "
+                "(file_id, location, story_date, recognized_story, bucket_version, processed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (file['id'], location, story_date, json.dumps(recognized_story) if recognized_story else None,
+                 bucket_version, time.time()))
@@ -1,68 +1,314 @@
 import datetime
 import os.path
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait
+from typing import Callable, Iterator
 
 from loguru import logger  # TODO: Add logging to logger and its tests
-from .instagram_bot import IGBOT, STORIES_DIR_PATH
-from .music_recognition import recognize, MusicRecognitionError, check_if_video_has_audio
-from .drive_logic import Drive, clear_downloaded_stories_dir
+from .instagram_bot import IGBOT
+from .music_recognition import recognize_clip, get_cached_recognition, MusicRecognitionError, check_if_video_has_audio
+from .music_recognition import get_bucket_version, ACRCLOUD_MAX_CONCURRENCY
+from .location_ledger import LocationLedger
+from .audio_extract import extract_clip, AudioExtractionError
+from .drive_logic import Drive, download_workspace
 
 MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
 date_now = datetime.date.today()
 logger.add(os.path.join(MAIN_DIR, 'logs', 'music_recognition', f"music_recognition_{date_now}.log"), rotation="1 day")
 
+RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', ACRCLOUD_MAX_CONCURRENCY))
 
-def logic(username: str) -> list:
+# Drive files processed by earlier location_logic runs, so repeated runs only process new stories
+PROCESSED_FILES = LocationLedger()
+
+
+def iter_logic(username: str, progress: Callable = None) -> Iterator[dict]:
     """
-    Recognize tracks in database that an Instagram user uploaded to their story.
+    Recognize tracks in database that an Instagram user uploaded to their story, yielding each story's tracks as soon
+    as the story is recognized.
 
     :param username: Name of the Instagram user to search its stories
-    :return: List of recognized tracks that exist in the database and in a user story
+    :param progress: Called with (stories processed, stories matched, total stories) after every story
+    :return: Yields {'type': 'start', 'total': stories} once the stories are listed, then
+             {'type': 'story', 'position': story's position in the user's stories, 'story_id': id,
+             'tracks': [{'title': title, 'artist': artist, 'album': album}, ...]} for every recognized story, then
+             {'type': 'summary', 'total': stories, 'processed': stories, 'matched': stories, 'failed': [story IDs]}
     """
     instagram_bot = IGBOT()
     user_id = instagram_bot.get_user_id(username)
-    stories_music = instagram_bot.download_user_stories(user_id)
-    recognised_tracks = []
-    for story_id, story_metadata in stories_music.items():
-        try:
-            recognition_results = recognize(os.path.join(STORIES_DIR_PATH, f'{story_id}.mp3'))
+    stories_music = instagram_bot.get_user_stories(user_id)
+    positions = {story_id: position for position, story_id in enumerate(stories_music)}
+    # Stories recognized before (against the current bucket) are not downloaded again, and are answered first
+    cached_results = {story_id: get_cached_recognition(f"instagram-story:{story_id}") for story_id in stories_music}
+    new_stories = {story_id: story for story_id, story in stories_music.items() if cached_results[story_id] is None}
+    yield {'type': 'start', 'total': len(stories_music)}
+
+    counts = {'processed': 0, 'matched': 0}
+    failed_stories = []
+    downloaded_paths = {}
+
+    def recognize_stories(story_ids) -> Iterator[dict]:
+        for story_id in story_ids:
+            story_metadata = stories_music[story_id]
+            recognition_results = None
+            try:
+                recognition_results = cached_results[story_id]
+                if recognition_results is None and story_id not in downloaded_paths:
+                    failed_stories.append(story_id)  # Its download failed
+                elif recognition_results is None:
+                    clip = extract_clip(downloaded_paths[story_id])
+                    recognition_results = recognize_clip(clip, name=f'{story_id}.mp4',
+                                                         source_keys=[f"instagram-story:{story_id}"])
+            except (MusicRecognitionError, AudioExtractionError) as e:
+                logger.critical(f"Error occurred while recognizing music from story ({story_id}.mp4)\n"
+                                f"\tError message: {e}")
+                # TODO: Display error message to user and ask to re-enter the file or reach support
+                failed_stories.append(story_id)
+            counts['processed'] += 1
+            counts['matched'] += bool(recognition_results)
+            if progress:
+                progress(counts['processed'], counts['matched'], len(stories_music))
             if recognition_results:
-                for recognition in recognition_results:
-                    recognised_tracks.append({
+                yield {
+                    'type': 'story',
+                    'position': positions[story_id],
+                    'story_id': story_id,
+                    'tracks': [{
                         'title': recognition['title'],
                         'artist': story_metadata.get('artist'),
                         'album': story_metadata.get('album')
-                    })
-        except MusicRecognitionError as e:
-            logger.critical(f"Error occurred while recognizing music from story ({story_id}.mp3)\n\tError message: {e}")
-            # TODO: Display error message to user and ask to re-enter the file or reach support
+                    } for recognition in recognition_results]
+                }
+
+    yield from recognize_stories(story_id for story_id in stories_music if story_id not in new_stories)
+    if new_stories:
+        with instagram_bot.story_workspace() as workspace:
+            downloaded_paths.update(instagram_bot.download_stories(new_stories, workspace))
+            yield from recognize_stories(new_stories)
+
+    yield {'type': 'summary', 'total': len(stories_music), 'processed': counts['processed'],
+           'matched': counts['matched'], 'failed': failed_stories}
+
+
+def logic(username: str, progress: Callable = None) -> list:
+    """
+    Recognize tracks in database that an Instagram user uploaded to their story.
+
+    :param username: Name of the Instagram user to search its stories
+    :param progress: Called with (stories processed, stories matched, total stories) after every story
+    :return: List of recognized tracks that exist in the database and in a user story
+    """
+    recognized_stories = [record for record in iter_logic(username, progress) if record['type'] == 'story']
+    return [track for record in sorted(recognized_stories, key=lambda record: record['position'])
+            for track in record['tracks']]
+
+
+def iter_recognize_files(files: list, recognize_file: Callable,
+                         max_workers: int = RECOGNITION_WORKERS) -> Iterator[tuple]:
+    """
+    Recognize files with a bounded pool of workers, yielding every file as soon as it is done.
+    Files not started yet are cancelled if the iteration stops early.
+
+    :param files: Files to recognize
+    :param recognize_file: Recognizes a single file and returns its result
+    :param max_workers: Maximum files recognized at the same time
+    :return: Yields (position of the file in files, file, result, error) in the order the files finish. A file that
+             failed has its exception as error (and None as result), the other files are not affected.
+    """
+    if not files:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files)))) as executor:
+        futures = {executor.submit(recognize_file, file): position for position, file in enumerate(files)}
+        try:
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Error occurred while recognizing {files[position]}\n\tError message: {e}")
+                    yield position, files[position], None, e
+                else:
+                    yield position, files[position], result, None
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def recognize_files(files: list, recognize_file: Callable, max_workers: int = RECOGNITION_WORKERS) -> list:
+    """
+    Recognize files with a bounded pool of workers.
+
+    :return: [(file, result, error), ...] in the order of the entered files, see iter_recognize_files
+    """
+    outcomes = sorted(iter_recognize_files(files, recognize_file, max_workers), key=lambda outcome: outcome[0])
+    return [(file, result, error) for _, file, result, error in outcomes]
+
+
+def _drive_source_keys(file: dict) -> list:
+    """Recognition cache keys of a Drive file, by its content checksum (stable across copies and re-uploads)."""
+    return [f"drive-md5:{file['md5']}"] if file.get('md5') else []
+
+
+def _get_cached_drive_recognition(file: dict) -> list or None:
+    source_keys = _drive_source_keys(file)
+    return get_cached_recognition(source_keys[0]) if source_keys else None
+
+
+def _recognize_drive_file(drive: Drive, file: dict, download: Future = None, directory: str = None) -> dict or None:
+    """
+    Recognize a Drive story, return its links and recognition metadata if it was recognized.
+    :param download: The future of the story's downloaded path (see Drive.submit_downloads), None if its recognition
+                     was cached. If the cached result is gone by now (e.g. the bucket changed), the story is
+                     downloaded into the directory and recognized.
+    """
+    result = _get_cached_drive_recognition(file) if download is None else None
+    if result is None:
+        if download is None:
+            file_path = drive.download_drive_files([file], directory)[0]['path']
+        else:
+            file_path = download.result()
+        if not check_if_video_has_audio(file_path):
+            logger.debug(f'File {file_path} has no audio. Deleting file.')
+            os.remove(file_path)
+            return None
+        result = recognize_clip(extract_clip(file_path), name=file_path, source_keys=_drive_source_keys(file))
+    if not result:
+        return None
+    drive_url = drive.get_file_link(file['id'])
+    download_url = drive.get_download_link(file['id'])
+    logger.success(f"Recognized Song! In story ID: {file['id']}")
+    return {'drive_url': drive_url, 'download_url': download_url, 'metadata': result}
+
+
+def iter_location_logic(location: str,
+                        day: int = date_now.day, month: int = date_now.month, year: int = date_now.year,
+                        end_day: int = 0, end_month: int = 0, end_year: int = 0,
+                        progress: Callable = None) -> Iterator[dict]:
+    """
+    Recognize tracks in database in the Drive stories of a location in a range of dates, yielding every recognized
+    story as soon as it is recognized. Stories processed by earlier runs are yielded first. The new stories are
+    downloaded as one batch into the run's own directory, and each story is recognized as soon as its download is
+    done, so results don't wait for the whole range to be downloaded.
+
+    :param progress: Called with (stories processed, stories matched, total stories) as stories are done
+    :return: Yields {'type': 'start', 'total': stories} once the stories are listed, then
+             {'type': 'story', 'position': story's position in the Drive listing, 'file_id': Drive file ID,
+             'story': {'drive_url': url, 'download_url': url, 'metadata': recognized tracks}} for every recognized
+             story, then {'type': 'summary', 'total': stories, 'processed': stories, 'matched': stories,
+             'failed': [Drive file IDs]}
+    """
+    drive = Drive()
+    drive_files = drive.get_files(location=location,
+                                  start_day=day, end_day=end_day or day,
+                                  start_month=month, end_month=end_month or month,
+                                  start_year=year, end_year=end_year or year
+                                  )
+    yield {'type': 'start', 'total': len(drive_files)}
+    bucket_version = get_bucket_version()
+    processed_files = PROCESSED_FILES.get_processed([file['id'] for file in drive_files], bucket_version)
+    logger.info(f"{len(processed_files)} of {len(drive_files)} stories were processed before, "
+                f"processing {len(drive_files) - len(processed_files)} new stories")
+
+    stories_processed, stories_matched = 0, 0
+    if progress:
+        progress(stories_processed, stories_matched, len(drive_files))
+
+    def story_record(position: int, file: dict, recognized_story: dict) -> dict:
+        return {'type': 'story', 'position': position, 'file_id': file['id'], 'story': recognized_story}
+
+    new_files = []
+    for position, file in enumerate(drive_files):
+        if file['id'] not in processed_files:
+            new_files.append((position, file))
             continue
+        stories_processed += 1
+        if processed_files[file['id']]:
+            stories_matched += 1
+            yield story_record(position, file, processed_files[file['id']])
+    if processed_files and progress:
+        progress(stories_processed, stories_matched, len(drive_files))
 
-    return recognised_tracks
+    failed_files = []
+    with download_workspace() as workspace:
+        # Stories recognized before (by their content) are not downloaded again
+        files_to_download = [file for _, file in new_files if _get_cached_drive_recognition(file) is None]
+        downloads = dict(zip([file['id'] for file in files_to_download],
+                             drive.submit_downloads(files_to_download, workspace)))
+        outcomes = iter_recognize_files([file for _, file in new_files],
+                                        lambda file: _recognize_drive_file(drive, file, downloads.get(file['id']),
+                                                                           workspace))
+        try:
+            for new_file_position, file, recognized_story, error in outcomes:
+                stories_processed += 1
+                if error:
+                    failed_files.append(file['id'])  # Not recorded, so the next run tries it again
+                else:
+                    PROCESSED_FILES.record(location, file, recognized_story, bucket_version)
+                    stories_matched += bool(recognized_story)
+                if progress:
+                    progress(stories_processed, stories_matched, len(drive_files))
+                if recognized_story:
+                    yield story_record(new_files[new_file_position][0], file, recognized_story)
+        finally:
+            for download in downloads.values():
+                download.cancel()
+            outcomes.close()
+            wait(downloads.values())  # The running downloads write into the workspace until they are done
+    if failed_files:
+        logger.warning(f"Couldn't recognize {len(failed_files)} of {len(new_files)} files: {failed_files}")
+
+    yield {'type': 'summary', 'total': len(drive_files), 'processed': stories_processed,
+           'matched': stories_matched, 'failed': failed_files}
 
 
 def location_logic(location: str,
                    day: int = date_now.day, month: int = date_now.month, year: int = date_now.year,
-                   end_day: int = 0, end_month: int = 0, end_year: int = 0) -> list:
-    drive = Drive()
-    downloaded_files = drive.download_files(location=location,
-                                            start_day=day, end_day=end_day or day,
-                                            start_month=month, end_month=end_month or month,
-                                            start_year=year, end_year=end_year or year
-                                            )
-
-    recognized_stories = []
-    for file in downloaded_files:
-        if check_if_video_has_audio(file['path']):
-            result = recognize(file['path'])
-            if result:
-                drive_url = drive.get_file_link(file['id'])
-                download_url = drive.get_download_link(file['id'])
-                logger.success(f"Recognized Song! In story ID: {file['id']}")
-                recognized_stories.append({'drive_url': drive_url, 'download_url': download_url, 'metadata': result})
-        else:
-            logger.debug(f'File {file["path"]} has no audio. Deleting file.')
-            os.remove(file['path'])
+                   end_day: int = 0, end_month: int = 0, end_year: int = 0,
+                   progress: Callable = None) -> list:
+    """
+    Recognize tracks in database in the Drive stories of a location in a range of dates.
+
+    :param progress: Called with (stories processed, stories matched, total stories) as stories are done
+    :return: The recognized stories with their Drive links and recognized tracks, in Drive order
+    """
+    records = iter_location_logic(location, day=day, month=month, year=year,
+                                  end_day=end_day, end_month=end_month, end_year=end_year, progress=progress)
+    recognized_stories = [record for record in records if record['type'] == 'story']
+    return [record['story'] for record in sorted(recognized_stories, key=lambda record: record['position'])]
+
 
-    clear_downloaded_stories_dir()
+def _post_audio_source_key(audio_url: str) -> str:
+    """Recognition cache key of a post's audio. The CDN signs its URLs, the path is what identifies the audio."""
+    return f"instagram-audio:{urlparse(audio_url).path}"
+
+
+def _recognize_post_audio(audio_representation) -> list or bool:
+    source_key = _post_audio_source_key(audio_representation.url)
+    result = get_cached_recognition(source_key)
+    if result is None:
+        clip = extract_clip(IGBOT.download_audio_representation_start(audio_representation))
+        result = recognize_clip(clip, name=urlparse(audio_representation.url).path, source_keys=[source_key])
+    return result
+
+
+def location_posts_logic(location_id: int) -> dict:
+    """
+    Recognize tracks in database in the recent Instagram posts of a location.
+    Only the first segments of each post's lowest bandwidth audio-only DASH stream are downloaded, never the video.
+
+    :param location_id: Instagram location ID
+    :return: {username: [{'audio_url': url, 'metadata': recognized tracks}, ...]} of the users with recognized posts
+    """
+    audio_representations = IGBOT().get_audio_representations_from_post_location_id(location_id)
+    posts = [(username, audio_representation) for username, user_representations in audio_representations.items()
+             for audio_representation in user_representations]
+    logger.info(f"Recognizing the audio of {len(posts)} posts in location {location_id}")
 
-    return recognized_stories
+    recognized_posts = {}
+    for (username, audio_representation), result, _error in recognize_files(
+            posts, lambda post: _recognize_post_audio(post[1])):
+        if result:
+            recognized_posts.setdefault(username, []).append({'audio_url': audio_representation.url,
+                                                              'metadata': result})
+    logger.info(f"Recognized posts of {len(recognized_posts)} users in location {location_id}")
+    return recognized_posts
@@ -0,0 +1,168 @@
+import os
+import json
+import struct
+import shutil
+import datetime
+import subprocess
+from typing import NamedTuple
+
+from loguru import logger
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'music_recognition', f"music_recognition_{date_now}.log"), rotation="1 day")
+
+# Boxes that only hold other boxes, on the path moov/trak/mdia/minf/stbl/stsd
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+MAX_MOOV_SIZE = 64 * 1024 * 1024  # A moov this big means the file isn't what we think it is
+FFPROBE_TIMEOUT = 30  # seconds
+
+
+class MediaProbeError(ValueError):
+    """Raised when the media file's streams can not be found."""
+    def __init__(self, path, error):
+        self.message = f"Can't probe media file {path}: {error}"
+        logger.debug(self.message)
+
+    def __str__(self):
+        return self.message
+
+
+class MediaInfo(NamedTuple):
+    has_audio: bool
+    duration: float or None = None  # seconds
+    audio_codec: str or None = None
+
+
+def _iter_boxes(data: bytes, start: int = 0, end: int = None):
+    """Yield (box type, payload start, payload end) of the ISO BMFF boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    position = start
+    while position + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, position)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, position + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            raise ValueError(f"Invalid size of box {box_type} at {position}")
+        yield box_type, position + header_size, min(position + size, end)
+        position += size
+
+
+def _find_moov(path: str) -> bytes:
+    """Read only the moov box of an MP4 file, skipping over the media data."""
+    with open(path, 'rb') as media_file:
+        file_size = os.fstat(media_file.fileno()).st_size
+        position = 0
+        first_box = True
+        while position + 8 <= file_size:
+            media_file.seek(position)
+            header = media_file.read(16)
+            size, box_type = struct.unpack_from('>I4s', header)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', header, 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - position
+            if first_box and box_type not in (b'ftyp', b'moov', b'free', b'skip', b'wide'):
+                raise ValueError("Not an MP4 file")
+            first_box = False
+            if size < header_size:
+                raise ValueError(f"Invalid size of box {box_type} at {position}")
+            if box_type == b'moov':
+                if size > MAX_MOOV_SIZE:
+                    raise ValueError(f"moov box of {size} bytes")
+                media_file.seek(position)
+                return media_file.read(size)
+            position += size
+    raise ValueError("No moov box")
+
+
+def _parse_track(moov: bytes, start: int, end: int) -> tuple:
+    """Get (handler type, duration in seconds, codec) of a trak box."""
+    handler_type, duration, codec = None, None, None
+    pending = [(start, end)]
+    while pending:
+        box_start, box_end = pending.pop()
+        for box_type, payload_start, payload_end in _iter_boxes(moov, box_start, box_end):
+            if box_type in CONTAINER_BOXES:
+                pending.append((payload_start, payload_end))
+            elif box_type == b'hdlr':
+                handler_type = moov[payload_start + 8:payload_start + 12]
+            elif box_type == b'mdhd':
+                if moov[payload_start] == 1:
+                    timescale, track_duration = struct.unpack_from('>IQ', moov, payload_start + 20)
+                else:
+                    timescale, track_duration = struct.unpack_from('>II', moov, payload_start + 12)
+                duration = track_duration / timescale if timescale and track_duration else None
+            elif box_type == b'stsd' and payload_end - payload_start >= 16:
+                # version/flags and entry count, then the first sample entry whose type is the codec
+                codec = moov[payload_start + 12:payload_start + 16].decode('latin-1')
+    return handler_type, duration, codec
+
+
+def probe_mp4(path: str) -> MediaInfo:
+    """
+    Find the streams of an MP4 (ISO BMFF) file from its container headers only.
+    :exception MediaProbeError: The file isn't an MP4 file or its headers can't be parsed
+    """
+    try:
+        moov = _find_moov(path)
+        movie_duration, audio_codec, has_audio = None, None, False
+        _, moov_start, moov_end = next(_iter_boxes(moov))
+        for box_type, payload_start, payload_end in _iter_boxes(moov, moov_start, moov_end):
+            if box_type == b'mvhd':
+                if moov[payload_start] == 1:
+                    timescale, duration = struct.unpack_from('>IQ', moov, payload_start + 20)
+                else:
+                    timescale, duration = struct.unpack_from('>II', moov, payload_start + 12)
+                movie_duration = duration / timescale if timescale and duration else None
+            elif box_type == b'trak':
+                handler_type, track_duration, codec = _parse_track(moov, payload_start, payload_end)
+                if handler_type == b'soun':
+                    has_audio = True
+                    audio_codec = codec
+                    movie_duration = movie_duration or track_duration
+    except (OSError, ValueError, struct.error) as e:
+        raise MediaProbeError(path, e)
+
+    return MediaInfo(has_audio=has_audio, duration=movie_duration, audio_codec=audio_codec)
+
+
+def probe_with_ffprobe(path: str) -> MediaInfo:
+    """
+    Find the streams of any container ffmpeg understands.
+    :exception MediaProbeError: ffprobe is not installed or failed to read the file
+    """
+    ffprobe_path = shutil.which('ffprobe')
+    if not ffprobe_path:
+        raise MediaProbeError(path, "ffprobe is not installed")
+    try:
+        output = subprocess.run([ffprobe_path, '-v', 'error', '-show_streams', '-show_format', '-of', 'json', path],
+                                capture_output=True, check=True, timeout=FFPROBE_TIMEOUT).stdout
+        probe_result = json.loads(output)
+    except (OSError, ValueError, subprocess.SubprocessError) as e:
+        raise MediaProbeError(path, e)
+
+    audio_streams = [stream for stream in probe_result.get('streams', []) if stream.get('codec_type') == 'audio']
+    duration = probe_result.get('format', {}).get('duration')
+    return MediaInfo(has_audio=bool(audio_streams),
+                     duration=float(duration) if duration else None,
+                     audio_codec=audio_streams[0].get('codec_name') if audio_streams else None)
+
+
+def probe_media(path: str) -> MediaInfo:
+    """
+    Find whether a video has audio, its duration and audio codec.
+    MP4 headers are read directly, other containers fall back to ffprobe.
+    :exception MediaProbeError: Neither the MP4 parser nor ffprobe could read the file
+    """
+    try:
+        return probe_mp4(path)
+    except MediaProbeError as _:
+        logger.debug(f"{path} is not a plain MP4 file, probing it with ffprobe")
+        return probe_with_ffprobe(path)
@@ -1,14 +1,22 @@
 from loguru import logger
 import requests
 import datetime
-import subprocess
 from moviepy.editor import VideoFileClip
 from acrcloud.recognizer import ACRCloudRecognizer
 from dotenv.main import load_dotenv
 import os
 from io import BytesIO
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator
 from werkzeug.utils import secure_filename
+from .bucket_catalog import BucketCatalog
+from .http_client import get_session
+from .media_probe import probe_media, MediaProbeError
+from .audio_extract import extract_clip, pcm_to_samples, pcm_to_wav
+from .recognition_cache import RecognitionCache, hash_clip
+from .fingerprint import FingerprintIndex, FingerprintError, CLIP_SECONDS, NO_MATCH, MATCH
 
 load_dotenv()
 
@@ -87,9 +95,63 @@ CONFIG = {
 }
 # BUCKET_INTERACTION_TOKEN = environ.get('ACRCLOUD_USER_INTERACTION_TOKEN', '')
 BUCKET_INTERACTION_TOKEN = os.environ.get('TEST_ALL_TOKEN', '')
+# Maximum simultaneous recognition calls, keep it at the ACRCloud project's QPS limit
+ACRCLOUD_MAX_CONCURRENCY = int(os.environ.get('ACRCLOUD_MAX_CONCURRENCY', 4))
+_acrcloud_slots = threading.BoundedSemaphore(ACRCLOUD_MAX_CONCURRENCY)
+BUCKET_PAGE_SIZE = int(os.environ.get('ACRCLOUD_BUCKET_PAGE_SIZE', 100))
+BUCKET_PAGE_WORKERS = int(os.environ.get('ACRCLOUD_BUCKET_PAGE_WORKERS', 4))
+
+# Local spectral-peak index of the bucket, checked before paying for an ACRCloud call
+FINGERPRINT_PREFILTER = os.environ.get('FINGERPRINT_PREFILTER', '1') != '0'
+# Reference copies of the bucket tracks, named after their titles. The index is (re)built from them whenever a catalog
+# refresh finds tracks it doesn't hold, without them the prefilter stays off.
+FINGERPRINT_TRACKS_DIR = os.environ.get('FINGERPRINT_TRACKS_DIR', '')
+_fingerprint_build_lock = threading.Lock()
+_fingerprint_built_for = None  # The bucket track IDs the last index build was for
+try:
+    FINGERPRINT_INDEX = FingerprintIndex().load()
+except FingerprintError as _:
+    FINGERPRINT_INDEX = FingerprintIndex()
+
+# Recognition results by audio clip, invalidated whenever the bucket's tracks change
+RECOGNITION_CACHE = RecognitionCache()
+# Indexed copy of the bucket listing, so duplicate checks and deletes don't list the whole bucket
+
+
+def _on_catalog_refresh(track_ids: set) -> None:
+    """Invalidate cached results of an older bucket and build the fingerprint index if it misses bucket tracks."""
+    RECOGNITION_CACHE.set_bucket(track_ids)
+    if not FINGERPRINT_PREFILTER or not FINGERPRINT_TRACKS_DIR:
+        return
+    if track_ids <= FINGERPRINT_INDEX.track_ids or track_ids == _fingerprint_built_for:
+        return
+    threading.Thread(target=_build_fingerprint_index_for, args=(track_ids,), name='fingerprint-index',
+                     daemon=True).start()
+
+
+def _build_fingerprint_index_for(track_ids: set) -> None:
+    """Build the index from FINGERPRINT_TRACKS_DIR once for these bucket tracks, unless a build is running."""
+    global _fingerprint_built_for
+    if not _fingerprint_build_lock.acquire(blocking=False):
+        return
+    try:
+        _fingerprint_built_for = track_ids  # Tracks without a local copy don't make every refresh rebuild it
+        build_fingerprint_index(FINGERPRINT_TRACKS_DIR)
+    except Exception as e:
+        logger.error(f"Couldn't build the fingerprint index from {FINGERPRINT_TRACKS_DIR}. Error: {e}")
+    finally:
+        _fingerprint_build_lock.release()
+
+
+CATALOG = BucketCatalog(loader=lambda: iter_files_in_db(), on_refresh=_on_catalog_refresh)
 
 
 def check_if_video_has_audio(video_path):
+    """Check if a video has an audio stream, reading only its container headers when possible."""
+    try:
+        return probe_media(video_path).has_audio
+    except MediaProbeError as _:
+        logger.debug(f"Couldn't probe {video_path}, opening it with moviepy")
     try:
         video_clip = VideoFileClip(video_path)
         has_audio = video_clip.audio is not None
@@ -100,15 +162,88 @@ def check_if_video_has_audio(video_path):
         raise e
 
 
+def load_audio_samples(audio: str or bytes, seconds: float = None):
+    """Decode an audio (or video) file, or its content, to mono samples at the fingerprint sample rate."""
+    return pcm_to_samples(extract_clip(audio, seconds=seconds))
+
+
+def _rejected_by_prefilter(recording_sample: str or bytes, name: str = None) -> bool:
+    """
+    Check the sample (a file path or an extracted clip) against the local fingerprint index.
+    Only a confident local "no match" rejects the sample, matches and uncertain results still go to ACRCloud.
+    """
+    name = name or recording_sample
+    if not FINGERPRINT_PREFILTER or not FINGERPRINT_INDEX.is_ready():
+        return False
+    try:
+        if not CATALOG.ids() <= FINGERPRINT_INDEX.track_ids:
+            logger.debug("The bucket has tracks that are not in the fingerprint index, skipping local check")
+            return False
+        if isinstance(recording_sample, bytes):
+            samples = pcm_to_samples(recording_sample)
+        else:
+            samples = load_audio_samples(recording_sample, seconds=CLIP_SECONDS)
+        local_match = FINGERPRINT_INDEX.match(samples)
+    except Exception as e:
+        logger.warning(f"Couldn't fingerprint {name} locally, sending it to ACRCloud. Error: {e}")
+        return False
+    logger.debug(f"Local fingerprint result for {name}: {local_match}")
+    if local_match.verdict == MATCH:
+        logger.info(f"Local fingerprint matched '{local_match.title}', confirming with ACRCloud")
+    return local_match.verdict == NO_MATCH
+
+
+def build_fingerprint_index(tracks_dir: str) -> FingerprintIndex:
+    """
+    Build the local fingerprint index from reference copies of the bucket tracks.
+    Called in the background after a catalog refresh when FINGERPRINT_TRACKS_DIR is set (see _on_catalog_refresh).
+
+    :param tracks_dir: Directory of audio files named after the track titles in the bucket
+    :return: The rebuilt index. It is only complete (allowed to reject clips) if every bucket track was found.
+    """
+    local_tracks = {os.path.splitext(file_name)[0]: os.path.join(tracks_dir, file_name)
+                    for file_name in os.listdir(tracks_dir)}
+    index = FingerprintIndex(FINGERPRINT_INDEX.path)
+    missing_titles = []
+    for track in CATALOG.tracks():
+        track_path = local_tracks.get(track['title']) or local_tracks.get(secure_filename(track['title']))
+        if not track_path:
+            missing_titles.append(track['title'])
+            continue
+        index.add_track(track['id'], track['title'], load_audio_samples(track_path))
+
+    index.complete = not missing_titles
+    if missing_titles:
+        logger.warning(f"No local copy of {missing_titles}, the fingerprint index will not reject clips")
+    index.save()
+    FINGERPRINT_INDEX.load()
+    return index
+
+
+def _add_to_fingerprint_index(audio_file: BytesIO, track_id: int, title: str) -> None:
+    """Fingerprint a track we just uploaded. On failure the index stops rejecting clips instead of missing it."""
+    try:
+        audio_file.seek(0)
+        FINGERPRINT_INDEX.add_track(track_id, title, load_audio_samples(audio_file.read()))
+        FINGERPRINT_INDEX.save()
+    except Exception as e:
+        logger.warning(f"Couldn't add '{title}' to the fingerprint index. Error: {e}")
+        FINGERPRINT_INDEX.mark_incomplete()
+
+
 def recognize(recording_sample: str, **kwargs) -> bool or dict:
     """
     Check if the recorded sample is present in the user database (the sample is cropped to the first 10 seconds)
     :param recording_sample: Path to local audio file
     :return: Is the recording in user database or not
     """
+    if '_retries' not in kwargs and _rejected_by_prefilter(recording_sample):
+        logger.info(f"No local fingerprint match for {recording_sample}, skipping ACRCloud")
+        return False
     logger.info(f"Recognising file in {recording_sample}")
     acr_recognizer = ACRCloudRecognizer(CONFIG)
-    answer = json.loads(acr_recognizer.recognize_by_file(recording_sample, start_seconds=0))
+    with _acrcloud_slots:
+        answer = json.loads(acr_recognizer.recognize_by_file(recording_sample, start_seconds=0))
     logger.info(f"Done recognising file in {recording_sample}")
     logger.debug(f"Recognition answer: {answer}")
     if answer["status"]["msg"] == 'Success':
@@ -132,8 +267,74 @@ def recognize(recording_sample: str, **kwargs) -> bool or dict:
         raise MusicRecognitionError(answer['status'])
 
 
+def get_cached_recognition(source_key: str) -> list or bool or None:
+    """
+    Get the recognition result of a source that was recognized before against the current bucket.
+    :param source_key: Source of a clip given to recognize_clip, such as 'drive-md5:<checksum>'
+    :return: The recognized tracks or False (no match), None if the source has no valid result
+    """
+    return RECOGNITION_CACHE.get_by_source(source_key)
+
+
+def get_bucket_version() -> int:
+    """Version of the bucket's contents, it changes whenever tracks are added or removed."""
+    try:
+        CATALOG.ids()  # A stale catalog refreshes, noticing changes made outside this app
+    except MusicError as e:
+        logger.warning(f"Couldn't refresh the bucket catalog, using the last known bucket version. Error: {e}")
+    return RECOGNITION_CACHE.bucket_version()
+
+
+def recognize_clip(clip: bytes, name: str = 'audio clip', source_keys: list = ()) -> bool or list:
+    """
+    Check if an audio clip is present in the user database, without writing it to disk.
+    Results are cached by the clip's content, see RecognitionCache.
+    :param clip: Mono 16 bit PCM at 8000 Hz, as audio_extract.extract_clip returns it
+    :param name: Name of the clip's source, for the logs
+    :param source_keys: Keys of the clip's source, to find the result later with get_cached_recognition
+    :return: The recognized tracks in the database, or False
+    """
+    if not clip:
+        logger.debug(f"{name} has no audio")
+        return False
+    clip_hash = hash_clip(clip)
+    cached_result = RECOGNITION_CACHE.get(clip_hash)
+    if cached_result is not None:
+        logger.info(f"Found cached recognition result of {name}")
+        RECOGNITION_CACHE.link(clip_hash, source_keys)
+        return cached_result
+
+    result = _recognize_clip(clip, name)
+    RECOGNITION_CACHE.put(clip_hash, result, source_keys)
+    return result
+
+
+def _recognize_clip(clip: bytes, name: str, _retries: int = 0) -> bool or list:
+    if not _retries and _rejected_by_prefilter(clip, name):
+        logger.info(f"No local fingerprint match for {name}, skipping ACRCloud")
+        return False
+    logger.info(f"Recognising audio clip of {name}")
+    acr_recognizer = ACRCloudRecognizer(CONFIG)
+    with _acrcloud_slots:
+        answer = json.loads(acr_recognizer.recognize_by_filebuffer(pcm_to_wav(clip), 0, CLIP_SECONDS))
+    logger.info(f"Done recognising audio clip of {name}")
+    logger.debug(f"Recognition answer: {answer}")
+    if answer["status"]["msg"] == 'Success':
+        return answer['metadata']['custom_files']
+    elif answer['status']['msg'] in ('No result', 'May Be Mute'):
+        return False
+    elif answer['status']['msg'] == 'Decode Audio Error':
+        if _retries == 3:
+            logger.warning(f"Could not decode the audio clip of {name}")
+            return False
+        logger.info('Retrying to recognize audio clip...')
+        return _recognize_clip(clip, name, _retries=_retries + 1)
+    else:
+        raise MusicRecognitionError(answer['status'])
+
+
 # noinspection PyUnresolvedReferences
-def _upload_to_db(audio_file: BytesIO, title: str, artist: str, album: str = 'Single') -> None:
+def _upload_to_db(audio_file: BytesIO, title: str, artist: str, album: str = 'Single') -> dict:
     """
     Upload an audio file to user music bucket.
 
@@ -142,7 +343,7 @@ def _upload_to_db(audio_file: BytesIO, title: str, artist: str, album: str = 'Si
     :param artist: Music Artist
     :param album: Music Album
     :exception MusicUploadError: The ACRCloud API encountered an error while uploading user's audio file
-    :return: None (Everything is fine)
+    :return: The uploaded file's record in the bucket
     """
     url = f"https://api-v2.acrcloud.com/api/buckets/{BUCKET_ID}/files"
 
@@ -159,7 +360,7 @@ def _upload_to_db(audio_file: BytesIO, title: str, artist: str, album: str = 'Si
 
     logger.info(f"Uploading file")
     try:
-        response = requests.post(url, headers=headers, data=payload, files=files)
+        response = get_session().post(url, headers=headers, data=payload, files=files)
         logger.info(f"Done uploading file")
         
         answer = response.json()
@@ -169,7 +370,7 @@ def _upload_to_db(audio_file: BytesIO, title: str, artist: str, album: str = 'Si
     except requests.RequestException as e:
         raise MusicUploadError(str(e))
 
-    return
+    return answer.get('data', {})
 
 
 def upload_to_db_protected(audio_file: BytesIO, title: str, artist: str, album: str = 'Single') -> None:
@@ -184,16 +385,21 @@ def upload_to_db_protected(audio_file: BytesIO, title: str, artist: str, album:
     :return: None (Everything is fine)
     """
     logger.info("Before uploading")
-    db = get_files_in_db()
-    files_metadata = get_musical_metadata(db)
-    if title in files_metadata:
-        if artist in files_metadata[title]['artist']:
-            raise MusicDuplicationError()
+    if CATALOG.contains(title, artist):
+        raise MusicDuplicationError()
 
-    _upload_to_db(audio_file, title, artist, album)
+    uploaded_file = _upload_to_db(audio_file, title, artist, album)
+    if uploaded_file.get('id'):
+        CATALOG.add({**uploaded_file, 'title': title, 'user_defined': {'artist': artist, 'album': album}})
+        _add_to_fingerprint_index(audio_file, uploaded_file['id'], title)
+    else:
+        CATALOG.invalidate()
+        FINGERPRINT_INDEX.mark_incomplete()
+    RECOGNITION_CACHE.set_bucket(CATALOG.ids())
 
 
-def get_files_in_db() -> dict:
+def _get_files_page(page: int) -> dict:
+    """Get one page of the bucket listing: {'data': [...], 'meta': {'current_page': ..., 'last_page': ...}}"""
     url = f"https://api-v2.acrcloud.com/api/buckets/{BUCKET_ID}/files"
 
     headers = {
@@ -201,9 +407,8 @@ def get_files_in_db() -> dict:
         'Authorization': f'Bearer {BUCKET_INTERACTION_TOKEN}'
     }
 
-    logger.info("Getting audio files from database...")
-    response = requests.get(url, headers=headers)
-    logger.info("Finished getting audio files from database")
+    logger.debug(f"Getting page {page} of audio files from database...")
+    response = get_session().get(url, headers=headers, params={'page': page, 'per_page': BUCKET_PAGE_SIZE})
     answer = json.loads(response.text)
     if answer.get('error'):
         raise MusicUploadError(response.text)
@@ -211,6 +416,40 @@ def get_files_in_db() -> dict:
     return answer
 
 
+def iter_files_pages() -> Iterator[dict]:
+    """
+    Yield the pages of the bucket listing as they arrive.
+    The first page tells the number of pages, the rest are fetched concurrently and yielded in completion order.
+    """
+    logger.info("Getting audio files from database...")
+    first_page = _get_files_page(1)
+    yield first_page
+
+    last_page = first_page.get('meta', {}).get('last_page', 1)
+    if last_page > 1:
+        executor = ThreadPoolExecutor(max_workers=min(BUCKET_PAGE_WORKERS, last_page - 1))
+        try:
+            futures = [executor.submit(_get_files_page, page) for page in range(2, last_page + 1)]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    logger.info("Finished getting audio files from database")
+
+
+def iter_files_in_db() -> Iterator[dict]:
+    """Yield the bucket files one by one, page by page as the pages arrive."""
+    for page in iter_files_pages():
+        yield from page['data']
+
+
+def get_files_in_db() -> dict:
+    """Get the whole bucket listing (all pages, in page order) as {'data': [...], 'meta': {...}}"""
+    pages = sorted(iter_files_pages(), key=lambda page: page.get('meta', {}).get('current_page', 1))
+    files = [bucket_file for page in pages for bucket_file in page['data']]
+    return {'data': files, 'meta': {**pages[0].get('meta', {}), 'total': len(files)}}
+
+
 def delete_id_from_db(file_id: int) -> None:
     """Delete audio file from user music bucket using the track ID.
 
@@ -220,14 +459,22 @@ def delete_id_from_db(file_id: int) -> None:
     """
 
     logger.info(f"Deleting audio file '{file_id}' from database")
-    return_code = subprocess.run([
-        "curl", "--location", "--request", "DELETE",
-        f"https://api-v2.acrcloud.com/api/buckets/{BUCKET_ID}/files/{file_id}",
-        "--header", "Accept: application/json",
-        "--header", f"Authorization: Bearer {BUCKET_INTERACTION_TOKEN}"
-    ])
+    try:
+        response = get_session().delete(f"https://api-v2.acrcloud.com/api/buckets/{BUCKET_ID}/files/{file_id}",
+                                         headers={'Accept': 'application/json',
+                                                  'Authorization': f'Bearer {BUCKET_INTERACTION_TOKEN}'})
+    except requests.RequestException as e:
+        logger.error(f"Request to delete audio file '{file_id}' failed. Error message: {e}")
+        raise MusicDeleteError()
+    if not response.ok and response.status_code != 404:  # 404: It was already deleted
+        logger.error(f"Deleting audio file '{file_id}' failed with status {response.status_code}: {response.text}")
+        raise MusicDeleteError()
     logger.info(f"Finished deleting audio file '{file_id}' from database")
-    logger.debug(f"CMD return code: {return_code}")
+    CATALOG.remove(file_id)
+    RECOGNITION_CACHE.set_bucket(CATALOG.ids())
+    if file_id in FINGERPRINT_INDEX.track_ids:
+        FINGERPRINT_INDEX.remove_track(file_id)
+        FINGERPRINT_INDEX.save()
 
 
 def delete_from_db(title: str) -> None:
@@ -238,11 +485,9 @@ def delete_from_db(title: str) -> None:
     :exception MusicDeleteError: The ACRCloud API encountered an error while deleting user's audio file
     :return: None (Everything is fine)
     """
-    db = get_files_in_db()
-    files_in_db = get_musical_metadata(db)
-    if title in list(files_in_db):
-        file_id = get_id_from_title(db, title)
-        delete_id_from_db(file_id)
+    track = CATALOG.get_by_title(title)
+    if track:
+        delete_id_from_db(track['id'])
     else:
         raise MusicFileDoesNotExist(f"Entered file title: {title}")
 
@@ -255,25 +500,25 @@ def delete_id_from_db_protected_for_web(file_id: int) -> None:
     :exception MusicDeleteError: The ACRCloud API encountered an error while deleting user's audio file
     :return: None (Everything is fine)
     """
-    db = get_files_in_db()
-    files_metadata = get_musical_metadata(db)
-    if file_id in list(map(lambda metadata: metadata['id'], files_metadata.values())):
+    if CATALOG.get(int(file_id)):
         delete_id_from_db(int(file_id))
     else:
-        raise MusicFileDoesNotExist(f"{'files_in_db': files_in_db, 'entered_title': title}")
+        raise MusicFileDoesNotExist(f"Entered file ID: {file_id}")
 
 
-def get_musical_metadata(database: dict) -> dict:
+def get_musical_metadata(database: dict or Iterator[dict]) -> dict:
     """
     Get the musical metadata of all tracks in database: title, album, artist, ACRCloud database ID
     {song_title: {'id': id, 'artist': artist, 'album': album}, song_title_2: {'id': id, ...}, ...}
+
+    :param database: A bucket listing (get_files_in_db) or bucket files as they stream in (iter_files_in_db)
     """
     titles_ids = dict()
-    for track_num in range(len(database['data'])):
-        file_title = database['data'][track_num]['title']
-        file_id = database['data'][track_num]['id']
-        file_artist = database['data'][track_num]['user_defined']['artist']
-        file_album = database['data'][track_num]['user_defined']['album']
+    for bucket_file in database['data'] if isinstance(database, dict) else database:
+        file_title = bucket_file['title']
+        file_id = bucket_file['id']
+        file_artist = bucket_file['user_defined']['artist']
+        file_album = bucket_file['user_defined']['album']
 
         titles_ids[file_title] = {
             'id': file_id,
@@ -289,18 +534,15 @@ def get_id_from_title(database: dict, title: str) -> int:
     return int(db_ids_titles[title]['id'])
 
 
+def iter_human_readable_db() -> Iterator[dict]:
+    """Yield the tracks of get_human_readable_db as they are listed."""
+    for track in CATALOG.iter_tracks():
+        yield {'title': track['title'], 'album': track['album'], 'artist': track['artist'], 'id': track['id']}
+
+
 def get_human_readable_db() -> list:
     """
     Get a list of all tracks in the database in a human-readable form (flattened json):
     [{'title': title, 'album': album, 'artist': artist, 'id': ACRCloud database ID}, {'title': title_2, ...}, ...]
     """
-    db = get_files_in_db()
-    musical_metadata = get_musical_metadata(db)
-    readable_db = []
-    for title in musical_metadata:
-        readable_db.append(
-            {'title': title, 'album': musical_metadata[title]['album'],
-             'artist': musical_metadata[title]['artist'], 'id': musical_metadata[title]['id']}
-        )
-
-    return readable_db
+    return list(iter_human_readable_db())
@@ -0,0 +1,105 @@
+import os
+import time
+import datetime
+
+from loguru import logger
+from .sqlite_store import SQLiteStore
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(MAIN_DIR, 'cache')
+RATE_LIMITS_PATH = os.environ.get('RATE_LIMITS_PATH', os.path.join(CACHE_DIR, 'rate_limits.sqlite3'))
+TICKET_TTL = 10  # seconds, a waiting caller that stopped polling this long ago (its process died) loses its turn
+MAX_POLL_INTERVAL = 0.25  # seconds, how long a caller waiting behind others sleeps between checks
+
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'rate_limiter', f"rate_limiter_{date_now}.log"), rotation="1 day")
+
+
+class RateLimitTimeout(TimeoutError):
+    """Raised when a caller waited longer than its timeout for its turn."""
+    def __init__(self, bucket, timeout):
+        self.message = f"Waited more than {timeout}s for a '{bucket}' request slot"
+        logger.warning(self.message)
+
+    def __str__(self):
+        return self.message
+
+
+class RateLimiter(SQLiteStore):
+    """
+    Token bucket shared by every thread and process on the host using the same database file.
+
+    Tokens refill at `rate` per second up to `capacity`, every request takes one. Callers wait in a first come, first
+    served queue of tickets, so a caller that keeps polling can't starve the ones that came before it.
+    """
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tickets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bucket TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tickets_bucket ON tickets (bucket, id);
+"""
+
+    def __init__(self, name: str, rate: float, capacity: float = 1, path: str = RATE_LIMITS_PATH):
+        """
+        :param name: The bucket's name, limiters with the same name and path share their tokens
+        :param rate: Requests allowed per second
+        :param capacity: Requests allowed in a burst after being idle
+        """
+        super().__init__(path)
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+
+    def _try_acquire(self, ticket_id: int) -> float:
+        """Take a token if the ticket is first in line and a token is available, else return seconds to wait."""
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")  # One caller at a time reads and takes the tokens
+            connection.execute("DELETE FROM tickets WHERE bucket = ? AND expires_at < ?", (self.name, now))
+            connection.execute("UPDATE tickets SET expires_at = ? WHERE id = ?", (now + TICKET_TTL, ticket_id))
+            first_ticket = connection.execute("SELECT MIN(id) FROM tickets WHERE bucket = ?", (self.name,)).fetchone()
+            if first_ticket[0] != ticket_id:
+                return min(1 / self.rate, MAX_POLL_INTERVAL)
+
+            row = connection.execute("SELECT tokens, updated_at FROM buckets WHERE name = ?", (self.name,)).fetchone()
+            tokens, updated_at = row if row else (self.capacity, now)
+            tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+            if tokens < 1:
+                connection.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                                   (self.name, tokens, now))
+                return (1 - tokens) / self.rate
+
+            connection.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                               (self.name, tokens - 1, now))
+            connection.execute("DELETE FROM tickets WHERE id = ?", (ticket_id,))
+            return 0
+
+    def acquire(self, timeout: float = None) -> None:
+        """
+        Wait for this caller's turn and take a request slot.
+        :param timeout: Maximum seconds to wait, None to wait as long as needed
+        :exception RateLimitTimeout: The slot wasn't available before the timeout
+        """
+        started_at = time.monotonic()
+        with self._connect() as connection:
+            ticket_id = connection.execute("INSERT INTO tickets (bucket, expires_at) VALUES (?, ?)",
+                                           (self.name, time.time() + TICKET_TTL)).lastrowid
+        try:
+            while True:
+                wait = self._try_acquire(ticket_id)
+                if not wait:
+                    return
+                if timeout is not None and time.monotonic() - started_at + wait > timeout:
+                    raise RateLimitTimeout(self.name, timeout)
+                time.sleep(min(wait, TICKET_TTL / 2))  # Poll before the ticket expires
+        except BaseException:
+            with self._connect() as connection:
+                connection.execute("DELETE FROM tickets WHERE id = ?", (ticket_id,))
+            raise
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+
+from loguru import logger
+from .sqlite_store import SQLiteStore
+
+MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(MAIN_DIR, 'cache')
+RECOGNITION_CACHE_PATH = os.environ.get('RECOGNITION_CACHE_PATH', os.path.join(CACHE_DIR, 'recognition_cache.sqlite3'))
+
+date_now = datetime.date.today()
+logger.add(os.path.join(MAIN_DIR, 'logs', 'music_recognition', f"music_recognition_{date_now}.log"), rotation="1 day")
+
+
+def hash_clip(clip: bytes) -> str:
+    return hashlib.sha256(clip).hexdigest()
+
+
+class RecognitionCache(SQLiteStore):
+    """
+    Persistent recognition results, keyed by the hash of the recognized audio clip.
+
+    Results are stored with the bucket version they were recognized against, and the version changes whenever the
+    bucket does, so results of an older bucket are never served. Sources (a Drive file's checksum, an Instagram story
+    ID) can be linked to a clip, letting callers find the result before downloading and decoding anything.
+    """
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    clip_hash TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    bucket_version INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    source_key TEXT PRIMARY KEY,
+    clip_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+    def __init__(self, path: str = RECOGNITION_CACHE_PATH):
+        super().__init__(path)
+
+    @staticmethod
+    def _bucket_version(connection) -> int:
+        row = connection.execute("SELECT value FROM meta WHERE key = 'bucket_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def bucket_version(self) -> int:
+        with self._connect() as connection:
+            return self._bucket_version(connection)
+
+    def set_bucket(self, track_ids: set) -> None:
+        """Record the tracks now in the bucket. If they changed, every cached result becomes stale."""
+        digest = hashlib.sha256(json.dumps(sorted(track_ids)).encode()).hexdigest()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")  # Read and bump the version atomically between processes
+            row = connection.execute("SELECT value FROM meta WHERE key = 'bucket_digest'").fetchone()
+            if row and row[0] == digest:
+                return
+            version = self._bucket_version(connection) + 1
+            connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                   [('bucket_digest', digest), ('bucket_version', str(version))])
+            connection.execute("DELETE FROM results WHERE bucket_version < ?", (version,))
+        logger.info(f"Bucket changed, recognition cache is now at bucket version {version}")
+
+    def get(self, clip_hash: str) -> list or bool or None:
+        """The cached result of a clip (recognized tracks or False), None on a miss."""
+        with self._connect() as connection:
+            row = connection.execute("SELECT result FROM results WHERE clip_hash = ? AND bucket_version = ?",
+                                     (clip_hash, self._bucket_version(connection))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_by_source(self, source_key: str) -> list or bool or None:
+        """The cached result of the clip a source was linked to, None on a miss."""
+        with self._connect() as connection:
+            row = connection.execute("SELECT results.result FROM sources JOIN results USING (clip_hash) "
+                                     "WHERE sources.source_key = ? AND results.bucket_version = ?",
+                                     (source_key, self._bucket_version(connection))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, clip_hash: str, result: list or bool, source_keys: list = ()) -> None:
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO results (clip_hash, result, bucket_version, created_at) "
+                               "VALUES (?, ?, ?, ?)",
+                               (clip_hash, json.dumps(result or False), self._bucket_version(connection), time.time()))
+            connection.executemany("INSERT OR REPLACE INTO sources (source_key, clip_hash) VALUES (?, ?)",
+                                   [(source_key, clip_hash) for source_key in source_keys])
+
+    def link(self, clip_hash: str, source_keys: list) -> None:
+        with self._connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO sources (source_key, clip_hash) VALUES (?, ?)",
+                                   [(source_key, clip_hash) for source_key in source_keys])
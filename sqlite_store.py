@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SQLiteStore:
+    """
+    Base of the local SQLite stores (caches, ledgers, queues).
+    Every operation uses its own short-lived connection, so a store can be shared between threads and processes.
+    """
+    SCHEMA = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _initialize(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _connect(self):
+        """A connection whose transaction is committed when the block ends (rolled back on an exception)."""
+        with self._init_lock:
+            if not self._initialized:
+                self._initialize()
+                self._initialized = True
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
@@ -1,5 +1,7 @@
 import os
-import time
+import queue
+import threading
+from contextlib import contextmanager
 
 from loguru import logger
 from .drive_logic import Drive
@@ -8,7 +10,9 @@ import datetime
 from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
 from dotenv.main import load_dotenv
 
 load_dotenv()
@@ -16,6 +20,12 @@ MAIN_DIR = path.dirname(path.abspath(__file__))
 date_now = datetime.date.today()
 logger.add(path.join(MAIN_DIR, 'logs', 'story_story_logic', f"story_story_logic_{date_now}.log"), rotation="1 day")
 
+STORY_STORY_URL = "https://app.story-story.co"
+PAGE_TIMEOUT = float(os.environ.get('STORY_STORY_PAGE_TIMEOUT', 15))  # seconds to wait for a page's elements
+SESSION_POOL_SIZE = int(os.environ.get('STORY_STORY_POOL_SIZE', 2))  # Logged in browsers kept open
+SESSION_WAIT_TIMEOUT = float(os.environ.get('STORY_STORY_SESSION_WAIT_TIMEOUT', 120))  # seconds
+WRONG_LOGIN_MESSAGE = "You entered the wrong email or password."
+
 
 class StoryStoryError(ValueError):
     """Raised when an error relating to story-story.co website interaction occurs."""
@@ -61,26 +71,35 @@ class StoryStoryCanNotFindLocation(StoryStoryError):
         return self.message
 
 
+def get_locations_dates(locations_names: list) -> list[dict]:
+    """Get the dates each Instagram location has stories at in Drive: [{'name': name, 'location_dates': dates}, ...]"""
+    locations_dates = Drive().get_locations_dates([f"{name}_" for name in locations_names])
+    return [{'name': name, 'location_dates': locations_dates[f"{name}_"]} for name in locations_names]
+
+
 class StoryStorySession:
     """Class to enter Instagram location to get its stories."""
 
     def __init__(self, email: str = os.environ['EMAIL'], password: str = os.environ['PASSWORD']):
         """Login to the user. """
-        driver_path = r"C:\Program Files (x86)\Google\Chrome\Application\chrome.exe"
-        website_url = "https://app.story-story.co"
-
         # Make selenium run without web-display
         options = webdriver.ChromeOptions()
         options.add_argument('headless')
 
         # Create a webdriver instance
         self.driver = webdriver.Chrome(options=options)
+        try:
+            self._login(email, password)
+        except BaseException:
+            self.close()  # Don't leave a browser behind for a session that never started
+            raise
 
+    def _login(self, email: str, password: str):
         # Open the website
-        self.driver.get(website_url)
+        self.driver.get(STORY_STORY_URL)
 
         # Locate the login fields and enter credentials
-        email_field = self.driver.find_element(By.NAME, "email")
+        email_field = self._wait().until(expected_conditions.presence_of_element_located((By.NAME, "email")))
         password_field = self.driver.find_element(By.NAME, "password")
 
         email_field.send_keys(email)
@@ -92,17 +111,52 @@ class StoryStorySession:
         logger.info(f"Entered E-mail: {email}")
 
         try:
-            assert "You entered the wrong email or password." not in self.driver.page_source
-            logger.success(f"Successfully Entered")
-        except AssertionError as _:
-            StoryStoryLoginError()
+            # Logged in once the login form is gone, or failed once the error shows
+            self._wait().until(lambda driver: WRONG_LOGIN_MESSAGE in driver.page_source
+                               or not driver.find_elements(By.NAME, "password"))
+        except TimeoutException as _:
+            logger.warning("Login page didn't change, continuing")
+        if WRONG_LOGIN_MESSAGE in self.driver.page_source:
+            raise StoryStoryLoginError()
+        logger.success(f"Successfully Entered")
+
+    def _wait(self, timeout: float = PAGE_TIMEOUT) -> WebDriverWait:
+        return WebDriverWait(self.driver, timeout)
+
+    def _go_home(self):
+        """Go back to the dashboards list, where every action starts."""
+        self.driver.get(STORY_STORY_URL)
+
+    def is_alive(self) -> bool:
+        """Health check: the browser still responds and is still logged in."""
+        try:
+            self.driver.current_url
+            return not self.driver.find_elements(By.NAME, "password")
+        except WebDriverException as _:
+            return False
+
+    def close(self):
+        """Quit the browser (and its Chrome processes). Safe to call more than once."""
+        driver, self.driver = getattr(self, 'driver', None), None
+        if driver:
+            try:
+                driver.quit()
+            except WebDriverException as e:
+                logger.warning(f"Failed to quit the browser. Error: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def _click_button(self, button_text: str):
         """Clicks a web button."""
         # Locate and click the link to the desired button
         try:
-            button_link = self.driver.find_element(By.PARTIAL_LINK_TEXT, button_text)
-        except NoSuchElementException as error:
+            button_link = self._wait().until(
+                expected_conditions.element_to_be_clickable((By.PARTIAL_LINK_TEXT, button_text)))
+        except (NoSuchElementException, TimeoutException) as error:
             logger.error(f"No Button named {button_text}.")
             raise StoryStoryButtonError(error)
 
@@ -127,47 +181,134 @@ class StoryStorySession:
         """Add an Instagram location to the story-story Dashboard"""
         logger.info(f"Entered location {location}")
 
-        location_input_field = self.driver.find_element(By.CSS_SELECTOR, '[placeholder="Add a location ID"]')
+        location_input_field = self._wait().until(expected_conditions.presence_of_element_located(
+            (By.CSS_SELECTOR, '[placeholder="Add a location ID"]')))
+        locations_number = self._get_locations_number()
         location_input_field.send_keys(location)
         location_input_field.send_keys(Keys.RETURN)
-        time.sleep(1)
+        try:
+            # Added once the location list grows, failed once the error shows
+            self._wait().until(lambda driver: "We were not able to add this location" in driver.page_source
+                               or self._get_locations_number() > locations_number)
+        except TimeoutException as _:
+            logger.warning(f"Location list didn't change after adding location {location}")
         if "We were not able to add this location" in self.driver.page_source:
             raise StoryStoryCanNotFindLocation(location)
 
         logger.success(f"Successfully added location {location}")
 
     def __del__(self):
-        self.driver.close()
+        self.close()
 
     def add_location(self, dashboard_name: str, location):
         """Add Instagram location to entered story-story Dashboard"""
         logger.info(f"Entered location {location} to be added in {dashboard_name} dashboard")
+        self._go_home()
         self._enter_dashboard(dashboard_name)
-        time.sleep(0.5)
         self._enter_dashboard_settings()
-        time.sleep(0.1)
         self._enter_new_location(location)
-        del self
         logger.success(f"Successfully added location {location}")
 
     def get_instagram_followed_locations_and_dates(self, dashboard_name: str) -> list[dict]:
         """Get all tracked Instagram locations and dates that stories are present"""
         logger.debug(f"Getting locations from dashboard {dashboard_name}")
+        self._go_home()
         self._enter_dashboard(dashboard_name)
-        time.sleep(0.5)
         self._enter_dashboard_settings()
-        time.sleep(0.5)
+        self._wait().until(expected_conditions.presence_of_element_located(
+            (By.CSS_SELECTOR, '[placeholder="Add a location ID"]')))
         locations_names = []
         for location_element in self.driver.find_elements(By.CLASS_NAME, "following-location-item__name"):
             name = location_element.find_elements(By.TAG_NAME, 'span')[0].text
             locations_names.append(name)
 
-        drive = Drive()
-        locations = []
-        for name in locations_names:
-            location_dates = drive.get_location_dates(f"{name}_")
-            locations.append({'name': name, 'location_dates': location_dates})
-
-        del self
         logger.info(f"Instagram locations in dashboard: {', '.join(locations_names)}")
-        return locations
+        return get_locations_dates(locations_names)
+
+
+class StoryStorySessionPool:
+    """
+    Logged in StoryStory browser sessions, reused between requests instead of starting Chrome and logging in for each.
+    Sessions are health checked before they are handed out, a dead or broken session is replaced.
+    """
+
+    def __init__(self, size: int = SESSION_POOL_SIZE, session_factory=None):
+        """
+        :param size: Maximum number of browsers open at the same time
+        :param session_factory: Creates a logged in session, StoryStorySession by default
+        """
+        self.size = size
+        self._session_factory = session_factory or StoryStorySession
+        self._idle_sessions = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def _create_session(self):
+        logger.info("Starting a StoryStory session")
+        return self._session_factory()
+
+    def warm(self) -> None:
+        """Open and log in all the pool's sessions ahead of the first requests."""
+        sessions = []
+        try:
+            for _ in range(self.size):
+                if not self._slots.acquire(blocking=False):
+                    break
+                try:
+                    sessions.append(self._create_session())
+                except Exception as e:
+                    self._slots.release()
+                    logger.error(f"Failed to warm a StoryStory session. Error: {e}")
+                    break
+        finally:
+            for session in sessions:
+                self._idle_sessions.put(session)
+                self._slots.release()
+        logger.info(f"Warmed {len(sessions)} StoryStory sessions")
+
+    def _get_idle_session(self):
+        try:
+            return self._idle_sessions.get_nowait()
+        except queue.Empty:
+            return None
+
+    @contextmanager
+    def session(self, timeout: float = SESSION_WAIT_TIMEOUT):
+        """
+        Borrow a healthy logged in session, waiting for one if they are all in use.
+        A session whose browser failed during use is closed instead of returned.
+        :exception StoryStoryError: The pool is closed or no session became free before the timeout
+        """
+        if self._closed:
+            raise StoryStoryError("StoryStory session pool is closed")
+        if not self._slots.acquire(timeout=timeout):
+            raise StoryStoryError(f"No StoryStory session became free in {timeout} seconds")
+        session = None
+        try:
+            session = self._get_idle_session()
+            while session and not session.is_alive():
+                logger.warning("Replacing a dead StoryStory session")
+                session.close()
+                session = self._get_idle_session()
+            session = session or self._create_session()
+            yield session
+        except WebDriverException:
+            if session:
+                session.close()
+                session = None
+            raise
+        finally:
+            if session:
+                if self._closed:
+                    session.close()
+                else:
+                    self._idle_sessions.put(session)
+            self._slots.release()
+
+    def close(self) -> None:
+        """Quit all the idle browsers, sessions in use are quit when they are returned."""
+        self._closed = True
+        session = self._get_idle_session()
+        while session:
+            session.close()
+            session = self._get_idle_session()
@@ -0,0 +1,33 @@
+import json
+import pytest
+from .. import app
+
+TRACKS = [{'title': 'Red Samba', 'album': None, 'artist': 'Jenja & The Band', 'id': 1},
+          {'title': 'Billie Jean', 'album': 'Thriller', 'artist': 'Michael Jackson', 'id': 2}]
+
+
+@pytest.fixture()
+def client():
+    return app.app.test_client()
+
+
+def test_database_songs(client, monkeypatch):
+    monkeypatch.setattr(app, 'iter_human_readable_db', lambda: iter(TRACKS))
+    response = client.get('/api/database_songs')
+    assert response.status_code == 200
+    assert json.loads(response.data) == TRACKS
+
+
+def test_database_songs_empty(client, monkeypatch):
+    monkeypatch.setattr(app, 'iter_human_readable_db', lambda: iter([]))
+    assert json.loads(client.get('/api/database_songs').data) == []
+
+
+def test_database_songs_error_after_start(client, monkeypatch):
+    def failing_tracks():
+        yield TRACKS[0]
+        raise RuntimeError("ACRCloud is down")
+
+    monkeypatch.setattr(app, 'iter_human_readable_db', failing_tracks)
+    response = client.get('/api/database_songs')
+    assert json.loads(response.data) == [TRACKS[0], {'error': 'ACRCloud is down'}]
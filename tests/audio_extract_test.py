@@ -0,0 +1,33 @@
+import io
+import os
+import wave
+import pytest
+from tests import MEDIA_TESTS_DIR
+from ..audio_extract import extract_clip, pcm_to_wav, pcm_to_samples, AudioExtractionError, SAMPLE_RATE, SAMPLE_WIDTH
+
+SAMPLE_PATH = os.path.join(MEDIA_TESTS_DIR, 'Billie_Jean_sample.wav')
+
+
+def test_extract_clip_length():
+    clip = extract_clip(SAMPLE_PATH, seconds=3)
+    assert len(clip) == 3 * SAMPLE_RATE * SAMPLE_WIDTH
+
+
+def test_extract_clip_from_memory():
+    with open(os.path.join(MEDIA_TESTS_DIR, 'red_samba_sample.aac'), 'rb') as audio_file:
+        clip = extract_clip(audio_file.read(), seconds=2)
+    assert 0 < len(clip) <= 2 * SAMPLE_RATE * SAMPLE_WIDTH
+    assert abs(pcm_to_samples(clip)).max() <= 1
+
+
+def test_extract_clip_wrong_file_format():
+    with pytest.raises(AudioExtractionError):
+        extract_clip(os.path.join(MEDIA_TESTS_DIR, 'wrong_file_format.txt'))
+
+
+def test_pcm_to_wav():
+    clip = extract_clip(SAMPLE_PATH, seconds=1)
+    with wave.open(io.BytesIO(pcm_to_wav(clip))) as wav_file:
+        assert wav_file.getframerate() == SAMPLE_RATE
+        assert wav_file.getnchannels() == 1
+        assert wav_file.getnframes() == SAMPLE_RATE
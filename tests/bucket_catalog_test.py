@@ -0,0 +1,90 @@
+import pytest
+from ..bucket_catalog import BucketCatalog
+
+BUCKET_FILES = [
+    {'id': 1, 'title': 'Red Samba', 'user_defined': {'artist': 'Adam Ten', 'album': 'Single'}},
+    {'id': 2, 'title': 'Billie Jean', 'user_defined': {'artist': 'Michael Jackson', 'album': 'Thriller'}},
+]
+
+
+class CountingLoader:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return BUCKET_FILES
+
+
+@pytest.fixture
+def loader():
+    return CountingLoader()
+
+
+@pytest.fixture
+def catalog(loader):
+    return BucketCatalog(loader=loader, ttl=60)
+
+
+def test_lookups_load_once(catalog, loader):
+    assert catalog.get(1)['title'] == 'Red Samba'
+    assert catalog.get_by_title('Billie Jean')['id'] == 2
+    assert catalog.contains('Billie Jean', 'Michael Jackson')
+    assert not catalog.contains('Billie Jean', 'Adam Ten')
+    assert loader.calls == 1
+
+
+def test_add_and_remove_update_in_place(catalog, loader):
+    catalog.ids()
+    catalog.add({'id': 3, 'title': 'Alawan', 'user_defined': {'artist': 'Jenja', 'album': 'Single'}})
+    assert catalog.contains('Alawan', 'Jenja')
+    catalog.remove(1)
+    assert catalog.get(1) is None
+    assert catalog.get_by_title('Red Samba') is None
+    assert catalog.ids() == {2, 3}
+    assert loader.calls == 1
+
+
+def test_stale_catalog_refreshes(loader):
+    catalog = BucketCatalog(loader=loader, ttl=-1)
+    catalog.ids()
+    catalog.ids()
+    assert loader.calls == 2
+
+
+def test_invalidate(catalog, loader):
+    catalog.ids()
+    catalog.invalidate()
+    assert [track['title'] for track in catalog.tracks()] == ['Red Samba', 'Billie Jean']
+    assert loader.calls == 2
+
+
+def test_iter_tracks_streams_while_refreshing(loader):
+    def paged_loader():
+        loader()
+        yield BUCKET_FILES[0]
+        assert catalog.is_stale  # The first track is already out before the listing finished
+        yield BUCKET_FILES[1]
+
+    catalog = BucketCatalog(loader=paged_loader, ttl=60)
+    assert [track['id'] for track in catalog.iter_tracks()] == [1, 2]
+    assert not catalog.is_stale
+    assert [track['id'] for track in catalog.iter_tracks()] == [1, 2]
+    assert loader.calls == 1
+
+
+def test_changes_during_refresh_are_kept(catalog):
+    catalog.ids()
+    new_file = {'id': 3, 'title': 'Alawan', 'user_defined': {'artist': 'Jenja', 'album': 'Single'}}
+
+    def paged_loader():
+        yield BUCKET_FILES[0]  # Listed before it is deleted
+        catalog.add(new_file)  # Uploaded after its page was listed
+        catalog.remove(1)
+        yield BUCKET_FILES[1]
+
+    catalog._loader = paged_loader
+    catalog.refresh()
+    assert catalog.ids() == {2, 3}
+    assert catalog.get_by_title('Red Samba') is None
+    assert catalog.contains('Alawan', 'Jenja')
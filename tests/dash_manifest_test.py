@@ -0,0 +1,90 @@
+import os
+import struct
+import subprocess
+
+import pytest
+from imageio_ffmpeg import get_ffmpeg_exe
+from tests import MEDIA_TESTS_DIR
+from ..dash_manifest import parse_audio_representation, parse_sidx, bytes_for_duration, Segment, DashManifestError
+from ..audio_extract import extract_clip, SAMPLE_RATE, SAMPLE_WIDTH
+
+MANIFEST = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT15.0S">
+  <Period duration="PT15.0S">
+    <AdaptationSet id="0" contentType="video" segmentAlignment="true">
+      <Representation id="v1" bandwidth="900000" codecs="avc1.4D401F" mimeType="video/mp4" width="720">
+        <BaseURL>https://cdn.example.com/video.mp4?sig=1</BaseURL>
+        <SegmentBase indexRange="818-1237"><Initialization range="0-817"/></SegmentBase>
+      </Representation>
+    </AdaptationSet>
+    <AdaptationSet id="1" contentType="audio" segmentAlignment="true">
+      <Representation id="a1" bandwidth="128000" codecs="mp4a.40.2" mimeType="audio/mp4">
+        <BaseURL>https://cdn.example.com/audio-high.mp4?sig=2</BaseURL>
+        <SegmentBase indexRange="824-1423"><Initialization range="0-823"/></SegmentBase>
+      </Representation>
+      <Representation id="a2" bandwidth="48000" codecs="mp4a.40.5" mimeType="audio/mp4">
+        <BaseURL dashif:id="x" xmlns:dashif="urn:dashif">https://cdn.example.com/audio-low.mp4?sig=3</BaseURL>
+        <SegmentBase indexRange="800-1399"><Initialization range="0-799"/></SegmentBase>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>"""
+
+
+def build_sidx(references: list, timescale: int = 1000, first_offset: int = 0, version: int = 0) -> bytes:
+    times = struct.pack('>II', 0, first_offset) if version == 0 else struct.pack('>QQ', 0, first_offset)
+    body = struct.pack('>B3sII', version, b'\0\0\0', 1, timescale) + times + struct.pack('>HH', 0, len(references))
+    for size, duration in references:
+        body += struct.pack('>III', size, duration, 0x90000000)
+    return struct.pack('>I4s', 8 + len(body), b'sidx') + body
+
+
+def test_lowest_bandwidth_audio_representation():
+    representation = parse_audio_representation(MANIFEST)
+    assert representation.url == 'https://cdn.example.com/audio-low.mp4?sig=3'
+    assert representation.bandwidth == 48000
+    assert representation.codecs == 'mp4a.40.5'
+    assert representation.init_range == (0, 799)
+    assert representation.index_range == (800, 1399)
+
+
+def test_manifest_without_audio():
+    video_only = MANIFEST[:MANIFEST.index('<AdaptationSet id="1"')] + "</Period></MPD>"
+    assert parse_audio_representation(video_only) is None
+
+
+def test_invalid_manifest():
+    with pytest.raises(DashManifestError):
+        parse_audio_representation("<MPD><Period>")
+
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_parse_sidx(version):
+    sidx = build_sidx([(1000, 2000), (1500, 2000), (500, 1000)], first_offset=10, version=version)
+    segments = parse_sidx(sidx, sidx_end=1400)
+    assert segments == [Segment(1410, 2409, 2.0), Segment(2410, 3909, 2.0), Segment(3910, 4409, 1.0)]
+    assert bytes_for_duration(segments, 3) == 3909
+    assert bytes_for_duration(segments, 60) == 4409
+
+
+def test_parse_sidx_wrong_box():
+    with pytest.raises(DashManifestError):
+        parse_sidx(b'\0\0\0\x10moof' + b'\0' * 8, sidx_end=16)
+
+
+def test_first_segments_decode(tmp_path):
+    """The headers and the first segments alone, as they would be downloaded, decode to the clip."""
+    subprocess.run([get_ffmpeg_exe(), '-v', 'error', '-i', os.path.join(MEDIA_TESTS_DIR, 'red_samba_sample.wav'),
+                    '-c:a', 'aac', '-b:a', '48k', '-f', 'dash', '-single_file', '1', '-global_sidx', '1',
+                    '-seg_duration', '2', str(tmp_path / 'audio.mpd')], check=True)
+    with open(tmp_path / 'audio-stream0.mp4', 'rb') as media_file:
+        media = media_file.read()
+    moov_end = media.index(b'sidx') - 4
+    sidx_size = struct.unpack_from('>I', media, moov_end)[0]
+    index_end = moov_end + sidx_size - 1
+
+    segments = parse_sidx(media[moov_end:index_end + 1], sidx_end=index_end + 1)
+    last_byte = bytes_for_duration(segments, 3)
+    assert last_byte < len(media) - 1
+    clip = extract_clip(media[:index_end + 1] + media[segments[0].start:last_byte + 1], seconds=3)
+    assert len(clip) >= 2.9 * SAMPLE_RATE * SAMPLE_WIDTH
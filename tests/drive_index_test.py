@@ -0,0 +1,84 @@
+import datetime
+
+import pytest
+from ..drive_index import DriveIndex, InMemoryChangesFeed
+
+FOLDER = 'location-folder'
+VIDEO = 'video/mp4'
+DATE = datetime.date(2023, 8, 24)
+
+
+def story(file_id: str, name: str, mime_type: str = VIDEO, parents: list = None) -> dict:
+    return {'id': file_id, 'name': name, 'mimeType': mime_type, 'md5Checksum': f"md5-{file_id}",
+            'parents': [FOLDER] if parents is None else parents}
+
+
+@pytest.fixture
+def index(tmp_path):
+    return DriveIndex(str(tmp_path / 'drive_index.sqlite3'), sync_interval=60)
+
+
+@pytest.fixture
+def feed():
+    return InMemoryChangesFeed(page_size=2)
+
+
+@pytest.fixture
+def indexed(index, feed):
+    index.sync(feed)  # Records where the feed starts before the folder is listed
+    index.index_folder(FOLDER, [story('1', '2023-08-24T21:00:00_a.mp4'),
+                                story('2', '2023-08-24T20:00:00_b.mp4'),
+                                story('3', '2023-08-25T10:00:00_c.jpg', mime_type='image/jpeg'),
+                                story('4', 'no date.mp4')])
+    return index
+
+
+def test_dates_and_files_by_date(indexed):
+    assert indexed.is_indexed(FOLDER)
+    assert not indexed.is_indexed('other-folder')
+    assert indexed.get_dates(FOLDER) == ['2023-08-24', '2023-08-25']
+    files_by_date = indexed.get_files_by_date(FOLDER, DATE, DATE + datetime.timedelta(days=1))
+    assert files_by_date[DATE] == [{'id': '2', 'name': '2023-08-24T20:00:00_b.mp4', 'md5': 'md5-2'},
+                                   {'id': '1', 'name': '2023-08-24T21:00:00_a.mp4', 'md5': 'md5-1'}]
+    assert files_by_date[DATE + datetime.timedelta(days=1)] == []  # Only videos are stories
+
+
+def test_changes_are_applied(indexed, feed):
+    feed.change(story('5', '2023-08-26T09:00:00_new.mp4'))  # Added
+    feed.change(story('1', '2023-08-27T09:00:00_renamed.mp4'))  # Renamed
+    feed.change(dict(story('2', '2023-08-24T20:00:00_b.mp4'), trashed=True))
+    feed.change(story('4', 'no date.mp4', parents=['elsewhere']))  # Moved out
+    feed.change(story('6', '2023-08-26T10:00:00_other.mp4', parents=['other-folder']))  # Not indexed
+    assert indexed.sync(feed) == 5
+    assert feed.list_calls == 3  # Every page is followed
+    assert indexed.get_dates(FOLDER) == ['2023-08-25', '2023-08-26', '2023-08-27']
+    assert indexed.get_files_by_date(FOLDER, DATE, DATE)[DATE] == []
+
+    feed.remove('5')
+    indexed.sync(feed)
+    assert indexed.get_dates(FOLDER) == ['2023-08-25', '2023-08-27']
+
+
+def test_removed_folder_is_forgotten(indexed, feed):
+    feed.remove(FOLDER)
+    indexed.sync(feed)
+    assert not indexed.is_indexed(FOLDER)
+    assert indexed.get_dates(FOLDER) == []
+
+
+def test_page_token_is_persisted(indexed, feed):
+    feed.change(story('5', '2023-08-26T09:00:00_new.mp4'))
+    indexed.sync(feed)
+    feed.change(story('6', '2023-08-28T09:00:00_newer.mp4'))
+    reopened = DriveIndex(indexed.path, sync_interval=60)
+    assert reopened.sync(feed) == 1  # Only the change made since the last sync
+    assert reopened.get_dates(FOLDER)[-1] == '2023-08-28'
+
+
+def test_sync_if_due(indexed, feed):
+    feed.change(story('5', '2023-08-26T09:00:00_new.mp4'))
+    indexed.sync_if_due(feed)
+    assert feed.list_calls == 0  # Synced less than sync_interval ago
+    indexed.sync_interval = 0
+    indexed.sync_if_due(feed)
+    assert '2023-08-26' in indexed.get_dates(FOLDER)
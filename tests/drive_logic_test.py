@@ -1,8 +1,16 @@
 import pytest
 import os.path
 import datetime
-from tests.test_tools import url_validator, date_validator
-from drive_logic import Drive, DriveLocationNotFound
+import json
+import threading
+import httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from .test_tools import url_validator, date_validator
+from .. import drive_logic
+from ..drive_logic import Drive, DriveLocationNotFound, AdaptiveConcurrencyLimiter, is_rate_limit_error, get_service
+from ..drive_logic import LocationFolderCache
+from ..drive_index import DriveIndex, InMemoryChangesFeed
 
 LOCATION = 'selina mantur'
 NON_EXISTENT_LOCATION = 'RISHON_LETZION'
@@ -69,3 +77,264 @@ def test_get_download_link(drive):
 def test_get_location_dates(drive):
     location_dates = drive.get_location_dates(LOCATION)
     assert date_validator(location_dates[0])
+
+
+def http_error(status: int, reason: str = '') -> HttpError:
+    content = json.dumps({'error': {'errors': [{'reason': reason}]}}).encode()
+    return HttpError(resp=httplib2.Response({'status': status}), content=content)
+
+
+def test_is_rate_limit_error():
+    assert is_rate_limit_error(http_error(429))
+    assert is_rate_limit_error(http_error(403, 'userRateLimitExceeded'))
+    assert not is_rate_limit_error(http_error(403, 'insufficientFilePermissions'))
+    assert not is_rate_limit_error(http_error(500))
+
+
+def test_adaptive_concurrency_limiter():
+    limiter = AdaptiveConcurrencyLimiter(max_limit=8)
+    limiter.on_rate_limited()
+    limiter.on_rate_limited()
+    assert limiter.limit == 2
+    for _ in range(2):
+        limiter.on_success()
+    assert limiter.limit == 3
+    with limiter:
+        assert limiter._active == 1
+    assert limiter._active == 0
+
+
+def test_get_service_per_thread(monkeypatch):
+    monkeypatch.setattr(drive_logic, '_credentials', Credentials(token='test-token'))
+    monkeypatch.setattr(drive_logic, '_thread_local', threading.local())
+    service = get_service()
+    assert get_service() is service
+    other_thread_services = []
+    thread = threading.Thread(target=lambda: other_thread_services.append(get_service()))
+    thread.start()
+    thread.join()
+    assert other_thread_services[0] is not service
+    assert other_thread_services[0]._http is not service._http
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeFilesResource:
+    """Serves pre-made list pages, the pages are chained by their index as page token."""
+    def __init__(self, pages):
+        self.pages = pages
+        self.list_calls = []
+
+    def list(self, q, pageToken=None, **kwargs):
+        self.list_calls.append(q)
+        page_number = int(pageToken or 0)
+        page = {'files': self.pages[page_number]}
+        if page_number + 1 < len(self.pages):
+            page['nextPageToken'] = str(page_number + 1)
+        return FakeRequest(page)
+
+
+class FakeDrive(Drive):
+    def __init__(self, pages):
+        self.files_resource = FakeFilesResource(pages)
+        self.feed = InMemoryChangesFeed()
+
+    @property
+    def service(self):
+        return self
+
+    @property
+    def changes_feed(self):
+        return self.feed
+
+    def files(self):
+        return self.files_resource
+
+
+@pytest.fixture
+def drive_index(tmp_path, monkeypatch):
+    index = DriveIndex(str(tmp_path / 'drive_index.sqlite3'), sync_interval=0)
+    monkeypatch.setattr(drive_logic, 'DRIVE_INDEX', index)
+    return index
+
+
+def test_get_files_by_date_from_index(drive_index):
+    video = 'video/mp4'
+    pages = [
+        [],  # Drive may return an empty page that still has a next page token
+        [{'id': '2', 'name': '2023-08-25T01:00:00_story.mp4', 'mimeType': video},
+         {'id': '1', 'name': '2023-08-24T23:00:00_story.mp4', 'mimeType': video}],
+        [{'id': '3', 'name': '2023-08-27T10:00:00_story.mp4', 'mimeType': video},
+         {'id': '4', 'name': 'no date.mp4', 'mimeType': video}],
+    ]
+    fake_drive = FakeDrive(pages)
+    files_by_date = fake_drive.get_files_by_date('folder', DATE, DATE + datetime.timedelta(days=2))
+    assert [file['id'] for file in files_by_date[DATE]] == ['1']
+    assert [file['id'] for file in files_by_date[DATE + datetime.timedelta(days=1)]] == ['2']
+    assert files_by_date[DATE + datetime.timedelta(days=2)] == []
+    assert len(fake_drive.files_resource.list_calls) == len(pages)
+
+    # Later lookups are answered from the index, kept current by the changes feed
+    fake_drive.feed.change({'id': '5', 'name': '2023-08-26T12:00:00_story.mp4', 'mimeType': video,
+                            'parents': ['folder']})
+    files_by_date = fake_drive.get_files_by_date('folder', DATE, DATE + datetime.timedelta(days=2))
+    assert [file['id'] for file in files_by_date[DATE + datetime.timedelta(days=2)]] == ['5']
+    assert len(fake_drive.files_resource.list_calls) == len(pages)
+
+
+def test_unknown_location_dates(tmp_path, monkeypatch):
+    monkeypatch.setattr(drive_logic, 'LOCATION_FOLDERS', LocationFolderCache(str(tmp_path / 'folders.json'), ttl=60))
+    fake_drive = FakeDrive([[]])  # No folder matches the location
+    with pytest.raises(DriveLocationNotFound):
+        fake_drive.get_location_dates(NON_EXISTENT_LOCATION)
+    with pytest.raises(DriveLocationNotFound):  # Not taken for a rate limit error
+        fake_drive._get_location_dates_with_backoff(NON_EXISTENT_LOCATION, limiter=AdaptiveConcurrencyLimiter(1))
+    assert len(fake_drive.files_resource.list_calls) == 2
+
+
+def test_location_folder_cache(tmp_path):
+    cache_path = str(tmp_path / 'location_folders.json')
+    cache = LocationFolderCache(cache_path, ttl=60)
+    assert cache.get(LOCATION) is None
+    cache.set(LOCATION, 'folder-id')
+    assert LocationFolderCache(cache_path, ttl=60).get(LOCATION) == 'folder-id'
+    assert LocationFolderCache(cache_path, ttl=-1).get(LOCATION) is None
+    cache.invalidate(LOCATION)
+    assert LocationFolderCache(cache_path, ttl=60).get(LOCATION) is None
+
+
+class FakeDatesDrive(Drive):
+    """Answers get_location_dates from a dict, counting the concurrent lookups."""
+
+    def __init__(self, dates):
+        self.dates = dates
+        self.lookups = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def get_location_dates(self, location: str) -> list:
+        with self._lock:
+            self.lookups.append(location)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        threading.Event().wait(0.05)
+        with self._lock:
+            self.active -= 1
+        drive_logic.LOCATION_DATES.set(location, self.dates[location])
+        return self.dates[location]
+
+
+@pytest.fixture
+def location_dates_cache(tmp_path, monkeypatch):
+    cache = drive_logic.LocationDatesCache(str(tmp_path / 'location_dates.json'), ttl=60)
+    monkeypatch.setattr(drive_logic, 'LOCATION_DATES', cache)
+    return cache
+
+
+def test_get_locations_dates_concurrently(location_dates_cache):
+    dates = {f"location {number}_": [f"2023-08-{number + 10}"] for number in range(8)}
+    fake_drive = FakeDatesDrive(dates)
+    assert fake_drive.get_locations_dates(list(dates), max_workers=4) == dates
+    assert fake_drive.max_active > 1
+    assert sorted(fake_drive.lookups) == sorted(dates)
+
+    # Cached dates are answered without Drive
+    assert fake_drive.get_locations_dates(list(dates)) == dates
+    assert len(fake_drive.lookups) == len(dates)
+
+
+def test_stale_location_dates_refresh_in_background(location_dates_cache):
+    location_dates_cache.set(LOCATION, ['2023-08-24'])
+    location_dates_cache.ttl = -1
+    fake_drive = FakeDatesDrive({LOCATION: ['2023-08-24', '2023-08-25']})
+    assert fake_drive.get_locations_dates([LOCATION]) == {LOCATION: ['2023-08-24']}  # Answered from the cache
+    for _ in range(100):  # Wait for the background refresh
+        if location_dates_cache.get(LOCATION)[0] != ['2023-08-24']:
+            break
+        threading.Event().wait(0.01)
+    assert location_dates_cache.get(LOCATION)[0] == ['2023-08-24', '2023-08-25']
+    assert fake_drive.lookups == [LOCATION]
+
+
+class FakeMediaRequest:
+    """A get_media request answering the byte range of its Range header, failing once after `fail_after` bytes."""
+    def __init__(self, media):
+        self.media = media
+        self.headers = {}
+
+    def execute(self, num_retries=0):
+        start, end = (int(byte) for byte in self.headers['Range'].split('=')[1].split('-'))
+        if start >= len(self.media.content):
+            raise HttpError(httplib2.Response({'status': 416}), b'')
+        if self.media.fail_after is not None and end >= self.media.fail_after:
+            self.media.fail_after = None
+            raise ConnectionResetError("Connection lost")
+        self.media.ranges.append((start, end))
+        return self.media.content[start:end + 1]
+
+
+class FakeMediaDrive(Drive):
+    def __init__(self, content, fail_after=None):
+        self.content = content
+        self.fail_after = fail_after
+        self.ranges = []
+
+    @property
+    def service(self):
+        return self
+
+    def files(self):
+        return self
+
+    def get_media(self, fileId):
+        return FakeMediaRequest(self)
+
+
+def test_download_resumes_with_range_requests(tmp_path, monkeypatch):
+    monkeypatch.setattr(drive_logic, 'DOWNLOADED_STORIES_DIR', str(tmp_path))
+    content = os.urandom(10_000)
+    md5 = drive_logic.hashlib.md5(content).hexdigest()
+    fake_drive = FakeMediaDrive(content, fail_after=5_000)
+    file_path = fake_drive._download('file-id', '2023-08-24T21:13:05_story.mp4', md5=md5, chunk_size=2_000)
+    with open(file_path, 'rb') as f:
+        assert f.read() == content
+    assert [start for start, _ in fake_drive.ranges] == [0, 2_000, 4_000, 6_000, 8_000]  # Resumed, not restarted
+
+    # A whole file is kept, a file that doesn't match the checksum is downloaded again
+    assert fake_drive._download('file-id', '2023-08-24T21:13:05_story.mp4', md5=md5) == file_path
+    assert len(fake_drive.ranges) == 5
+    with open(file_path, 'wb') as f:
+        f.write(content[:100])
+    fake_drive._download('file-id', '2023-08-24T21:13:05_story.mp4', md5=md5, chunk_size=20_000)
+    with open(file_path, 'rb') as f:
+        assert f.read() == content
+
+
+def test_same_name_files_download_apart(tmp_path, monkeypatch):
+    monkeypatch.setattr(drive_logic, 'DOWNLOADED_STORIES_DIR', str(tmp_path))
+    file_name = '2023-08-24T21:13:05_story.mp4'
+    first_path = FakeMediaDrive(b'first story')._download('first-id', file_name)
+    second_path = FakeMediaDrive(b'second story')._download('second-id', file_name)
+    assert first_path != second_path
+    with open(first_path, 'rb') as first_file, open(second_path, 'rb') as second_file:
+        assert (first_file.read(), second_file.read()) == (b'first story', b'second story')
+
+
+def test_submit_downloads_into_workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(drive_logic, 'DOWNLOADED_STORIES_DIR', str(tmp_path))
+    files = [{'id': f"file-{number}", 'name': '2023-08-24T21:13:05_story.mp4'} for number in range(3)]
+    with drive_logic.download_workspace() as workspace:
+        futures = FakeMediaDrive(b'story').submit_downloads(files, workspace)
+        paths = [future.result() for future in futures]
+        assert all(os.path.dirname(path) == workspace for path in paths)
+        assert len(set(paths)) == len(files)
+        drive_logic.clear_downloaded_stories_dir()  # Leaves the workspaces of running downloads alone
+        assert all(os.path.exists(path) for path in paths)
+    assert not os.path.exists(workspace)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from ..fingerprint import FingerprintIndex, SAMPLE_RATE, MATCH, NO_MATCH, UNCERTAIN
+
+
+def synthetic_track(seed: int, seconds: int) -> np.ndarray:
+    """A sequence of random three-tone chords, 8 chords per second."""
+    generator = np.random.default_rng(seed)
+    chord_length = SAMPLE_RATE // 8
+    time_axis = np.arange(chord_length) / SAMPLE_RATE
+    chords = []
+    for _ in range(seconds * 8):
+        frequencies = generator.uniform(100, 3500, size=3)
+        chords.append(sum(np.sin(2 * np.pi * frequency * time_axis) for frequency in frequencies))
+    return np.concatenate(chords)
+
+
+TRACK = synthetic_track(seed=1, seconds=40)
+OTHER_TRACK = synthetic_track(seed=2, seconds=40)
+
+
+@pytest.fixture
+def index(tmp_path):
+    fingerprint_index = FingerprintIndex(str(tmp_path / 'index.npz'))
+    fingerprint_index.add_track(1, 'Red Samba', TRACK)
+    fingerprint_index.add_track(2, 'Billie Jean', OTHER_TRACK)
+    fingerprint_index.complete = True
+    return fingerprint_index
+
+
+def test_match_noisy_excerpt(index):
+    excerpt = TRACK[int(7.3 * SAMPLE_RATE):int(17.3 * SAMPLE_RATE)]
+    noise = np.random.default_rng(0).normal(0, 0.5, len(excerpt))
+    result = index.match(excerpt + noise)
+    assert result.verdict == MATCH
+    assert result.title == 'Red Samba'
+
+
+def test_no_match_unknown_track(index):
+    assert index.match(synthetic_track(seed=3, seconds=10)).verdict == NO_MATCH
+
+
+def test_incomplete_index_is_uncertain(index):
+    index.complete = False
+    assert index.match(synthetic_track(seed=3, seconds=10)).verdict == UNCERTAIN
+
+
+def test_silence_is_uncertain(index):
+    assert index.match(np.zeros(10 * SAMPLE_RATE)).verdict == UNCERTAIN
+
+
+def test_remove_track(index):
+    index.remove_track(1)
+    assert index.match(TRACK[:10 * SAMPLE_RATE]).verdict == NO_MATCH
+    assert index.match(OTHER_TRACK[:10 * SAMPLE_RATE]).title == 'Billie Jean'
+
+
+def test_save_and_load(index):
+    index.save()
+    loaded_index = FingerprintIndex(index.path).load()
+    assert loaded_index.track_ids == {1, 2}
+    assert loaded_index.is_ready()
+    assert loaded_index.match(TRACK[:10 * SAMPLE_RATE]).title == 'Red Samba'
@@ -0,0 +1,73 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from ..http_client import create_session, get_session, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Answers 503 to the first `failures` requests of a path, then 200, and counts connections."""
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+    requests_by_path = {}
+    failures = 2
+    connections = set()
+
+    def do_GET(self):
+        FlakyHandler.connections.add(self.client_address)
+        count = FlakyHandler.requests_by_path.get(self.path, 0) + 1
+        FlakyHandler.requests_by_path[self.path] = count
+        status = 503 if self.path.startswith('/flaky') and count <= FlakyHandler.failures else 200
+        body = f"request {count}".encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server():
+    FlakyHandler.requests_by_path = {}
+    FlakyHandler.connections = set()
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{http_server.server_address[1]}"
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def test_shared_session():
+    assert get_session() is get_session()
+    assert get_session().timeout == (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+def test_retries_server_errors(server):
+    response = create_session().get(f"{server}/flaky")
+    assert response.status_code == 200
+    assert response.text == "request 3"
+
+
+def test_post_is_not_retried_on_response(server):
+    response = create_session().post(f"{server}/flaky-upload")
+    assert response.status_code == 503
+    assert FlakyHandler.requests_by_path['/flaky-upload'] == 1
+
+
+def test_connections_are_reused(server):
+    session = create_session()
+    for _ in range(5):
+        assert session.get(f"{server}/ok").ok
+    assert len(FlakyHandler.connections) == 1
+
+
+def test_host_pool_sizes():
+    session = create_session(host_pool_sizes={'api.example.com': 3}, default_pool_size=7)
+    assert session.get_adapter('https://api.example.com/files')._pool_maxsize == 3
+    assert session.get_adapter('https://cdn.example.com/video.mp4')._pool_maxsize == 7
@@ -3,7 +3,7 @@ import os
 from tests import TESTS_DIR
 STORIES_TESTS_DIR = os.path.join(TESTS_DIR, 'test_instagram_bot_media')
 os.environ['STORIES_DIR_PATH'] = STORIES_TESTS_DIR
-from instagram_bot import IGBOT
+from ..instagram_bot import IGBOT
 
 TEST_IG_USERNAME = 'yula.bar'
 TEST_IG_ID = '8539536167'
@@ -0,0 +1,101 @@
+import time
+import pytest
+from ..jobs import JobRunner, JobStore, JobError, QUEUED, RUNNING, SUCCEEDED, FAILED
+
+
+def wait_for(runner: JobRunner, job_id: str, timeout: float = 5) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = runner.get(job_id)
+        if job['status'] in (SUCCEEDED, FAILED):
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+def count_matches(params, progress):
+    for processed in range(1, params['total'] + 1):
+        progress(processed, processed // 2, params['total'])
+    return [{'matched': params['total'] // 2}]
+
+
+def fail(_params, _progress):
+    raise RuntimeError("Drive is down")
+
+
+def test_job_succeeds_with_progress(tmp_path):
+    runner = JobRunner({'count': count_matches}, store=JobStore(str(tmp_path / 'jobs.sqlite3')))
+    job = wait_for(runner, runner.submit('count', {'total': 4}))
+    assert job['status'] == SUCCEEDED
+    assert job['result'] == [{'matched': 2}]
+    assert job['progress'] == {'files_total': 4, 'files_processed': 4, 'files_matched': 2}
+    assert job['params'] == {'total': 4}
+
+
+def test_progress_keeps_known_total(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite3'))
+    job_id = store.create('count', {})
+    store.set_progress(job_id, 1, 0, files_total=4)
+    store.set_progress(job_id, 2, 1)
+    assert store.get(job_id)['progress'] == {'files_total': 4, 'files_processed': 2, 'files_matched': 1}
+
+
+def test_failed_job_keeps_error(tmp_path):
+    runner = JobRunner({'fail': fail}, store=JobStore(str(tmp_path / 'jobs.sqlite3')))
+    job = wait_for(runner, runner.submit('fail', {}))
+    assert job['status'] == FAILED
+    assert 'Drive is down' in job['error']
+
+
+def test_unknown_job(tmp_path):
+    runner = JobRunner({}, store=JobStore(str(tmp_path / 'jobs.sqlite3')))
+    with pytest.raises(JobError):
+        runner.submit('missing', {})
+    with pytest.raises(JobError):
+        runner.get('missing')
+
+
+def test_unfinished_jobs_resume_after_restart(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite3'), lease=-1)  # The worker of the running job died
+    queued_id = store.create('count', {'total': 2})
+    running_id = store.create('count', {'total': 3})
+    assert store.claim(running_id)
+    assert store.get(queued_id)['status'] == QUEUED and store.get(running_id)['status'] == RUNNING
+
+    runner = JobRunner({'count': count_matches}, store=JobStore(str(tmp_path / 'jobs.sqlite3')))
+    assert runner.resume_unfinished() == 2
+    assert wait_for(runner, queued_id)['result'] == [{'matched': 1}]
+    assert wait_for(runner, running_id)['result'] == [{'matched': 1}]
+    assert store.get_queued() == []
+
+
+def test_job_is_claimed_once(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite3'))
+    job_id = store.create('count', {'total': 2})
+    assert store.claim(job_id)
+    assert not store.claim(job_id)
+
+    # A running job with a live lease belongs to another worker, it is not run again
+    runs = []
+    runner = JobRunner({'count': lambda params, progress: runs.append(params)}, store=store)
+    assert runner.resume_unfinished() == 0
+    assert store.requeue_abandoned() == []
+    assert store.get(job_id)['status'] == RUNNING and runs == []
+
+
+def test_resumed_in_two_processes_runs_once(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite3'))
+    job_id = store.create('count', {'total': 2})
+    runs = []
+
+    def run(params, progress):
+        runs.append(params)
+        return count_matches(params, progress)
+
+    runners = [JobRunner({'count': run}, store=JobStore(str(tmp_path / 'jobs.sqlite3'))) for _ in range(2)]
+    for runner in runners:
+        runner.resume_unfinished()
+    assert wait_for(runners[0], job_id)['status'] == SUCCEEDED
+    for runner in runners:
+        runner._executor.shutdown(wait=True)
+    assert len(runs) == 1
@@ -0,0 +1,24 @@
+import pytest
+from ..location_ledger import LocationLedger
+
+LOCATION = 'art club'
+RECOGNIZED_FILE = {'id': 'file-1', 'name': '2023-08-26T22:00:00_story.mp4'}
+SILENT_FILE = {'id': 'file-2', 'name': '2023-08-26T23:00:00_story.mp4'}
+RECOGNIZED_STORY = {'drive_url': 'https://drive.google.com/uc?id=file-1', 'metadata': [{'title': 'Red Samba'}]}
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return LocationLedger(str(tmp_path / 'location_ledger.sqlite3'))
+
+
+def test_record_and_get_processed(ledger):
+    ledger.record(LOCATION, RECOGNIZED_FILE, RECOGNIZED_STORY, bucket_version=1)
+    ledger.record(LOCATION, SILENT_FILE, None, bucket_version=1)
+    processed = ledger.get_processed(['file-1', 'file-2', 'file-3'], bucket_version=1)
+    assert processed == {'file-1': RECOGNIZED_STORY, 'file-2': None}
+
+
+def test_bucket_change_reprocesses(ledger):
+    ledger.record(LOCATION, RECOGNIZED_FILE, RECOGNIZED_STORY, bucket_version=1)
+    assert ledger.get_processed(['file-1'], bucket_version=2) == {}
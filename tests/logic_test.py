@@ -1,8 +1,14 @@
 import pytest
 import os.path
-from tests.test_tools import url_validator
+from concurrent.futures import Future
+from types import SimpleNamespace
+from .test_tools import url_validator
 import datetime
-from logic import logic, location_logic
+from .. import drive_logic, logic as logic_module
+from ..location_ledger import LocationLedger
+from ..dash_manifest import AudioRepresentation
+from ..workspace import workspace
+from ..logic import logic, location_logic
 
 YULA_BAR_USERNAME = 'yula.bar'
 SHAKED_BEN_BARUCH_USERNAME = 'shaked.b.b'
@@ -38,3 +44,243 @@ def test_location_logic():
     first_story_download_url = recognized_stories[0]['download_url']
     assert url_validator(first_story_url)
     assert url_validator(first_story_download_url)
+
+
+FILES = [{'id': f"f{number}", 'name': f"2023-08-24T2{number}:00:00_story.mp4", 'md5': f"md5-{number}"}
+         for number in range(4)]
+RED_SAMBA = [{'title': 'Red Samba'}]
+BILLIE_JEAN = [{'title': 'Billie Jean'}]
+ALAWAN = [{'title': 'Alawan'}]
+
+
+class QueuedDownload(Future):
+    """A download waiting for a worker. Cancelling it notifies its waiters, as the executor does when it reaches it."""
+    def cancel(self):
+        cancelled = super().cancel()
+        if cancelled:
+            self.set_running_or_notify_cancel()
+        return cancelled
+
+
+class FakeDrive:
+    """Lists the files, downloads come back as futures, completed right away unless only some are `completed`."""
+    def __init__(self, files, completed=None):
+        self.files = files
+        self.completed = completed
+        self.submitted = []
+        self.downloads = {}
+        self.downloaded_later = []
+
+    def get_files(self, **_kwargs):
+        return self.files
+
+    def submit_downloads(self, files, directory):
+        futures = []
+        for file in files:
+            self.submitted.append(file['id'])
+            future = QueuedDownload()
+            if self.completed is None or file['id'] in self.completed:
+                future.set_result(os.path.join(directory, f"{file['id']}.mp4"))
+            self.downloads[file['id']] = future
+            futures.append(future)
+        return futures
+
+    def download_drive_files(self, files, directory):
+        self.downloaded_later.extend(file['id'] for file in files)
+        return [{'id': file['id'], 'path': os.path.join(directory, f"{file['id']}.mp4")} for file in files]
+
+    def get_file_link(self, file_id):
+        return f"https://drive.google.com/file/d/{file_id}/view"
+
+    def get_download_link(self, file_id):
+        return f"https://drive.google.com/uc?id={file_id}"
+
+
+class FakeRecognizer:
+    """recognize_clip answering by the clip's file name (the clip is its path, see the pipeline fixture)."""
+    def __init__(self, results):
+        self.results = results
+        self.failing = set()
+        self.calls = []
+
+    def __call__(self, clip, name=None, source_keys=None):
+        clip_id = os.path.splitext(os.path.basename(clip))[0]
+        self.calls.append(clip_id)
+        if clip_id in self.failing:
+            raise RuntimeError(f"Can't recognize {clip_id}")
+        return self.results.get(clip_id, [])
+
+
+@pytest.fixture()
+def pipeline(tmp_path, monkeypatch):
+    """The recognition pipelines without Drive, Instagram or ACRCloud: f1 and f3 match, f0 and f2 don't."""
+    stories_dir = tmp_path / 'stories'
+    stories_dir.mkdir()
+    recognizer = FakeRecognizer({'f1': RED_SAMBA, 'f3': BILLIE_JEAN})
+    state = SimpleNamespace(drive=FakeDrive(FILES), cache={}, recognizer=recognizer, stories_dir=stories_dir)
+    monkeypatch.setattr(drive_logic, 'DOWNLOADED_STORIES_DIR', str(stories_dir))
+    monkeypatch.setattr(logic_module, 'Drive', lambda: state.drive)
+    monkeypatch.setattr(logic_module, 'PROCESSED_FILES', LocationLedger(str(tmp_path / 'ledger.sqlite3')))
+    monkeypatch.setattr(logic_module, 'get_bucket_version', lambda: 1)
+    monkeypatch.setattr(logic_module, 'get_cached_recognition', lambda source_key: state.cache.get(source_key))
+    monkeypatch.setattr(logic_module, 'check_if_video_has_audio', lambda path: True)
+    monkeypatch.setattr(logic_module, 'extract_clip', lambda audio: audio)
+    monkeypatch.setattr(logic_module, 'recognize_clip', state.recognizer)
+    return state
+
+
+def run_location_logic() -> list:
+    return list(logic_module.iter_location_logic(LOCATION, day=DATE.day, month=DATE.month, year=DATE.year))
+
+
+def stories_of(records: list) -> list:
+    """(position, file ID, recognized tracks) of the story records, by position"""
+    return sorted((record['position'], record['file_id'], record['story']['metadata'])
+                  for record in records if record['type'] == 'story')
+
+
+def test_location_records(pipeline):
+    records = run_location_logic()
+    assert records[0] == {'type': 'start', 'total': 4}
+    assert stories_of(records) == [(1, 'f1', RED_SAMBA), (3, 'f3', BILLIE_JEAN)]
+    assert records[-1] == {'type': 'summary', 'total': 4, 'processed': 4, 'matched': 2, 'failed': []}
+    story = next(record['story'] for record in records if record.get('file_id') == 'f1')
+    assert story['drive_url'] == pipeline.drive.get_file_link('f1')
+    assert story['download_url'] == pipeline.drive.get_download_link('f1')
+    assert os.listdir(pipeline.stories_dir) == []  # The run's workspace is removed
+
+
+def test_location_logic_in_drive_order(pipeline):
+    stories = location_logic(location=LOCATION, day=DATE.day, month=DATE.month, year=DATE.year)
+    assert [story['metadata'] for story in stories] == [RED_SAMBA, BILLIE_JEAN]
+
+
+def test_failed_file_is_reported_and_retried(pipeline):
+    pipeline.recognizer.failing.add('f1')
+    assert run_location_logic()[-1] == {'type': 'summary', 'total': 4, 'processed': 4, 'matched': 1,
+                                        'failed': ['f1']}
+
+    pipeline.recognizer.failing.clear()
+    pipeline.drive = FakeDrive(FILES)
+    records = run_location_logic()
+    assert pipeline.drive.submitted == ['f1']  # The failed file wasn't recorded as processed
+    assert stories_of(records) == [(1, 'f1', RED_SAMBA), (3, 'f3', BILLIE_JEAN)]
+    assert records[-1]['failed'] == []
+
+
+def test_processed_files_are_replayed(pipeline, monkeypatch):
+    first_records = run_location_logic()
+    recognitions = len(pipeline.recognizer.calls)
+
+    pipeline.drive = FakeDrive(FILES)
+    records = run_location_logic()
+    assert pipeline.drive.submitted == []
+    assert len(pipeline.recognizer.calls) == recognitions
+    assert stories_of(records) == stories_of(first_records)
+    assert records[-1] == first_records[-1]
+
+    monkeypatch.setattr(logic_module, 'get_bucket_version', lambda: 2)  # The bucket changed, process them again
+    pipeline.drive = FakeDrive(FILES)
+    run_location_logic()
+    assert sorted(pipeline.drive.submitted) == ['f0', 'f1', 'f2', 'f3']
+
+
+def test_cached_recognition_skips_download(pipeline):
+    pipeline.cache['drive-md5:md5-2'] = ALAWAN
+    records = run_location_logic()
+    assert 'f2' not in pipeline.drive.submitted
+    assert 'f2' not in pipeline.recognizer.calls
+    assert stories_of(records) == [(1, 'f1', RED_SAMBA), (2, 'f2', ALAWAN), (3, 'f3', BILLIE_JEAN)]
+
+
+def test_closing_the_stream_cancels_downloads(pipeline):
+    pipeline.drive = FakeDrive(FILES, completed={'f1'})
+    records = logic_module.iter_location_logic(LOCATION, day=DATE.day, month=DATE.month, year=DATE.year)
+    assert next(records) == {'type': 'start', 'total': 4}
+    assert next(records)['file_id'] == 'f1'
+    records.close()  # The client went away
+    assert all(pipeline.drive.downloads[file_id].cancelled() for file_id in ('f0', 'f2', 'f3'))
+    assert os.listdir(pipeline.stories_dir) == []
+
+
+def test_cached_recognition_gone_before_recognition(pipeline, monkeypatch):
+    cached_answers = iter([ALAWAN])  # Cached when the batch is submitted, gone (the bucket changed) by recognition
+
+    def get_cached_recognition(source_key):
+        return next(cached_answers, None) if source_key == 'drive-md5:md5-2' else None
+
+    monkeypatch.setattr(logic_module, 'get_cached_recognition', get_cached_recognition)
+    pipeline.recognizer.results['f2'] = ALAWAN
+    records = run_location_logic()
+    assert 'f2' not in pipeline.drive.submitted
+    assert pipeline.drive.downloaded_later == ['f2']  # Downloaded and recognized, not taken for no match
+    assert stories_of(records) == [(1, 'f1', RED_SAMBA), (2, 'f2', ALAWAN), (3, 'f3', BILLIE_JEAN)]
+
+
+class FakeInstagramBot:
+    """A user's stories, downloaded into the stories directory except the `failing_downloads`."""
+    def __init__(self, stories, stories_dir, failing_downloads=()):
+        self.stories = stories
+        self.stories_dir = stories_dir
+        self.failing_downloads = set(failing_downloads)
+
+    def get_user_id(self, username):
+        return f"{username}-id"
+
+    def get_user_stories(self, user_id):
+        return self.stories
+
+    def story_workspace(self):
+        return workspace(self.stories_dir)
+
+    def download_stories(self, stories, directory):
+        return {story_id: os.path.join(directory, f"{story_id}.mp4")
+                for story_id in stories if story_id not in self.failing_downloads}
+
+
+def test_instagram_records(pipeline, monkeypatch):
+    stories = {story_id: {'artist': 'Jenja & The Band', 'album': None} for story_id in ('s0', 's1', 's2', 's3')}
+    monkeypatch.setattr(logic_module, 'IGBOT',
+                        lambda: FakeInstagramBot(stories, str(pipeline.stories_dir), failing_downloads={'s1'}))
+    pipeline.cache['instagram-story:s0'] = RED_SAMBA
+    pipeline.recognizer.results['s2'] = BILLIE_JEAN
+
+    records = list(logic_module.iter_logic(SHAKED_WORK_USERNAME))
+    assert [(record['type'], record.get('position')) for record in records] == [
+        ('start', None), ('story', 0), ('story', 2), ('summary', None)]  # Cached stories are answered first
+    assert records[1]['tracks'] == [{'title': 'Red Samba', 'artist': 'Jenja & The Band', 'album': None}]
+    assert records[-1] == {'type': 'summary', 'total': 4, 'processed': 4, 'matched': 2, 'failed': ['s1']}
+    assert 's0' not in pipeline.recognizer.calls
+    assert os.listdir(pipeline.stories_dir) == []
+
+    assert [track['title'] for track in logic(SHAKED_WORK_USERNAME)] == ['Red Samba', 'Billie Jean']
+
+
+class FakePostsBot:
+    """Audio representations of a location's posts. Only the start of the audio is downloaded, here its URL path."""
+    representations = {}
+    downloads = []
+
+    def get_audio_representations_from_post_location_id(self, location_id):
+        return self.representations
+
+    @staticmethod
+    def download_audio_representation_start(representation):
+        FakePostsBot.downloads.append(representation.url)
+        return representation.url.split('?')[0].replace('https://cdn.example.com', '')
+
+
+def test_location_posts_logic(pipeline, monkeypatch):
+    first, second, third, failing = (AudioRepresentation(f"https://cdn.example.com/{name}.mp4?signature={name}", 64000)
+                                     for name in ('a1', 'b1', 'b2', 'b3'))
+    monkeypatch.setattr(FakePostsBot, 'representations', {'user_a': [first], 'user_b': [second, third, failing]})
+    monkeypatch.setattr(FakePostsBot, 'downloads', [])
+    monkeypatch.setattr(logic_module, 'IGBOT', FakePostsBot)
+    pipeline.recognizer.results['a1'] = RED_SAMBA
+    pipeline.recognizer.failing.add('b3')
+    pipeline.cache['instagram-audio:/b2.mp4'] = ALAWAN  # Cached by the URL path, the signature changes
+
+    recognized_posts = logic_module.location_posts_logic(1234)
+    assert recognized_posts == {'user_a': [{'audio_url': first.url, 'metadata': RED_SAMBA}],
+                                'user_b': [{'audio_url': third.url, 'metadata': ALAWAN}]}
+    assert sorted(FakePostsBot.downloads) == sorted([first.url, second.url, failing.url])
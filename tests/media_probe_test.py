@@ -0,0 +1,51 @@
+import os
+import struct
+import pytest
+from tests import MEDIA_TESTS_DIR
+from ..media_probe import probe_mp4, MediaProbeError
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def track(handler_type: bytes, codec: bytes, timescale: int, duration: int) -> bytes:
+    media_header = box(b'mdhd', bytes(12) + struct.pack('>II', timescale, duration) + bytes(4))
+    handler = box(b'hdlr', bytes(8) + handler_type + bytes(13))
+    sample_description = box(b'stsd', bytes(4) + struct.pack('>I', 1) + box(codec, bytes(8)))
+    sample_table = box(b'minf', box(b'stbl', sample_description))
+    return box(b'trak', box(b'mdia', media_header + handler + sample_table))
+
+
+def mp4(*tracks: bytes, movie_duration: int = 15000) -> bytes:
+    movie_header = box(b'mvhd', bytes(12) + struct.pack('>II', 1000, movie_duration) + bytes(80))
+    return box(b'ftyp', b'isom' + bytes(4)) + box(b'mdat', bytes(1024)) + box(b'moov', movie_header + b''.join(tracks))
+
+
+@pytest.fixture
+def write_mp4(tmp_path):
+    def write(content: bytes) -> str:
+        path = str(tmp_path / 'story.mp4')
+        with open(path, 'wb') as video_file:
+            video_file.write(content)
+        return path
+    return write
+
+
+def test_probe_video_with_audio(write_mp4):
+    media_info = probe_mp4(write_mp4(mp4(track(b'vide', b'avc1', 90000, 1350000),
+                                         track(b'soun', b'mp4a', 44100, 661500))))
+    assert media_info.has_audio
+    assert media_info.audio_codec == 'mp4a'
+    assert media_info.duration == 15
+
+
+def test_probe_silent_video(write_mp4):
+    media_info = probe_mp4(write_mp4(mp4(track(b'vide', b'avc1', 90000, 1350000))))
+    assert not media_info.has_audio
+    assert media_info.audio_codec is None
+
+
+def test_probe_not_mp4():
+    with pytest.raises(MediaProbeError):
+        probe_mp4(os.path.join(MEDIA_TESTS_DIR, 'wrong_file_format.txt'))
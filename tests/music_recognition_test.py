@@ -1,6 +1,12 @@
 import os
 import io
+import time
 import pytest
+from .. import music_recognition
+from ..bucket_catalog import BucketCatalog
+from ..fingerprint import FingerprintIndex
+from ..recognition_cache import RecognitionCache
+from .fingerprint_test import synthetic_track
 from ..music_recognition import recognize, get_files_in_db, upload_to_db_protected, delete_id_from_db
 from ..music_recognition import get_id_from_title, get_musical_metadata, get_human_readable_db
 from ..music_recognition import delete_from_db, delete_id_from_db_protected_for_web, MusicDuplicationError
@@ -152,3 +158,77 @@ def test_delete_id_from_db_protected_for_web(cleanup):
     db_after_delete = get_files_in_db()
     assert db_after_delete != db_before_delete
     assert added_track_title not in db_after_delete
+
+
+@pytest.fixture()
+def reference_tracks(tmp_path, monkeypatch):
+    """A bucket of two tracks with a reference copy of each in a tracks directory, and an empty fingerprint index."""
+    tracks_dir = tmp_path / 'tracks'
+    tracks_dir.mkdir()
+    samples = {}
+    for seed, title in enumerate(['Red Samba', 'Billie Jean'], start=1):
+        track_path = str(tracks_dir / f"{title}.wav")
+        open(track_path, 'wb').close()
+        samples[track_path] = synthetic_track(seed=seed, seconds=40)
+    bucket = [{'id': 1, 'title': 'Red Samba'}, {'id': 2, 'title': 'Billie Jean'}]
+    monkeypatch.setattr(music_recognition, 'load_audio_samples', lambda audio, seconds=None: samples[audio])
+    monkeypatch.setattr(music_recognition, 'CATALOG', BucketCatalog(loader=lambda: bucket))
+    monkeypatch.setattr(music_recognition, 'FINGERPRINT_INDEX', FingerprintIndex(str(tmp_path / 'index.npz')))
+    monkeypatch.setattr(music_recognition, 'RECOGNITION_CACHE', RecognitionCache(str(tmp_path / 'cache.sqlite3')))
+    monkeypatch.setattr(music_recognition, 'FINGERPRINT_TRACKS_DIR', str(tracks_dir))
+    monkeypatch.setattr(music_recognition, '_fingerprint_built_for', None)
+    return tracks_dir
+
+
+def test_build_fingerprint_index(reference_tracks):
+    index = music_recognition.build_fingerprint_index(str(reference_tracks))
+    assert index.track_ids == {1, 2}
+    assert index.is_ready()
+    assert music_recognition.FINGERPRINT_INDEX.is_ready()  # The index in use is reloaded
+
+
+def test_build_fingerprint_index_missing_track(reference_tracks):
+    os.remove(reference_tracks / 'Billie Jean.wav')
+    index = music_recognition.build_fingerprint_index(str(reference_tracks))
+    assert index.track_ids == {1}
+    assert not index.is_ready()  # Can't reject clips without every bucket track
+
+
+def test_catalog_refresh_builds_fingerprint_index(reference_tracks, monkeypatch):
+    builds = []
+    monkeypatch.setattr(music_recognition, 'build_fingerprint_index', builds.append)
+    music_recognition._on_catalog_refresh({1, 2})
+    deadline = time.monotonic() + 5
+    while not builds and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert builds == [str(reference_tracks)]
+
+    music_recognition._on_catalog_refresh({1, 2})  # Not rebuilt for the same tracks
+    time.sleep(0.1)
+    assert len(builds) == 1
+
+
+def test_iter_files_pages(monkeypatch):
+    pages = {page: {'data': [{'id': page * 10}, {'id': page * 10 + 1}], 'meta': {'current_page': page, 'last_page': 3}}
+             for page in range(1, 4)}
+    requested_pages = []
+
+    def get_files_page(page):
+        requested_pages.append(page)
+        return pages[page]
+
+    monkeypatch.setattr(music_recognition, '_get_files_page', get_files_page)
+    listed_pages = list(music_recognition.iter_files_pages())
+    assert listed_pages[0] == pages[1]  # Tells how many pages there are
+    assert sorted(page['meta']['current_page'] for page in listed_pages) == [1, 2, 3]
+    assert sorted(requested_pages) == [1, 2, 3]  # Every page once
+
+    db = music_recognition.get_files_in_db()
+    assert [bucket_file['id'] for bucket_file in db['data']] == [10, 11, 20, 21, 30, 31]  # In page order
+    assert db['meta']['total'] == 6
+
+
+def test_iter_files_pages_single_page(monkeypatch):
+    page = {'data': [{'id': 1}], 'meta': {'current_page': 1, 'last_page': 1}}
+    monkeypatch.setattr(music_recognition, '_get_files_page', lambda page_number: page)
+    assert list(music_recognition.iter_files_pages()) == [page]
@@ -0,0 +1,78 @@
+import time
+import threading
+import multiprocessing
+
+import pytest
+from ..rate_limiter import RateLimiter, RateLimitTimeout, TICKET_TTL
+
+
+def acquire_times(path: str, count: int, queue) -> None:
+    limiter = RateLimiter('test', rate=20, path=path)
+    for _ in range(count):
+        limiter.acquire()
+        queue.put(time.time())
+
+
+def test_burst_then_rate(tmp_path):
+    limiter = RateLimiter('test', rate=20, capacity=3, path=str(tmp_path / 'rate_limits.sqlite3'))
+    started_at = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - started_at < 0.1  # The burst doesn't wait
+    for _ in range(4):
+        limiter.acquire()
+    assert time.monotonic() - started_at >= 4 / 20 - 0.02
+
+
+def test_limit_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'rate_limits.sqlite3')
+    RateLimiter('test', rate=20, path=path).acquire()  # Create the database before the processes race
+    queue = multiprocessing.get_context('spawn').Queue()
+    processes = [multiprocessing.get_context('spawn').Process(target=acquire_times, args=(path, 4, queue))
+                 for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=30)
+    times = sorted(queue.get(timeout=1) for _ in range(12))
+    # 12 requests at 20 per second from three processes take at least 11 intervals
+    assert times[-1] - times[0] >= 11 / 20 - 0.05
+
+
+def test_callers_are_served_in_arrival_order(tmp_path):
+    path = str(tmp_path / 'rate_limits.sqlite3')
+    limiter = RateLimiter('test', rate=10, path=path)
+    limiter.acquire()  # Empty the bucket, so the callers below queue up
+    served = []
+
+    def call(caller: int):
+        RateLimiter('test', rate=10, path=path).acquire()
+        served.append(caller)
+
+    threads = []
+    for caller in range(4):
+        thread = threading.Thread(target=call, args=(caller,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)  # Arrive in order, well before the next token
+    for thread in threads:
+        thread.join()
+    assert served == [0, 1, 2, 3]
+
+
+def test_timeout_leaves_the_queue(tmp_path):
+    limiter = RateLimiter('test', rate=0.5, path=str(tmp_path / 'rate_limits.sqlite3'))
+    limiter.acquire()
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(timeout=0.1)
+    with limiter._connect() as connection:
+        assert connection.execute("SELECT COUNT(*) FROM tickets").fetchone()[0] == 0
+
+
+def test_dead_callers_lose_their_turn(tmp_path):
+    limiter = RateLimiter('test', rate=100, path=str(tmp_path / 'rate_limits.sqlite3'))
+    with limiter._connect() as connection:  # A caller whose process died while waiting
+        connection.execute("INSERT INTO tickets (bucket, expires_at) VALUES (?, ?)", ('test', time.time() - 1))
+    started_at = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - started_at < TICKET_TTL
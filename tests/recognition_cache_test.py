@@ -0,0 +1,40 @@
+import pytest
+from ..recognition_cache import RecognitionCache, hash_clip
+
+CLIP = b'\x01\x02' * 8000
+RESULT = [{'title': 'Red Samba', 'acrid': 'abc'}]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    recognition_cache = RecognitionCache(str(tmp_path / 'recognition_cache.sqlite3'))
+    recognition_cache.set_bucket({1, 2})
+    return recognition_cache
+
+
+def test_put_and_get(cache):
+    assert cache.get(hash_clip(CLIP)) is None
+    cache.put(hash_clip(CLIP), RESULT, source_keys=['drive-md5:123'])
+    assert cache.get(hash_clip(CLIP)) == RESULT
+    assert cache.get_by_source('drive-md5:123') == RESULT
+    assert cache.get_by_source('drive-md5:456') is None
+
+
+def test_no_match_is_cached(cache):
+    cache.put(hash_clip(CLIP), False)
+    assert cache.get(hash_clip(CLIP)) is False
+
+
+def test_bucket_change_invalidates(cache):
+    cache.put(hash_clip(CLIP), RESULT, source_keys=['instagram-story:1'])
+    cache.set_bucket({1, 2})
+    assert cache.get(hash_clip(CLIP)) == RESULT
+    cache.set_bucket({1, 2, 3})
+    assert cache.get(hash_clip(CLIP)) is None
+    assert cache.get_by_source('instagram-story:1') is None
+
+
+def test_link_source_to_cached_clip(cache):
+    cache.put(hash_clip(CLIP), RESULT)
+    cache.link(hash_clip(CLIP), ['drive-md5:789'])
+    assert cache.get_by_source('drive-md5:789') == RESULT
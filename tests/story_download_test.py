@@ -0,0 +1,126 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from .. import instagram_bot
+from ..instagram_bot import IGBOT, IGDownloadError
+
+VIDEO = os.urandom(1024 * 1024)
+
+
+class CDNHandler(BaseHTTPRequestHandler):
+    """
+    Serves VIDEO for /story-*, honoring Range requests for /story-*-ranged, 404 for anything else.
+    """
+
+    def do_GET(self):
+        if not self.path.startswith('/story-'):
+            self.send_error(404)
+            return
+        body = VIDEO
+        if self.path.endswith('-ranged') and self.headers.get('Range'):
+            start, end = self.headers['Range'].replace('bytes=', '').split('-')
+            body = VIDEO[int(start):int(end) + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(VIDEO)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            pass  # The client read what it needed
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def cdn_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CDNHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def stories_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(instagram_bot, 'STORIES_DIR_PATH', str(tmp_path))
+    return tmp_path
+
+
+def story(url: str) -> dict:
+    return {'video_versions': [{'url': url}]}
+
+
+def test_download_stories_in_parallel(cdn_url, stories_dir):
+    stories = {f'{story_id}': story(f'{cdn_url}/story-{story_id}.mp4') for story_id in range(12)}
+    downloaded = IGBOT.download_stories(stories, max_workers=4)
+    assert set(downloaded) == set(stories)
+    for story_id, path in downloaded.items():
+        assert path == os.path.join(str(stories_dir), f'{story_id}.mp4')
+        with open(path, 'rb') as video:
+            assert video.read() == VIDEO
+
+
+def test_failed_story_does_not_affect_others(cdn_url, stories_dir):
+    stories = {'good': story(f'{cdn_url}/story-good.mp4'), 'missing': story(f'{cdn_url}/gone.mp4')}
+    downloaded = IGBOT.download_stories(stories)
+    assert list(downloaded) == ['good']
+    assert sorted(os.listdir(stories_dir)) == ['good.mp4']  # No partial file left behind
+
+
+def test_download_user_stories_leaves_out_failed(cdn_url, monkeypatch):
+    stories = {'good': story(f'{cdn_url}/story-good.mp4'), 'missing': story(f'{cdn_url}/gone.mp4')}
+    bot = IGBOT()
+    monkeypatch.setattr(bot, 'get_user_stories', lambda user_id: stories)
+    assert bot.download_user_stories_as_videos('user') == {'good': stories['good']}
+
+
+def test_download_story_error(cdn_url):
+    with pytest.raises(IGDownloadError):
+        IGBOT.download_story('missing', story(f'{cdn_url}/gone.mp4'))
+
+
+def test_story_workspace_is_removed(cdn_url, stories_dir):
+    with IGBOT.story_workspace() as workspace:
+        downloaded = IGBOT.download_stories({'mine': story(f'{cdn_url}/story-mine.mp4')}, workspace)
+        assert downloaded == {'mine': os.path.join(workspace, 'mine.mp4')}
+        assert os.path.dirname(workspace) == str(stories_dir)
+    assert not os.path.exists(workspace)
+    assert os.listdir(stories_dir) == []
+
+
+def test_clean_stories_directory_keeps_workspaces(cdn_url, stories_dir):
+    IGBOT.download_stories({'old': story(f'{cdn_url}/story-old.mp4')})
+    with IGBOT.story_workspace() as workspace:
+        downloaded = IGBOT.download_stories({'mine': story(f'{cdn_url}/story-mine.mp4')}, workspace)
+        IGBOT.clean_stories_directory()
+        assert os.listdir(stories_dir) == [os.path.basename(workspace)]
+        assert os.path.exists(downloaded['mine'])
+
+
+def test_story_workspace_is_removed_on_error(stories_dir):
+    with pytest.raises(RuntimeError):
+        with IGBOT.story_workspace() as workspace:
+            open(os.path.join(workspace, 'partial.mp4'), 'wb').close()
+            raise RuntimeError
+    assert os.listdir(stories_dir) == []
+
+
+@pytest.mark.parametrize('path', ['/story-audio-ranged', '/story-audio'])
+def test_download_audio_start(cdn_url, path):
+    assert IGBOT.download_audio_start(f'{cdn_url}{path}', size=1000) == VIDEO[:1000]
+
+
+def test_download_audio_start_error(cdn_url):
+    with pytest.raises(IGDownloadError):
+        IGBOT.download_audio_start(f'{cdn_url}/gone')
+
+
+@pytest.mark.parametrize('path', ['/story-audio-ranged', '/story-audio'])
+def test_download_range(cdn_url, path):
+    assert IGBOT._download_range(f'{cdn_url}{path}', 1000, 1999) == VIDEO[1000:2000]
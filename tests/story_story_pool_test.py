@@ -0,0 +1,94 @@
+import os
+import threading
+
+import pytest
+os.environ.setdefault('EMAIL', 'test@example.com')
+os.environ.setdefault('PASSWORD', 'password')
+from selenium.common.exceptions import WebDriverException
+from ..story_story_logic import StoryStorySessionPool, StoryStoryError
+
+
+class FakeSession:
+    created = 0
+
+    def __init__(self):
+        FakeSession.created += 1
+        self.alive = True
+        self.closed = False
+
+    def is_alive(self) -> bool:
+        return self.alive and not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def reset_sessions():
+    FakeSession.created = 0
+
+
+def test_warm_then_reuse():
+    pool = StoryStorySessionPool(size=2, session_factory=FakeSession)
+    pool.warm()
+    assert FakeSession.created == 2
+    for _ in range(5):
+        with pool.session() as session:
+            assert isinstance(session, FakeSession)
+    assert FakeSession.created == 2
+
+
+def test_dead_session_is_replaced():
+    pool = StoryStorySessionPool(size=1, session_factory=FakeSession)
+    with pool.session() as session:
+        first_session = session
+    first_session.alive = False
+    with pool.session() as session:
+        assert session is not first_session
+    assert first_session.closed
+
+
+def test_session_broken_during_use_is_closed():
+    pool = StoryStorySessionPool(size=1, session_factory=FakeSession)
+    with pytest.raises(WebDriverException):
+        with pool.session() as session:
+            broken_session = session
+            raise WebDriverException("chrome not reachable")
+    assert broken_session.closed
+    with pool.session() as session:
+        assert session is not broken_session
+
+
+def test_pool_size_bounds_browsers():
+    pool = StoryStorySessionPool(size=1, session_factory=FakeSession)
+    with pool.session():
+        with pytest.raises(StoryStoryError):
+            with pool.session(timeout=0.05):
+                pass
+    assert FakeSession.created == 1
+
+
+def test_waiting_request_gets_returned_session():
+    pool = StoryStorySessionPool(size=1, session_factory=FakeSession)
+    borrowed = []
+
+    def borrow():
+        with pool.session(timeout=5) as session:
+            borrowed.append(session)
+
+    with pool.session() as first_session:
+        thread = threading.Thread(target=borrow)
+        thread.start()
+    thread.join()
+    assert borrowed == [first_session]
+
+
+def test_close_quits_idle_browsers():
+    pool = StoryStorySessionPool(size=2, session_factory=FakeSession)
+    pool.warm()
+    with pool.session() as session:
+        pool.close()
+    assert session.closed
+    with pytest.raises(StoryStoryError):
+        with pool.session():
+            pass
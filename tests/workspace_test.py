@@ -0,0 +1,25 @@
+import os
+
+import pytest
+from ..workspace import workspace, remove_files
+
+
+def test_workspace_is_removed(tmp_path):
+    with workspace(str(tmp_path)) as path:
+        open(os.path.join(path, 'story.mp4'), 'wb').close()
+        assert os.path.dirname(path) == str(tmp_path)
+    assert os.listdir(tmp_path) == []
+
+
+def test_workspace_is_removed_on_error(tmp_path):
+    with pytest.raises(RuntimeError):
+        with workspace(str(tmp_path)):
+            raise RuntimeError
+    assert os.listdir(tmp_path) == []
+
+
+def test_remove_files_keeps_workspaces(tmp_path):
+    open(tmp_path / 'old.mp4', 'wb').close()
+    with workspace(str(tmp_path)) as path:
+        remove_files(str(tmp_path))
+        assert os.listdir(tmp_path) == [os.path.basename(path)]
@@ -0,0 +1,25 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def workspace(directory: str, prefix: str = 'stories-'):
+    """
+    A directory of its own (inside the entered directory) for one run's files, deleted with everything in it when the
+    run ends (even if it fails), so concurrent runs never see or delete each other's files.
+    """
+    path = tempfile.mkdtemp(prefix=prefix, dir=directory)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_files(directory: str) -> None:
+    """Delete the files in a directory. Directories (the workspaces of running runs) are left alone."""
+    for file in os.listdir(directory):
+        file_path = os.path.join(directory, file)
+        if os.path.isfile(file_path):
+            os.remove(file_path)